@@ -1,9 +1,34 @@
+from __future__ import annotations
+
 import click
 import os
+import sys
+import re
 import json
+import hashlib
+import mmap
+import bisect
+from array import array
+from itertools import accumulate, islice
+import threading
+import contextvars
+import time
+import random
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
-from anthropic import Anthropic, APIError, RateLimitError, BadRequestError
-from anthropic.types import ContentBlock, MessageParam, ToolParam, ToolResultBlockParam
+from typing import TYPE_CHECKING
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks
+    fcntl = None
+
+# The anthropic SDK, asyncio, sqlite3 and concurrent.futures are imported
+# inside the functions that use them: the CLI runs from editor hooks, and
+# commands like `list`, `new` and `init` should not pay for the SDK import.
+# benchmarks/startup.py guards this.
+if TYPE_CHECKING:
+    from anthropic.types import ContentBlock
 
 BaseSPrompt = """
 ### Shared Part of System Prompt ###
@@ -26,7 +51,47 @@ You and the associated code are still in development. When things do not seem as
 """
 
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
-client = Anthropic(api_key=ANTHROPIC_API_KEY)
+_client = None
+_client_loop = None
+# While serving, the daemon's one long-lived event loop (see serve).
+_daemon_loop = None
+
+def get_client():
+    """The API client for the running event loop; submits run on asyncio."""
+    import asyncio
+    global _client, _client_loop
+    # An async client's connection pool belongs to the loop it was made on.
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        from anthropic import AsyncAnthropic
+        # Retries are owned by the rate limiter below, which sees every attempt's headers.
+        _client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+        _client_loop = loop
+    return _client
+
+def run_async(coro):
+    """Runs a submit's coroutine to completion. In the daemon every submit shares
+    its loop, so the clients and their connection pools stay warm; otherwise it
+    gets a new loop whose clients are closed at the end."""
+    import asyncio
+    if _daemon_loop is not None:
+        return asyncio.run_coroutine_threadsafe(coro, _daemon_loop).result()
+    return asyncio.run(closing_clients(coro))
+
+async def closing_clients(coro):
+    try:
+        return await coro
+    finally:
+        await close_clients()
+
+async def close_clients():
+    import asyncio
+    global _client
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.close()
+        _client = None
+    for provider in _providers or []:
+        await provider.close()
 
 @click.group()
 def cli():
@@ -38,37 +103,1030 @@ def ensure_project_initialized():
         click.echo("Project not initialized. Run 'aiproject init' first.")
         exit(1)
 
+# Small JSON state files (settings, project index, tree snapshot) are read
+# through a cache keyed by their stat, so a long-running process (`aiproject
+# serve`) parses each one again only after it changes. Callers must not
+# mutate what they get back.
+_json_cache = {}
+
+def read_json_cached(path):
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _json_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(path, 'r') as f:
+        data = json.load(f)
+    _json_cache[path] = (key, data)
+    return data
+
+def load_project_config():
+    try:
+        return read_json_cached('.aiproject.json')
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def project_setting(name, default):
+    return load_project_config().get(name, default)
+
+# Project state (indexes, caches, logs) lives under .aiproject/, next to the
+# .aiproject.json marker.
+PROJECT_STATE_DIR = '.aiproject'
+INDEX_FILE = os.path.join(PROJECT_STATE_DIR, 'index.json')
+INDEX_VERSION = 1
+DEFAULT_DIGEST_TOKEN_BUDGET = 2000
+DEFAULT_TOOL_WORKERS = 8
+DEFAULT_TOOL_TIMEOUT = 60
+DEFAULT_STREAM_FLUSH_INTERVAL = 0.05
+DEFAULT_STREAM_FLUSH_BYTES = 4096
+DEFAULT_FILE_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_LINE_INDEX_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_READ_FILE_MAX_BYTES = 256 * 1024
+DEFAULT_SEARCH_MAX_FILE_BYTES = 4 * 1024 * 1024
+DEFAULT_SEARCH_MAX_RESULTS = 50
+SUMMARY_SCAN_BYTES = 64 * 1024
+SUMMARY_MAX_CHARS = 160
+
+def estimate_tokens(text):
+    # Rough but cheap: ~4 characters per token for English text and code.
+    return (len(text) + 3) // 4
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+def write_text_atomic(path, text):
+    # Write beside the target and rename over it, so readers see the old or
+    # the new file, never a half-written one. Keeps the file's permissions.
+    # The temp name is hidden so listings and the indexes skip it.
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(temp_path, 'w', newline='') as f:
+            f.write(text)
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# File Locks
+# Several sessions can work in one project at once (threads of submit-many,
+# the daemon, separate processes), so every write to a conversation or project
+# file holds an advisory flock() for that file. The lock lives in a lock file
+# under .aiproject/locks/ named after the path, not on the file itself, so it
+# still holds across the temp-file-and-rename writes that replace the file.
+# A submit also holds a separate "session" lock on its conversation until it
+# ends, so a second submit of the same file is refused rather than
+# interleaved. Time spent waiting for locks goes to the telemetry log.
+LOCK_DIR = os.path.join(PROJECT_STATE_DIR, 'locks')
+_lock_waits = threading.local()
+
+class FileBusy(Exception):
+    pass
+
+def lock_path(path, kind='write'):
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:20]
+    return os.path.join(LOCK_DIR, f"{digest}.{kind}.lock")
+
+def acquire_lock(path, kind='write', blocking=True):
+    """Locks path; returns the lock file (close it to release) and the seconds waited."""
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    f = open(lock_path(path, kind), 'a')
+    if fcntl is None:
+        return f, 0.0
+    start = time.perf_counter()
+    try:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f, 0.0
+        except BlockingIOError:
+            if not blocking:
+                raise FileBusy(path)
+        fcntl.flock(f, fcntl.LOCK_EX)
+    except BaseException:
+        f.close()
+        raise
+    waited = time.perf_counter() - start
+    _lock_waits.seconds = lock_wait_seconds() + waited
+    return f, waited
+
+@contextmanager
+def file_lock(path):
+    lock, waited = acquire_lock(path)
+    try:
+        yield waited
+    finally:
+        lock.close()
+
+def lock_wait_seconds():
+    # Total lock wait of the calling thread, so a tool's share can be measured.
+    return getattr(_lock_waits, 'seconds', 0.0)
+
+def append_locked(filepath, text):
+    with file_lock(filepath) as waited, open(filepath, 'a') as f:
+        f.write(text)
+    return waited
+
+# Project Tree
+# Every listing, the project index and the search index walk the tree through
+# walk_tree(). Directory contents are cached in .aiproject/tree.json and reused
+# while the directory's own mtime is unchanged, so an unchanged tree costs one
+# stat per directory rather than a scandir of every file. Hidden entries and
+# anything matched by a .gitignore (the project's, or one inside the tree)
+# are skipped.
+TREE_SNAPSHOT = os.path.join(PROJECT_STATE_DIR, 'tree.json')
+DEFAULT_LIST_PAGE_SIZE = 200
+DEFAULT_MAX_LIST_LIMIT = 1000
+
+def glob_to_regex(pattern):
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        char = pattern[i]
+        closing = pattern.find(']', i + 2) if char == '[' else -1
+        if char == '*':
+            out.append('[^/]*')
+        elif char == '?':
+            out.append('[^/]')
+        elif closing != -1:
+            body = pattern[i + 1:closing].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append(f'[{body}]')
+            i = closing
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return "".join(out)
+
+def compile_glob(pattern):
+    # As in .gitignore, a pattern without a slash matches at any depth.
+    anchored = '/' in pattern.rstrip('/')
+    regex = glob_to_regex(pattern.strip('/'))
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return re.compile(regex + r'\Z')
+
+def read_gitignore(directory):
+    rules = []
+    base = '' if directory == '.' else directory + '/'
+    try:
+        with open(os.path.join(directory, '.gitignore'), 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        rules.append((base, compile_glob(line.rstrip('/')), negate, dir_only))
+    return rules
+
+def is_ignored(path, is_dir, rules):
+    ignored = False
+    for base, pattern, negate, dir_only in rules:
+        if (dir_only and not is_dir) or not path.startswith(base):
+            continue
+        if pattern.match(path[len(base):]):
+            ignored = not negate  # the last matching rule wins
+    return ignored
+
+def walk_tree(root='conversations'):
+    try:
+        snapshot = read_json_cached(TREE_SNAPSHOT)
+    except (OSError, json.JSONDecodeError):
+        snapshot = {}
+    fresh = {}
+    changed = False
+    paths = []
+    stack = [(root, read_gitignore('.'))]
+    while stack:
+        directory, rules = stack.pop()
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        cached = snapshot.get(directory)
+        if cached and cached[0] == mtime:
+            children = cached[1]
+        else:
+            try:
+                with os.scandir(directory) as entries:
+                    children = [[entry.name, entry.is_dir(follow_symlinks=False)] for entry in entries
+                                if entry.is_dir(follow_symlinks=False) or entry.is_file()]
+            except OSError:
+                continue
+            changed = True
+        fresh[directory] = [mtime, children]
+        if any(name == '.gitignore' for name, _ in children):
+            rules = rules + read_gitignore(directory)
+        for name, is_dir in children:
+            if name.startswith('.'):
+                continue
+            path = f"{directory}/{name}"
+            if is_ignored(path, is_dir, rules):
+                continue
+            if is_dir:
+                stack.append((path, rules))
+            else:
+                paths.append(path[len(root) + 1:])
+    if changed or fresh.keys() != snapshot.keys():
+        write_json_atomic(TREE_SNAPSHOT, fresh)
+    paths.sort()
+    return paths
+
+# Project Knowledge Index
+def summarize_text(text, ext):
+    lines = text.splitlines()
+    if ext in ('.md', '.markdown', '.rst'):
+        items = [line.lstrip('#').strip() for line in lines if line.startswith('#')]
+    elif ext == '.py':
+        items = [m.group(1) for line in lines
+                 if (m := re.match(r'(?:async\s+)?(?:def|class)\s+(\w+)', line))]
+    elif ext in ('.js', '.jsx', '.ts', '.tsx'):
+        items = [m.group(1) for line in lines
+                 if (m := re.match(r'(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:function\*?|class)\s+(\w+)', line))]
+    else:
+        items = []
+    if not items:
+        # No structure we recognise; the first few lines are the next best hint.
+        items = [line.strip() for line in lines if line.strip()][:3]
+    summary = "; ".join(items)
+    if len(summary) > SUMMARY_MAX_CHARS:
+        summary = summary[:SUMMARY_MAX_CHARS - 3] + "..."
+    return summary
+
+def fingerprint_file(path):
+    """Return (sha1, summary) reading the file once."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        head = f.read(SUMMARY_SCAN_BYTES)
+        sha.update(head)
+        while chunk := f.read(1024 * 1024):
+            sha.update(chunk)
+    if b'\0' in head:
+        return sha.hexdigest(), "binary file"
+    text = head.decode('utf-8', errors='replace')
+    return sha.hexdigest(), summarize_text(text, os.path.splitext(path)[1].lower())
+
+def load_project_index():
+    try:
+        index = read_json_cached(INDEX_FILE)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if index.get('version') != INDEX_VERSION:
+        return {}
+    return index.get('files', {})
+
+def update_project_index(root='conversations'):
+    """Bring the on-disk index up to date, re-reading only files whose stat changed."""
+    previous = load_project_index()
+    files = {}
+    changed = False
+    for relpath in walk_tree(root):
+        filepath = os.path.join(root, relpath)
+        try:
+            st = os.stat(filepath)
+            known = previous.get(relpath)
+            if known and known['size'] == st.st_size and known['mtime_ns'] == st.st_mtime_ns:
+                files[relpath] = known
+                continue
+            digest, summary = fingerprint_file(filepath)
+        except OSError:
+            continue
+        if known and known['hash'] == digest:
+            # Touched but not modified: keep the summary we already have.
+            summary = known['summary']
+        files[relpath] = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "hash": digest,
+            "summary": summary,
+        }
+        changed = True
+    if changed or files.keys() != previous.keys():
+        write_json_atomic(INDEX_FILE, {"version": INDEX_VERSION, "files": files})
+    return files
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def build_project_digest(files, token_budget, exclude=None):
+    paths = sorted(path for path in files if path != exclude)
+    if not paths:
+        return ""
+    header = (
+        "\n### Project Files ###\n"
+        f"The project contains {len(paths)} files, readable with the read_file tool. "
+        "Consult them when they look relevant to the request.\n"
+    )
+    lines = [header]
+    used = estimate_tokens(header)
+    shown = 0
+    # Room for the closing "more files" line, at its longest.
+    more_cost = estimate_tokens(f"- ... {len(paths)} more files not shown (use list_files).\n")
+    for path in paths:
+        entry = files[path]
+        line = f"- {path} ({format_size(entry['size'])}): {entry['summary']}\n"
+        cost = estimate_tokens(line)
+        reserve = more_cost if shown + 1 < len(paths) else 0
+        if used + cost + reserve > token_budget:
+            break
+        lines.append(line)
+        used += cost
+        shown += 1
+    if shown < len(paths):
+        lines.append(f"- ... {len(paths) - shown} more files not shown (use list_files).\n")
+    return "".join(lines)
+
+# Prompt Caching
+# The cached prefix is tools -> system -> messages. We use all four allowed
+# breakpoints: the last tool, the last system block, and the two newest user
+# turns (see with_cache_breakpoints).
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def build_system_prompt(exclude=None):
+    files = update_project_index()
+    budget = project_setting('digest_token_budget', DEFAULT_DIGEST_TOKEN_BUDGET)
+    blocks = [{"type": "text", "text": BaseSPrompt}]
+    digest = build_project_digest(files, budget, exclude=exclude)
+    if digest:
+        blocks.append({"type": "text", "text": digest})
+    blocks[-1]["cache_control"] = CACHE_CONTROL
+    return blocks
+
+def as_content_blocks(content):
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return [block if isinstance(block, dict) else block.to_dict(exclude_none=True)
+            for block in content]
+
+def with_cache_breakpoints(messages):
+    # The previous round's breakpoint sat on what is now the second-newest user
+    # turn. Keeping one there guarantees this round reads the prefix the last
+    # round wrote; the one on the newest turn writes the prefix for the next.
+    marked = messages[:]
+    user_turns = [i for i, message in enumerate(messages) if message['role'] == 'user']
+    for i in user_turns[-2:]:
+        blocks = as_content_blocks(messages[i]['content'])
+        if not blocks:
+            continue
+        blocks[-1] = {**blocks[-1], "cache_control": CACHE_CONTROL}
+        marked[i] = {**messages[i], "content": blocks}
+    return marked
+
+def report_usage(usage, lead="\n"):
+    cache_read = usage.cache_read_input_tokens or 0
+    cache_write = usage.cache_creation_input_tokens or 0
+    prompt_tokens = usage.input_tokens + cache_read + cache_write
+    hit_rate = cache_read / prompt_tokens if prompt_tokens else 0.0
+    click.echo(f"{lead}[usage] input: {usage.input_tokens}, cache read: {cache_read}, "
+               f"cache write: {cache_write}, output: {usage.output_tokens} "
+               f"(cache hit {hit_rate:.0%})")
+
+# File Content Cache
+# Process-wide LRU of file contents keyed by (path, mtime, size), capped in
+# bytes. A changed file gets a new key, so stale entries are never served;
+# the tool writes below also invalidate explicitly, since a same-size rewrite
+# can land within the filesystem's mtime granularity. sizeof gives an
+# entry's size in bytes; it is measured once, when the entry is stored.
+def encoded_size(text):
+    return len(text.encode('utf-8', errors='surrogatepass'))
+
+class FileCache:
+    def __init__(self, max_bytes, sizeof=encoded_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (content, size)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, content):
+        size = self.sizeof(content)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = (content, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def invalidate(self, path):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == path]:
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+_file_cache = None
+_file_cache_lock = threading.Lock()
+
+def get_file_cache():
+    global _file_cache
+    with _file_cache_lock:
+        if _file_cache is None:
+            _file_cache = FileCache(project_setting('file_cache_bytes', DEFAULT_FILE_CACHE_BYTES))
+        return _file_cache
+
+def file_key(filepath):
+    st = os.stat(filepath)
+    return (os.path.normpath(filepath), st.st_mtime_ns, st.st_size)
+
+# Line Index
+# Byte offset of the start of every line, built once per (path, mtime, size)
+# by scanning an mmap of the file in large chunks; after that, any line range
+# is two array lookups and one slice. Each index costs 8 bytes per line, so
+# they are kept in a FileCache capped at line_index_cache_bytes. An index
+# larger than the whole cap (a log of millions of lines) is written to
+# .aiproject/line-index/ instead and mapped from there on later reads, so it
+# is not rebuilt either; a file's older spilled indexes are removed then.
+LINE_INDEX_CHUNK = 8 * 1024 * 1024
+LINE_INDEX_DIR = os.path.join(PROJECT_STATE_DIR, 'line-index')
+_line_index_cache = None
+
+def build_line_index(filepath, size):
+    starts = array('Q')
+    if size == 0:
+        return starts
+    starts.append(0)
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for chunk_start in range(0, size, LINE_INDEX_CHUNK):
+            parts = mm[chunk_start:chunk_start + LINE_INDEX_CHUNK].split(b'\n')
+            # Each newline ends a part; the next line starts one byte after it.
+            starts.extend(islice(accumulate(map((1).__add__, map(len, parts[:-1])),
+                                            initial=chunk_start), 1, None))
+    if starts[-1] == size:
+        starts.pop()  # trailing newline, not an extra empty line
+    return starts
+
+def line_index_bytes(starts):
+    return len(starts) * starts.itemsize
+
+def get_line_index_cache():
+    global _line_index_cache
+    with _file_cache_lock:
+        if _line_index_cache is None:
+            max_bytes = project_setting('line_index_cache_bytes', DEFAULT_LINE_INDEX_CACHE_BYTES)
+            _line_index_cache = FileCache(max_bytes, sizeof=line_index_bytes)
+        return _line_index_cache
+
+def spilled_index_path(key):
+    path, mtime_ns, size = key
+    return os.path.join(LINE_INDEX_DIR, f"{hashlib.sha1(path.encode()).hexdigest()}-{mtime_ns}-{size}.idx")
+
+def spill_line_index(key, starts):
+    spill_path = spilled_index_path(key)
+    prefix = os.path.basename(spill_path).split('-')[0] + '-'
+    os.makedirs(LINE_INDEX_DIR, exist_ok=True)
+    for name in os.listdir(LINE_INDEX_DIR):
+        if name.startswith(prefix) and name.endswith('.idx'):
+            os.remove(os.path.join(LINE_INDEX_DIR, name))
+    temp_path = f"{spill_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        starts.tofile(f)
+    os.replace(temp_path, spill_path)
+
+def load_spilled_line_index(key):
+    # The mapping stays open for as long as the returned view is referenced.
+    try:
+        with open(spilled_index_path(key), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    return memoryview(mm).cast('Q')
+
+def get_line_index(filepath, key):
+    cache = get_line_index_cache()
+    starts = cache.get(key)
+    if starts is None:
+        starts = load_spilled_line_index(key)
+    if starts is None:
+        starts = build_line_index(filepath, key[2])
+        if line_index_bytes(starts) > cache.max_bytes:
+            try:
+                spill_line_index(key, starts)
+            except OSError:
+                pass  # rebuilt on the next read instead
+        else:
+            cache.put(key, starts)
+    return starts
+
+def read_slice(filepath, begin, end):
+    if end <= begin:
+        return ""
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[begin:end].decode('utf-8', errors='replace')
+
+def read_lines(filename, filepath, key, start_line, end_line, max_bytes):
+    starts = get_line_index(filepath, key)
+    total = len(starts)
+    first = max(1, start_line or 1)
+    last = min(total, end_line or total)
+    if first > last:
+        return f"[Lines {first}-{end_line or total} are out of range: '{filename}' has {total} lines.]"
+    begin = starts[first - 1]
+    end = starts[last] if last < total else key[2]
+    header = f"[Lines {first}-{last} of {total} in '{filename}']\n"
+    if end - begin > max_bytes:
+        # Cut at the last line boundary that fits, unless even one line does not.
+        cut = bisect.bisect_right(starts, begin + max_bytes) - 1
+        if cut >= first:
+            end = starts[cut]
+            header = (f"[Lines {first}-{cut} of {total} in '{filename}' (output capped at {max_bytes} bytes; "
+                      f"continue from start_line={cut + 1})]\n")
+        else:
+            # A single line longer than the cap: the rest of it is only
+            # reachable by byte offset.
+            line_end = starts[first] if first < total else key[2]
+            end = begin + max_bytes
+            header = (f"[First {max_bytes} of {line_end - begin} bytes of line {first} of {total} in "
+                      f"'{filename}' (output capped; read the rest of the line with offset={end}, "
+                      f"length={line_end - end}, then continue from start_line={first + 1})]\n")
+    return header + read_slice(filepath, begin, end)
+
+def read_bytes(filename, filepath, key, offset, length, max_bytes):
+    size = key[2]
+    begin = min(max(0, offset or 0), size)
+    end = size if length is None else min(size, begin + max(0, length))
+    header = f"[Bytes {begin}-{end} of {size} in '{filename}']\n"
+    if end - begin > max_bytes:
+        end = begin + max_bytes
+        header = (f"[Bytes {begin}-{end} of {size} in '{filename}' (output capped at {max_bytes} bytes; "
+                  f"continue from offset={end})]\n")
+    return header + read_slice(filepath, begin, end)
+
 # CRUD Operations
-def read_file(filename):
+MUTATING_TOOLS = {'write_file', 'append_file', 'delete_file', 'edit_file'}
+READ_RANGE_ARGS = ('start_line', 'end_line', 'offset', 'length')
+LIST_OPTIONS = ('pattern', 'cursor', 'limit')
+SEARCH_OPTIONS = ('regex', 'case_sensitive', 'path_glob', 'max_results', 'cursor')
+
+def read_file(filename, start_line=None, end_line=None, offset=None, length=None):
     filepath = os.path.join('conversations', filename)
     if not os.path.exists(filepath):
         return f"Error: File '{filename}' not found."
-    with open(filepath, 'r') as f:
-        return f.read()
+    key = file_key(filepath)
+    max_bytes = project_setting('read_file_max_bytes', DEFAULT_READ_FILE_MAX_BYTES)
+    if start_line is not None or end_line is not None:
+        return read_lines(filename, filepath, key, start_line, end_line, max_bytes)
+    if offset is not None or length is not None:
+        return read_bytes(filename, filepath, key, offset, length, max_bytes)
+    if key[2] > max_bytes:
+        lines = len(get_line_index(filepath, key))
+        return (f"[File '{filename}' is {format_size(key[2])} ({key[2]} bytes, {lines} lines), over the "
+                f"{max_bytes}-byte limit for a single read. Read part of it with start_line/end_line "
+                f"or offset/length.]")
+    content = get_file_cache().get(key)
+    if content is None:
+        with open(filepath, 'r') as f:
+            content = f.read()
+        get_file_cache().put(key, content)
+    return content
 
 def write_file(filename, content):
     filepath = os.path.join('conversations', filename)
-    with open(filepath, 'w') as f:
-        f.write(content)
+    with file_lock(filepath):
+        get_file_cache().invalidate(os.path.normpath(filepath))
+        write_text_atomic(filepath, content)
     return f"Successfully wrote to '{filename}'."
 
 def append_file(filename, content):
     filepath = os.path.join('conversations', filename)
-    with open(filepath, 'a') as f:
-        f.write(content)
+    with file_lock(filepath):
+        get_file_cache().invalidate(os.path.normpath(filepath))
+        with open(filepath, 'a') as f:
+            f.write(content)
     return f"Successfully appended to '{filename}'."
 
 def delete_file(filename):
     filepath = os.path.join('conversations', filename)
+    with file_lock(filepath):
+        if not os.path.exists(filepath):
+            return f"Error: File '{filename}' not found."
+        get_file_cache().invalidate(os.path.normpath(filepath))
+        os.remove(filepath)
+    return f"Successfully deleted '{filename}'."
+
+UNCHANGED_NOTE = ("[Unchanged since the read_file result for tool_use_id {}; "
+                  "content omitted to save context. Refer to that result.]")
+UNCHANGED_REFERENCE = re.compile(r'\[Unchanged since the read_file result for tool_use_id (\S+);')
+
+def read_file_once(filename, session, tool_use_id):
+    # Within one session an unchanged file is only sent in full once; later
+    # reads point back at that tool_result instead of adding another copy.
+    filepath = os.path.join('conversations', filename)
+    try:
+        key = file_key(filepath)
+    except OSError:
+        return read_file(filename)
+    earlier = session.delivered.get(key[0])
+    if earlier and earlier[0] == key:
+        return UNCHANGED_NOTE.format(earlier[1])
+    content = read_file(filename)
+    session.delivered[key[0]] = (key, tool_use_id)
+    return content
+
+def list_files(pattern=None, cursor=None, limit=None):
+    paths = walk_tree()
+    if pattern:
+        matcher = compile_glob(pattern)
+        paths = [path for path in paths if matcher.match(path)]
+    # Paths are sorted, so "everything after the last path returned" is a
+    # stable cursor even if files are added or removed between pages.
+    start = bisect.bisect_right(paths, cursor) if cursor else 0
+    limit = limit or project_setting('list_page_size', DEFAULT_LIST_PAGE_SIZE)
+    limit = min(max(1, limit), project_setting('max_list_limit', DEFAULT_MAX_LIST_LIMIT))
+    page = paths[start:start + limit]
+    files = []
+    for path in page:
+        try:
+            st = os.stat(os.path.join('conversations', path))
+        except OSError:
+            continue
+        files.append({
+            "path": path,
+            "size": st.st_size,
+            "mtime": datetime.fromtimestamp(st.st_mtime).isoformat(timespec='seconds'),
+        })
+    listing = {"total": len(paths), "files": files}
+    if start + limit < len(paths):
+        listing["next_cursor"] = page[-1]
+    return listing
+
+# File Edits
+# edit_file changes part of a file without the model re-sending all of it:
+# either exact-match replacements or a unified diff. Every edit is checked
+# against the current contents first and applied in memory; the file is only
+# replaced (atomically) if all of them apply, and the result is a one-line
+# summary rather than the new contents. Line endings are kept as they are.
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+class EditError(Exception):
+    pass
+
+def apply_replacements(text, edits):
+    count = 0
+    for number, edit in enumerate(edits, 1):
+        old, new = edit.get('old_text'), edit.get('new_text')
+        if not isinstance(old, str) or not isinstance(new, str):
+            raise EditError(f"edit {number} needs old_text and new_text strings")
+        if not old:
+            raise EditError(f"edit {number} has an empty old_text")
+        matches = text.count(old)
+        if matches == 0 and '\r\n' in text and '\r\n' not in old:
+            # The model writes \n; the file may use \r\n.
+            old, new = old.replace('\n', '\r\n'), new.replace('\n', '\r\n')
+            matches = text.count(old)
+        if matches == 0:
+            raise EditError(f"edit {number}: old_text not found")
+        if matches > 1 and not edit.get('replace_all'):
+            raise EditError(f"edit {number}: old_text matches {matches} times; include more "
+                            "surrounding text, or set replace_all")
+        text = text.replace(old, new)
+        count += matches
+    return text, count
+
+def parse_hunks(patch):
+    # Hunk header counts are not trusted: the lines themselves say what the
+    # hunk replaces. "\\ No newline at end of file" after a removed, added or
+    # context line means the old file, the new file or both lack a final newline.
+    hunks = []
+    lines = patch.split('\n')
+    while lines and not lines[-1].strip():
+        lines.pop()
+    for line in lines:
+        line = line.rstrip('\r')
+        header = HUNK_HEADER.match(line)
+        if header:
+            hunks.append({"start": int(header.group(1)), "old": [], "new": [],
+                          "old_eof": False, "new_eof": False, "last": None})
+        elif not hunks:
+            continue  # diff/index/---/+++ headers
+        elif line.startswith('\\'):
+            hunk = hunks[-1]
+            hunk['old_eof'] = hunk['old_eof'] or hunk['last'] in ('-', ' ')
+            hunk['new_eof'] = hunk['new_eof'] or hunk['last'] in ('+', ' ')
+        else:
+            kind, body = (line[:1] or ' '), line[1:]
+            if kind not in ' -+':
+                raise EditError(f"hunk {len(hunks)} has a line that is not context, - or +: {line[:60]!r}")
+            if kind in ' -':
+                hunks[-1]['old'].append(body)
+            if kind in ' +':
+                hunks[-1]['new'].append(body)
+            hunks[-1]['last'] = kind
+    if not hunks:
+        raise EditError("patch has no @@ hunks")
+    return hunks
+
+def find_hunk(lines, old, expected, start):
+    # At the line number the hunk names (shifted by earlier hunks) if it
+    # matches there, else at the nearest exact match after the previous hunk.
+    size = len(old)
+    if start <= expected and lines[expected:expected + size] == old:
+        return expected
+    candidates = [i for i in range(start, len(lines) - size + 1) if lines[i:i + size] == old]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda i: abs(i - expected))
+
+def apply_patch(text, patch):
+    parts = text.split('\n')
+    final_newline = parts[-1] == ''
+    if final_newline:
+        parts.pop()
+    lines = [part[:-1] if part.endswith('\r') else part for part in parts]
+    endings = ['\r\n' if part.endswith('\r') else '\n' for part in parts]
+    newline = endings[0] if endings else '\n'
+    hunks = parse_hunks(patch)
+    shift = 0
+    start = 0
+    for number, hunk in enumerate(hunks, 1):
+        old, new = hunk['old'], hunk['new']
+        # "-N,0" inserts after line N; otherwise the hunk starts at line N.
+        expected = min(len(lines), max(0, hunk['start'] - (1 if old else 0) + shift))
+        at = find_hunk(lines, old, expected, start)
+        if at is None:
+            raise EditError(f"hunk {number} does not match the current file "
+                            f"(it expects {old[0][:60]!r} near line {hunk['start']})")
+        lines[at:at + len(old)] = new
+        endings[at:at + len(old)] = [newline] * len(new)
+        if at + len(new) == len(lines):
+            if hunk['new_eof']:
+                final_newline = False
+            elif hunk['old_eof']:
+                final_newline = True
+        shift += len(new) - len(old)
+        start = at + len(new)
+    if lines and not final_newline:
+        endings[-1] = ''
+    return "".join(line + ending for line, ending in zip(lines, endings)), len(hunks)
+
+def edit_file(filename, edits=None, patch=None):
+    filepath = os.path.join('conversations', filename)
+    if bool(edits) == bool(patch):
+        return "Error: Give either edits or patch."
+    # The lock spans read, check and write, so a concurrent edit is never lost.
+    with file_lock(filepath):
+        return edit_file_locked(filename, filepath, edits, patch)
+
+def edit_file_locked(filename, filepath, edits, patch):
     if not os.path.exists(filepath):
         return f"Error: File '{filename}' not found."
-    os.remove(filepath)
-    return f"Successfully deleted '{filename}'."
+    with open(filepath, 'r', newline='') as f:
+        text = f.read()
+    try:
+        if edits:
+            updated, count = apply_replacements(text, edits)
+            change = f"{count} replacement(s)"
+        else:
+            updated, hunks = apply_patch(text, patch)
+            change = f"{hunks} hunk(s)"
+    except EditError as e:
+        return f"Error: Could not edit '{filename}': {e}. The file was not changed."
+    if updated == text:
+        return f"No change to '{filename}': the edit leaves it as it was."
+    get_file_cache().invalidate(os.path.normpath(filepath))
+    write_text_atomic(filepath, updated)
+    old_lines, new_lines = count_lines(text), count_lines(updated)
+    return f"Edited '{filename}': {change}, now {new_lines} lines ({new_lines - old_lines:+d})."
+
+def count_lines(text):
+    return text.count('\n') + (1 if text and not text.endswith('\n') else 0)
+
+# Search Index
+# A trigram inverted index over the project files in .aiproject/search.db.
+# It follows the project index: a file is re-tokenized only when its content
+# hash there changed. A query's literal text (or the literal runs a regex must
+# contain) narrows the candidates to files holding all of its trigrams; only
+# those are then read and matched line by line.
+SEARCH_DB = os.path.join(PROJECT_STATE_DIR, 'search.db')
+SNIPPET_MAX_CHARS = 200
+
+def open_search_db():
+    import sqlite3
+    os.makedirs(PROJECT_STATE_DIR, exist_ok=True)
+    db = sqlite3.connect(SEARCH_DB, timeout=30)
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, hash TEXT);
+        CREATE TABLE IF NOT EXISTS trigrams (
+            trigram TEXT, file_id INTEGER, PRIMARY KEY (trigram, file_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file_id);
+    ''')
+    return db
 
-def list_files():
-    return os.listdir('conversations')
+def text_trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def is_searchable(entry, max_bytes):
+    return entry['summary'] != "binary file" and entry['size'] <= max_bytes
+
+def update_search_index(db, root='conversations'):
+    files = update_project_index(root)
+    max_bytes = project_setting('search_max_file_bytes', DEFAULT_SEARCH_MAX_FILE_BYTES)
+    with db:
+        # One turn's searches run at once; taking the write lock before
+        # reading what is indexed makes their refreshes run one after another,
+        # each seeing what the previous one wrote.
+        db.execute('BEGIN IMMEDIATE')
+        known = {path: (file_id, digest) for file_id, path, digest in db.execute('SELECT id, path, hash FROM files')}
+        for path in known.keys() - files.keys():
+            file_id = known[path][0]
+            db.execute('DELETE FROM trigrams WHERE file_id = ?', (file_id,))
+            db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        for path, entry in files.items():
+            if path in known and known[path][1] == entry['hash']:
+                continue
+            if path in known:
+                file_id = known[path][0]
+                db.execute('DELETE FROM trigrams WHERE file_id = ?', (file_id,))
+                db.execute('UPDATE files SET hash = ? WHERE id = ?', (entry['hash'], file_id))
+            else:
+                file_id = db.execute('INSERT INTO files (path, hash) VALUES (?, ?)',
+                                     (path, entry['hash'])).lastrowid
+            # Binary and oversized files are tracked but get no postings, so
+            # they never come up as candidates; search_files reports them.
+            if not is_searchable(entry, max_bytes):
+                continue
+            try:
+                with open(os.path.join(root, path), 'r', encoding='utf-8', errors='replace') as f:
+                    trigrams = text_trigrams(f.read())
+            except OSError:
+                continue
+            db.executemany('INSERT OR IGNORE INTO trigrams (trigram, file_id) VALUES (?, ?)',
+                           ((trigram, file_id) for trigram in trigrams))
+    return files
+
+QUANTIFIER = re.compile(r'\{\d*(?:,\d*)?\}')
+
+def required_literals(pattern):
+    # Literal runs every match must contain. Conservative: anything optional,
+    # grouped or alternated is skipped, and a top-level "|" means no
+    # requirement at all (every file is a candidate).
+    if '|' in pattern:
+        return []
+    runs, run, depth, i = [], "", 0, 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            following = pattern[i + 1]
+            if following.isalnum():
+                runs.append(run)
+                run = ""
+            elif depth == 0:
+                run += following
+            i += 2
+            continue
+        if char == '(':
+            depth += 1
+            runs.append(run)
+            run = ""
+        elif char == ')':
+            depth = max(0, depth - 1)
+        elif char == '[':
+            runs.append(run)
+            run = ""
+            i = class_end(pattern, i)
+        elif char in '?*' or char == '{' and QUANTIFIER.match(pattern, i):
+            # The quantified character (or group, whose run is already
+            # empty) may repeat or be missing; skip the whole {m,n}.
+            runs.append(run[:-1])
+            run = ""
+            if char == '{':
+                i = QUANTIFIER.match(pattern, i).end() - 1
+        elif char in '.^$+':
+            runs.append(run)
+            run = ""
+        elif depth == 0:
+            run += char
+        i += 1
+    runs.append(run)
+    return [run for run in runs if len(run) >= 3]
+
+def class_end(pattern, start):
+    # The index of the "]" closing the character class opened at start. A
+    # "]" right after "[" or "[^" is a member, and so is an escaped one.
+    i = start + 1
+    if pattern[i:i + 1] == '^':
+        i += 1
+    if pattern[i:i + 1] == ']':
+        i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i
+
+def search_files(query, regex=False, case_sensitive=False, path_glob=None,
+                 max_results=DEFAULT_SEARCH_MAX_RESULTS, cursor=None):
+    flags = 0 if case_sensitive else re.IGNORECASE
+    try:
+        pattern = re.compile(query if regex else re.escape(query), flags)
+    except re.error as e:
+        return f"Error: Invalid regular expression: {e}"
+    # The same glob rules as list_files.
+    path_matcher = compile_glob(path_glob) if path_glob else None
+    max_results = max(1, max_results)
 
-def handle_tool_use(content_block: ContentBlock):
+    db = open_search_db()
+    try:
+        files = update_search_index(db)
+        max_bytes = project_setting('search_max_file_bytes', DEFAULT_SEARCH_MAX_FILE_BYTES)
+        searchable = {path for path, entry in files.items() if is_searchable(entry, max_bytes)}
+        trigrams = set()
+        for literal in (required_literals(query) if regex else [query]):
+            trigrams |= text_trigrams(literal)
+        if trigrams:
+            placeholders = ",".join("?" * len(trigrams))
+            rows = db.execute(
+                f'''SELECT path FROM files WHERE id IN (
+                    SELECT file_id FROM trigrams WHERE trigram IN ({placeholders})
+                    GROUP BY file_id HAVING COUNT(*) = ?)''',
+                (*trigrams, len(trigrams)))
+            candidates = sorted(path for (path,) in rows)
+        else:
+            # Nothing to narrow by: every file, including those too short to
+            # hold a trigram.
+            candidates = sorted(searchable)
+    finally:
+        db.close()
+    skipped = sorted(path for path in files.keys() - searchable
+                     if not path_matcher or path_matcher.match(path))
+
+    # Results are ordered by (path, line); the cursor is the last one returned.
+    after_path, after_line = None, 0
+    if cursor:
+        after_path, _, line = cursor.rpartition(':')
+        after_line = int(line) if line.isdigit() else 0
+    results = []
+    next_cursor = None
+    for path in candidates:
+        if after_path is not None and path < after_path:
+            continue
+        if path_matcher and not path_matcher.match(path):
+            continue
+        try:
+            with open(os.path.join('conversations', path), 'r', encoding='utf-8', errors='replace') as f:
+                for lineno, line in enumerate(f, 1):
+                    if path == after_path and lineno <= after_line:
+                        continue
+                    if not pattern.search(line):
+                        continue
+                    if len(results) == max_results:
+                        next_cursor = results[-1][0]
+                        break
+                    snippet = line.strip()
+                    if len(snippet) > SNIPPET_MAX_CHARS:
+                        snippet = snippet[:SNIPPET_MAX_CHARS - 3] + "..."
+                    results.append((f"{path}:{lineno}", snippet))
+        except OSError:
+            continue
+        if next_cursor:
+            break
+
+    lines = [f"{location}: {snippet}" for location, snippet in results] or [f"No matches for {query!r}."]
+    if next_cursor:
+        lines.append(f"[More matches: call search_files again with cursor={next_cursor!r}]")
+    if skipped:
+        names = ", ".join(skipped[:5]) + (", ..." if len(skipped) > 5 else "")
+        lines.append(f"[{len(skipped)} file(s) not searched (binary, or over {max_bytes} bytes): {names}]")
+    return "\n".join(lines)
+
+def handle_tool_use(content_block: ContentBlock, session=None):
     try:
         if content_block.type != 'tool_use':
             return None
@@ -76,16 +1134,30 @@ def handle_tool_use(content_block: ContentBlock):
         function_name = content_block.name
         arguments = content_block.input
 
+        if session is not None and function_name in MUTATING_TOOLS:
+            session.delivered.pop(os.path.normpath(os.path.join('conversations', arguments['filename'])), None)
+
         if function_name == 'read_file':
+            ranges = {name: arguments[name] for name in READ_RANGE_ARGS if arguments.get(name) is not None}
+            if ranges:
+                return read_file(arguments['filename'], **ranges)
+            if session is not None:
+                return read_file_once(arguments['filename'], session, content_block.id)
             return read_file(arguments['filename'])
         elif function_name == 'write_file':
             return write_file(arguments['filename'], arguments['content'])
+        elif function_name == 'edit_file':
+            return edit_file(arguments['filename'], arguments.get('edits'), arguments.get('patch'))
         elif function_name == 'append_file':
             return append_file(arguments['filename'], arguments['content'])
         elif function_name == 'delete_file':
             return delete_file(arguments['filename'])
         elif function_name == 'list_files':
-            return json.dumps(list_files())
+            options = {name: arguments[name] for name in LIST_OPTIONS if arguments.get(name) is not None}
+            return json.dumps(list_files(**options))
+        elif function_name == 'search_files':
+            options = {name: arguments[name] for name in SEARCH_OPTIONS if arguments.get(name) is not None}
+            return search_files(arguments['query'], **options)
         else:
             return f"Error: Unknown function '{function_name}'"
     except KeyError as e:
@@ -94,116 +1166,159 @@ def handle_tool_use(content_block: ContentBlock):
         print(f"Error in handle_tool_use: {str(e)}")
         return f"Error: {str(e)}"
 
-@cli.command()
-def init():
-    """Initialize a new project in the current directory"""
-    if os.path.exists('.aiproject.json'):
-        click.echo("Project already initialized.")
-        return
-    
-    project_config = {
-        "name": os.path.basename(os.getcwd()),
-        "created_at": datetime.now().isoformat()
-    }
-    
-    with open('.aiproject.json', 'w') as f:
-        json.dump(project_config, f, indent=2)
-        
-    os.makedirs('conversations', exist_ok=True)
-    
-    click.echo("Project initialized successfully.")
+# Concurrent Tool Execution
+# Read-only tools run in parallel. Calls that touch a path which is mutated
+# in the same turn are chained in their original order, so a write followed
+# by a read of that file behaves exactly as it would run serially.
+READ_ONLY_TOOLS = {'read_file', 'list_files', 'search_files'}
+_tool_executor = None
+_tool_executor_lock = threading.Lock()
 
-@cli.command()
-def list():
-    """List all conversations in the project"""
-    ensure_project_initialized()
-    
-    conversations = list_files()
-    if not conversations:
-        click.echo("No conversations found.")
-        return
-    
-    click.echo("Conversations:")
-    for conversation in conversations:
-        click.echo(f"- {conversation}")
+def get_tool_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    global _tool_executor
+    with _tool_executor_lock:
+        if _tool_executor is None:
+            workers = project_setting('tool_workers', DEFAULT_TOOL_WORKERS)
+            _tool_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tool')
+        return _tool_executor
 
-@cli.command()
-@click.argument('filename')
-def new(filename):
-    """Create a new conversation file"""
-    ensure_project_initialized()
-    
-    filepath = os.path.join('conversations', filename)
-    if os.path.exists(filepath):
-        click.echo(f"Conversation file '{filename}' already exists.")
-        return
-    
-    with open(filepath, 'w') as f:
-        f.write(f"# Conversation: {filename}\n")
-        f.write(f"Created: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        f.write("## User\n")
-        f.write("Enter your message here.\n")
-        
-    click.echo(f"New conversation file '{filename}' created.")
-    click.echo("You can now edit the file and use 'aiproject submit' to start the conversation.")
+def tool_target(tool_call):
+    filename = tool_call.input.get('filename') if isinstance(tool_call.input, dict) else None
+    return os.path.normpath(filename) if isinstance(filename, str) else None
 
-def process_response(response, filepath):
-    tool_calls = []
-    with open(filepath, 'a') as f:
-        f.write(f"\n\n## Assistant\nTimestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        for content in response.content:
-            if content.type == 'text':
-                f.write(content.text)
-                print(content.text)
-            elif content.type == 'tool_use':
-                tool_calls.append(content)
-    return tool_calls
+def timed_tool_use(tool_call, session, turn):
+    start = time.perf_counter()
+    waited = lock_wait_seconds()
+    result = handle_tool_use(tool_call, session)
+    if turn is not None:
+        turn['tools'].append({
+            "name": tool_call.name,
+            "ms": round((time.perf_counter() - start) * 1000, 2),
+            "result_bytes": len(result.encode()) if isinstance(result, str) else 0,
+            "lock_wait_ms": round((lock_wait_seconds() - waited) * 1000, 2),
+        })
+    return result
 
-def process_stream(stream, filepath):
-    tool_calls = []
-    with open(filepath, 'a') as f:
-        f.write(f"\n\n## Assistant\nTimestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        for text in stream.text_stream:
-            print(text, end="", flush=True)
-            f.write(text)
+def started_tool_use(tool_call, session, turn, started):
+    started[tool_call.id] = time.monotonic()
+    return timed_tool_use(tool_call, session, turn)
 
-    final_message = stream.get_final_message()
-    if final_message.content:
-        for content_block in final_message.content:
-            if content_block.type == 'tool_use':
-                tool_calls.append(content_block)
+def run_tool_chain(tool_calls, futures, session, turn, started):
+    for tool_call in tool_calls:
+        future = futures[tool_call.id]
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(started_tool_use(tool_call, session, turn, started))
+        except BaseException as e:
+            future.set_exception(e)
 
-    return tool_calls, final_message
+def wait_for_tool(future, tool_id, started, timeout):
+    # Each call gets timeout seconds from when it started running; one that
+    # has not started yet gets them from now, and more once it starts.
+    waiting_since = time.monotonic()
+    while True:
+        since = started.get(tool_id, waiting_since)
+        try:
+            return future.result(timeout=max(0, since + timeout - time.monotonic()))
+        except TimeoutError:
+            if started.get(tool_id, waiting_since) == since:
+                raise
 
-@cli.command()
-@click.argument('filename')
-@click.option('--stream', is_flag=True, help="Use streaming for the response")
-def submit(filename, stream):
-    """Submit a conversation file to Claude and append the response"""
-    ensure_project_initialized()
-    
-    filepath = os.path.join('conversations', filename)
-    if not os.path.exists(filepath):
-        click.echo(f"Conversation file '{filename}' not found.")
-        return
-    
-    with open(filepath, 'r') as f:
-        content = f.read()
-        
-    messages = [
-        MessageParam(role="user", content=content)
-    ]
+def run_tool_calls(tool_calls, on_result=None, session=None):
+    from concurrent.futures import CancelledError, Future
+    from anthropic.types import ToolResultBlockParam
+    executor = get_tool_executor()
+    timeout = project_setting('tool_timeout', DEFAULT_TOOL_TIMEOUT)
+    mutated = {tool_target(call) for call in tool_calls if call.name not in READ_ONLY_TOOLS}
+    # Tool timings go to the turn that asked for them, even if one finishes late.
+    turn = session.turn if session is not None else None
+    futures = {}
+    chains = {}
+    started = {}
+    for tool_call in tool_calls:
+        target = tool_target(tool_call)
+        # Each tool runs in the caller's context, so in the daemon anything it
+        # prints still goes to the client that asked for it.
+        if tool_call.name in READ_ONLY_TOOLS and target not in mutated:
+            futures[tool_call.id] = executor.submit(contextvars.copy_context().run,
+                                                    started_tool_use, tool_call, session, turn, started)
+        else:
+            futures[tool_call.id] = Future()
+            chains.setdefault(target, []).append(tool_call)
+    for chain in chains.values():
+        executor.submit(contextvars.copy_context().run, run_tool_chain, chain, futures, session, turn, started)
+
+    tool_results = []
+    for tool_call in tool_calls:
+        target = tool_target(tool_call)
+        try:
+            tool_result = wait_for_tool(futures[tool_call.id], tool_call.id, started, timeout)
+        except CancelledError:
+            tool_result = f"Error: Tool '{tool_call.name}' was not run (an earlier call on {target} timed out)."
+        except TimeoutError:
+            if futures[tool_call.id].cancel():
+                tool_result = (f"Error: Tool '{tool_call.name}' was not run: no tool worker "
+                               f"was free within {timeout}s.")
+            else:
+                # The worker thread cannot be interrupted; it finishes in the
+                # background, but the model gets an answer for this tool_use now.
+                tool_result = f"Error: Tool '{tool_call.name}' timed out after {timeout}s."
+                if turn is not None:
+                    turn['tools'].append({"name": tool_call.name, "ms": timeout * 1000,
+                                          "result_bytes": 0, "timed_out": True})
+            # Calls queued behind it on the same path are cancelled, so none
+            # lands after the model was told an earlier one failed. One that
+            # has already started is waited for like any other call.
+            chain = chains.get(target, [])
+            if tool_call in chain:
+                for queued in chain[chain.index(tool_call) + 1:]:
+                    futures[queued.id].cancel()
+        # Every tool_use id must get a tool_result — "" (e.g. an
+        # empty file) is a valid result, so test against None only.
+        if tool_result is not None:
+            tool_results.append(ToolResultBlockParam(
+                type="tool_result",
+                tool_use_id=tool_call.id,
+                content=tool_result
+            ))
+            if on_result:
+                on_result(tool_results[-1])
+    return tool_results
 
+def build_tools():
+    from anthropic.types import ToolParam
     tools = [
         ToolParam(
             name="read_file",
-            description="Reads the contents of a file and returns it as a string.",
+            description=(
+                "Reads the contents of a file and returns it as a string. Large files are not returned "
+                "whole: you get their size and line count instead, and can then read a range of lines "
+                "(start_line/end_line, 1-based, inclusive) or bytes (offset/length)."
+            ),
             input_schema={
                 "type": "object",
                 "properties": {
                     "filename": {
                         "type": "string",
                         "description": "The path to the file to be read."
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "First line to return (1-based)."
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "Last line to return (inclusive). Defaults to the end of the file."
+                    },
+                    "offset": {
+                        "type": "integer",
+                        "description": "Byte offset to start reading from."
+                    },
+                    "length": {
+                        "type": "integer",
+                        "description": "Number of bytes to read from offset."
                     }
                 },
                 "required": ["filename"]
@@ -211,7 +1326,10 @@ def submit(filename, stream):
         ),
         ToolParam(
             name="write_file",
-            description="Writes the provided content to a file.",
+            description=(
+                "Writes the provided content to a file, replacing it. To change part of an existing "
+                "file, use edit_file instead of rewriting the whole file."
+            ),
             input_schema={
                 "type": "object",
                 "properties": {
@@ -227,6 +1345,52 @@ def submit(filename, stream):
                 "required": ["filename", "content"]
             }
         ),
+        ToolParam(
+            name="edit_file",
+            description=(
+                "Changes part of an existing file. Give either edits, a list of exact-match "
+                "replacements applied in order (each old_text must match exactly once unless "
+                "replace_all is set; include enough surrounding lines to make it unique), or patch, "
+                "a unified diff of this one file with @@ hunks. The edits are checked against the "
+                "current contents and applied all together or not at all. Returns a short summary."
+            ),
+            input_schema={
+                "type": "object",
+                "properties": {
+                    "filename": {
+                        "type": "string",
+                        "description": "The path to the file to be edited."
+                    },
+                    "edits": {
+                        "type": "array",
+                        "description": "Exact-match replacements, applied in order.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "old_text": {
+                                    "type": "string",
+                                    "description": "Text currently in the file, copied exactly."
+                                },
+                                "new_text": {
+                                    "type": "string",
+                                    "description": "Text to put in its place."
+                                },
+                                "replace_all": {
+                                    "type": "boolean",
+                                    "description": "Replace every occurrence. Defaults to false."
+                                }
+                            },
+                            "required": ["old_text", "new_text"]
+                        }
+                    },
+                    "patch": {
+                        "type": "string",
+                        "description": "A unified diff of the file, e.g. from `diff -u`."
+                    }
+                },
+                "required": ["filename"]
+            }
+        ),
         ToolParam(
             name="append_file",
             description="Appends the provided content to the end of a file.",
@@ -261,91 +1425,1778 @@ def submit(filename, stream):
         ),
         ToolParam(
             name="list_files",
-            description="Lists all files in the conversations directory.",
+            description=(
+                "Lists project files recursively, skipping hidden and .gitignore'd files. Returns JSON with "
+                "the total count and one page of {path, size, mtime} entries in path order; pass "
+                "next_cursor back as cursor to get the following page."
+            ),
             input_schema={
                 "type": "object",
-                "properties": {}
+                "properties": {
+                    "pattern": {
+                        "type": "string",
+                        "description": "Glob to filter paths, e.g. '*.md' or 'src/**/*.py'."
+                    },
+                    "cursor": {
+                        "type": "string",
+                        "description": "next_cursor from a previous call."
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": f"Entries per page. Defaults to {DEFAULT_LIST_PAGE_SIZE}, "
+                                       f"at most {DEFAULT_MAX_LIST_LIMIT}."
+                    }
+                }
+            }
+        ),
+        ToolParam(
+            name="search_files",
+            description=(
+                "Searches the contents of all project files and returns matching lines as "
+                "'path:line: text'. Prefer this over reading files one by one to find something. "
+                "Matching is per line."
+            ),
+            input_schema={
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Text to search for, or a regular expression if regex is true."
+                    },
+                    "regex": {
+                        "type": "boolean",
+                        "description": "Treat query as a Python regular expression. Defaults to false."
+                    },
+                    "case_sensitive": {
+                        "type": "boolean",
+                        "description": "Match case exactly. Defaults to false."
+                    },
+                    "path_glob": {
+                        "type": "string",
+                        "description": "Only search files whose path matches this glob, e.g. '*.py'."
+                    },
+                    "max_results": {
+                        "type": "integer",
+                        "description": f"Maximum matches to return. Defaults to {DEFAULT_SEARCH_MAX_RESULTS}."
+                    },
+                    "cursor": {
+                        "type": "string",
+                        "description": "Cursor from a previous call, to get the next page of matches."
+                    }
+                },
+                "required": ["query"]
             }
         )
     ]
+    # A breakpoint on the last tool caches the whole tool list.
+    tools[-1]["cache_control"] = CACHE_CONTROL
+    return tools
+
+@cli.command()
+def init():
+    """Initialize a new project in the current directory"""
+    if os.path.exists('.aiproject.json'):
+        click.echo("Project already initialized.")
+        return
+    
+    project_config = {
+        "name": os.path.basename(os.getcwd()),
+        "created_at": datetime.now().isoformat()
+    }
+    
+    with open('.aiproject.json', 'w') as f:
+        json.dump(project_config, f, indent=2)
+        
+    os.makedirs('conversations', exist_ok=True)
     
+    click.echo("Project initialized successfully.")
+
+@cli.command()
+def list():
+    """List all conversations in the project"""
+    if run_in_daemon():
+        return
+    ensure_project_initialized()
+    
+    conversations = walk_tree()
+    if not conversations:
+        click.echo("No conversations found.")
+        return
+    
+    click.echo("Conversations:")
+    for conversation in conversations:
+        click.echo(f"- {conversation}")
+
+@cli.command()
+@click.argument('filename')
+def new(filename):
+    """Create a new conversation file"""
+    if run_in_daemon():
+        return
+    ensure_project_initialized()
+    
+    filepath = os.path.join('conversations', filename)
+    if os.path.exists(filepath):
+        click.echo(f"Conversation file '{filename}' already exists.")
+        return
+    
+    with open(filepath, 'w') as f:
+        f.write(f"# Conversation: {filename}\n")
+        f.write(f"Created: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+        f.write("## User\n")
+        f.write("Enter your message here.\n")
+        
+    click.echo(f"New conversation file '{filename}' created.")
+    click.echo("You can now edit the file and use 'aiproject submit' to start the conversation.")
+
+# Daemon
+# `aiproject serve` runs one long-lived process per project, listening on
+# .aiproject/daemon.sock. It keeps the API client (and its connection pool),
+# the file and line-index caches and the parsed project state in memory.
+# submit, submit-many, list and new first look for that socket: if a daemon
+# answers, the command and its parameters are sent there, and its output is
+# streamed back line by line as JSON; if not, the command runs in-process as
+# usual. Each client is served on its own thread, and every submit's tool
+# loop runs on the daemon's one event loop, so submits of different files
+# run side by side. Their options (--cache, --hedge) belong to their sessions.
+DAEMON_SOCKET = os.path.join(PROJECT_STATE_DIR, 'daemon.sock')
+DAEMON_COMMANDS = {'submit', 'submit-many', 'list', 'new'}
+_serving = False
+# The client connection output goes to. A context variable rather than a
+# thread-local, since asyncio tasks and to_thread workers copy the context
+# of the client thread that started them.
+_daemon_client = contextvars.ContextVar('daemon_client', default=None)
+
+def run_in_daemon():
+    """Runs the current command in a running daemon; False if there is none."""
+    if _serving or not os.path.exists(DAEMON_SOCKET):
+        return False
+    import socket
+    ctx = click.get_current_context()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        return False  # a stale socket left by a daemon that died
+    code = 1
+    with sock, sock.makefile('rwb') as conn:
+        conn.write(json.dumps({"command": ctx.command.name, "params": ctx.params}).encode() + b"\n")
+        conn.flush()
+        for line in conn:
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            else:
+                code = message['exit']
+                break
+    if code:
+        sys.exit(code)
+    return True
+
+class DaemonStdout:
+    """sys.stdout for the daemon: writes made on behalf of a client go to that
+    client, everything else to the daemon's own stdout."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text):
+        conn = _daemon_client.get()
+        if conn is None:
+            return self.stdout.write(text)
+        conn.write(json.dumps({"out": text}).encode() + b"\n")
+        conn.flush()
+        return len(text)
+
+    def flush(self):
+        if _daemon_client.get() is None:
+            self.stdout.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+def serve_client(rfile, wfile):
+    line = rfile.readline()
+    if not line:
+        return  # a liveness probe from another `serve`
+    request = json.loads(line)
+    name = request['command']
+    code = 0
+    client = _daemon_client.set(wfile)
+    try:
+        command = cli.get_command(None, name)
+        if name not in DAEMON_COMMANDS or command is None:
+            raise click.UsageError(f"'{name}' cannot run in the daemon")
+        with click.Context(command, info_name=name) as ctx:
+            ctx.invoke(command, **request['params'])
+    except click.exceptions.Exit as e:
+        code = e.exit_code
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except (BrokenPipeError, ConnectionResetError):
+        return  # the client went away
+    except Exception as e:
+        click.echo(f"Error in daemon: {e}")
+        code = 1
+    finally:
+        _daemon_client.reset(client)
     try:
-        if stream:
-            while True:
-                with client.messages.stream(
-                        model="claude-haiku-4-5-20251001",
-                        max_tokens=1000,
-                        system=BaseSPrompt,
-                        messages=messages,
-                        tools=tools
-                ) as stream:
-                    tool_calls, final_message = process_stream(stream, filepath)
-
-                if not tool_calls:
-                    break  # No more tool calls, we're done
-
-                # The assistant's tool_use turn must be part of the conversation
-                # before we can send back its tool_result.
-                messages.append(MessageParam(role="assistant", content=final_message.content))
-
-                tool_results = []
-                for tool_call in tool_calls:
-                    tool_result = handle_tool_use(tool_call)
-                    # Every tool_use id must get a tool_result — "" (e.g. an
-                    # empty file) is a valid result, so test against None only.
-                    if tool_result is not None:
-                        tool_results.append(ToolResultBlockParam(
-                            type="tool_result",
-                            tool_use_id=tool_call.id,
-                            content=tool_result
-                        ))
-
-                messages.append(MessageParam(role="user", content=tool_results))
+        wfile.write(json.dumps({"exit": code}).encode() + b"\n")
+        wfile.flush()
+    except OSError:
+        pass
+
+@cli.command()
+def serve():
+    """Keep the client, caches and project state warm for other commands"""
+    import asyncio
+    import signal
+    import socketserver
+    global _serving, _daemon_loop
+    ensure_project_initialized()
+    if os.path.exists(DAEMON_SOCKET):
+        import socket
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(DAEMON_SOCKET)
+                click.echo("A daemon is already serving this project.")
+                return
+            except OSError:
+                os.remove(DAEMON_SOCKET)
+
+    _serving = True
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_client(self.rfile, self.wfile)
+
+    os.makedirs(PROJECT_STATE_DIR, exist_ok=True)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(DAEMON_SOCKET, Handler)
+    except OSError:
+        click.echo("A daemon is already serving this project.")
+        return
+    server.daemon_threads = True
+    # Clients that connect while we warm up wait in the listen backlog.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='daemon-loop', daemon=True).start()
+    _daemon_loop = loop
+
+    async def open_client():
+        get_client()
+
+    run_async(open_client())
+    update_project_index()
+    sys.stdout = DaemonStdout(sys.stdout)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    click.echo(f"Serving {os.getcwd()} on {DAEMON_SOCKET} (pid {os.getpid()}); Ctrl-C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(DAEMON_SOCKET)
+        asyncio.run_coroutine_threadsafe(close_clients(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+# Conversation Parsing
+# Conversation files are markdown with "## User" / "## Assistant" sections.
+# Header lines inside fenced code blocks (``` or ~~~) are content, except the
+# "## Assistant" + "Timestamp:" header we write ourselves, which always starts
+# a section (so a response cut off inside a fence cannot swallow the rest).
+# A sidecar index under .aiproject/conversations/ keeps each section's offsets
+# and a hash of its bytes. Every section's text is sent, so a resubmit still
+# reads the whole file, but only the last section and anything after it are
+# scanned for headers: the sections before it are reused as long as their
+# bytes still match their hashes, so an edit anywhere in the file is seen.
+CONVERSATION_INDEX_DIR = os.path.join(PROJECT_STATE_DIR, 'conversations')
+CONVERSATION_INDEX_VERSION = 3
+SECTION_LINE = re.compile(rb'^(?:## (User|Assistant)[ \t]*\r?$| {0,3}(`{3,}|~{3,})([^\r\n]*?)[ \t]*\r?$)',
+                          re.MULTILINE)
+WRITTEN_HEADER = re.compile(rb'\r?\nTimestamp: ')
+TIMESTAMP_LINE = re.compile(r'\ATimestamp: [^\n]*\n')
+
+def conversation_index_path(filename):
+    return os.path.join(CONVERSATION_INDEX_DIR, filename + '.json')
+
+def find_headers(data, start):
+    fence = None
+    for match in SECTION_LINE.finditer(data, start):
+        if match.group(1):
+            written = match.group(1) == b'Assistant' and WRITTEN_HEADER.match(data, match.end())
+            if fence is None or written:
+                fence = None
+                yield match
+        elif fence is None:
+            if not (match.group(2)[:1] == b'`' and b'`' in match.group(3)):
+                fence = match.group(2)
+        elif (match.group(2)[:1] == fence[:1] and len(match.group(2)) >= len(fence)
+              and not match.group(3)):
+            fence = None
+
+def section_text(role, raw):
+    text = raw.decode('utf-8', errors='replace')
+    if role == 'assistant':
+        text = TIMESTAMP_LINE.sub('', text.lstrip('\r\n'), count=1)
+    return text.strip()
+
+def section_hash(raw):
+    return hashlib.sha1(raw).hexdigest()
+
+def scan_sections(data, base):
+    # data holds the file from byte offset base on; offsets are absolute.
+    sections = []
+    headers = find_headers(data, 0)
+    match = next(headers, None)
+    if base == 0 and (match is None or match.start() > 0):
+        # Text before the first header (the "# Conversation" preamble) counts
+        # as user text so nothing in the file is silently dropped.
+        sections.append({"role": "user", "start": 0, "body": 0,
+                         "end": match.start() if match else len(data)})
+    while match:
+        following = next(headers, None)
+        sections.append({
+            "role": match.group(1).decode().lower(),
+            "start": base + match.start(),
+            "body": base + match.end(),
+            "end": base + (following.start() if following else len(data)),
+        })
+        match = following
+    for section in sections:
+        section["hash"] = section_hash(data[section["start"] - base:section["end"] - base])
+    return sections
+
+def load_conversation_index(filename):
+    try:
+        index = read_json_cached(conversation_index_path(filename))
+    except (OSError, json.JSONDecodeError):
+        return None
+    return index if index.get('version') == CONVERSATION_INDEX_VERSION else None
+
+def index_conversation(filepath, filename):
+    """Returns the file's bytes and its sections."""
+    index = load_conversation_index(filename)
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    sections = []
+    scan_from = 0
+    if index and index['sections'] and len(data) >= index['size']:
+        # The last indexed section may have grown, so it is always rescanned.
+        # The sections before it cover the file up to its start, so if they
+        # all still match, so does the header scan that found them.
+        reused = index['sections'][:-1]
+        view = memoryview(data)
+        if all(section_hash(view[section['start']:section['end']]) == section['hash'] for section in reused):
+            sections = reused
+            scan_from = index['sections'][-1]['start']
+    sections = sections + scan_sections(data[scan_from:], scan_from)
+    if not index or index['size'] != len(data) or index['sections'] != sections:
+        write_json_atomic(conversation_index_path(filename), {
+            "version": CONVERSATION_INDEX_VERSION,
+            "size": len(data),
+            "sections": sections,
+        })
+    return data, sections
+
+def parse_conversation(filepath, filename, limit=None):
+    from anthropic.types import MessageParam
+    data, sections = index_conversation(filepath, filename)
+    messages = []
+    for section in sections:
+        if limit is not None and section['start'] >= limit:
+            break
+        end = section['end'] if limit is None else min(section['end'], limit)
+        text = section_text(section['role'], data[section['body']:end])
+        if not text:
+            continue
+        # Tool rounds are written as consecutive "## Assistant" sections; the
+        # API wants strictly alternating roles, so they are merged back.
+        if messages and messages[-1]['role'] == section['role']:
+            messages[-1]['content'] += "\n\n" + text
         else:
-            while True:
-                response = client.messages.create(
-                    model="claude-haiku-4-5-20251001",
-                    max_tokens=1000,
-                    system=BaseSPrompt,
-                    messages=messages,
-                    tools=tools
-                )
-
-                tool_calls = process_response(response, filepath)
-
-                if not tool_calls:
-                    break  # No more tool calls, we're done
-
-                # The assistant's tool_use turn must be part of the conversation
-                # before we can send back its tool_result.
-                messages.append(MessageParam(role="assistant", content=response.content))
-
-                tool_results = []
-                for tool_call in tool_calls:
-                    tool_result = handle_tool_use(tool_call)
-                    # Every tool_use id must get a tool_result — "" (e.g. an
-                    # empty file) is a valid result, so test against None only.
-                    if tool_result is not None:
-                        tool_results.append(ToolResultBlockParam(
-                            type="tool_result",
-                            tool_use_id=tool_call.id,
-                            content=tool_result
-                        ))
-
-                messages.append(MessageParam(role="user", content=tool_results))
-
-    except BadRequestError as e:
-        click.echo(f"Bad request: {e}")
-    except RateLimitError as e:
-        click.echo(f"Rate limit exceeded: {e}")
-    except APIError as e:
-        click.echo(f"API error: {e}")
+            messages.append(MessageParam(role=section['role'], content=text))
+    return messages
+
+ASSISTANT_HEADER = "\n\n## Assistant\nTimestamp: {}\n\n"
+
+def assistant_header():
+    return ASSISTANT_HEADER.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+def write_header(filepath, header):
+    # header is None for a new assistant turn, "" when continuing one.
+    header = assistant_header() if header is None else header
+    return append_locked(filepath, header) if header else 0.0
+
+def process_response(response, filepath, echo=True, timing=None, header=None):
+    tool_calls = []
+    texts = [assistant_header() if header is None else header]
+    for content in response.content:
+        if content.type == 'text':
+            texts.append(content.text)
+            if echo:
+                print(content.text)
+        elif content.type == 'tool_use':
+            tool_calls.append(content)
+    text = "".join(texts)
+    waited = append_locked(filepath, text) if text else 0.0
+    if timing is not None:
+        timing['lock_wait'] += waited
+    return tool_calls
+
+class StreamWriter:
+    """Buffers streamed text, flushing the conversation file and stdout together
+    once stream_flush_interval seconds or stream_flush_bytes have accumulated.
+    Each flush is one locked append, so the file is never held open or locked
+    while waiting on the network."""
+
+    def __init__(self, filepath, echo=True):
+        self.filepath = filepath
+        self.echo = echo
+        self.interval = project_setting('stream_flush_interval', DEFAULT_STREAM_FLUSH_INTERVAL)
+        self.max_bytes = project_setting('stream_flush_bytes', DEFAULT_STREAM_FLUSH_BYTES)
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        self.first_write = None
+        self.lock_wait = 0.0
+
+    def write(self, text):
+        if self.first_write is None:
+            self.first_write = time.perf_counter()
+        self.pending.append(text)
+        self.pending_bytes += len(text)
+        if (self.pending_bytes >= self.max_bytes
+                or time.monotonic() - self.last_flush >= self.interval):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            text = "".join(self.pending)
+            self.lock_wait += append_locked(self.filepath, text)
+            if self.echo:
+                print(text, end="", flush=True)
+            self.pending = []
+            self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+
+async def process_stream(stream, filepath, echo=True, timing=None, header=None):
+    writer = StreamWriter(filepath, echo)
+    writer.lock_wait = write_header(filepath, header)
+    try:
+        async for text in stream.text_stream:
+            writer.write(text)
+    finally:
+        writer.flush()
+    if timing is not None:
+        timing['first_text'] = writer.first_write
+        timing['lock_wait'] += writer.lock_wait
+    final_message = await stream.get_final_message()
+    tool_calls = [block for block in final_message.content if block.type == 'tool_use']
+    return tool_calls, final_message
+
+# Session Journal
+# Every submit keeps an append-only journal in .aiproject/journal/ of where it
+# started in the conversation file, where each assistant turn began, each
+# complete assistant message and each tool result. If the process dies, the
+# next submit of that file replays the journal instead of starting over: the
+# half-written turn is cut from the file, finished tool results are reused and
+# only the interrupted request is sent again. The journal is removed once the
+# session completes.
+JOURNAL_DIR = os.path.join(PROJECT_STATE_DIR, 'journal')
+
+class Journal:
+    def __init__(self, filename):
+        self.path = os.path.join(JOURNAL_DIR, filename + '.jsonl')
+        self.f = None
+
+    def load(self):
+        events = []
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # torn final line from the crash
+        except OSError:
+            pass
+        return events
+
+    def start(self, offset):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.f = open(self.path, 'w')
+        self.record('start', offset=offset)
+
+    def reopen(self):
+        self.f = open(self.path, 'a')
+
+    def record(self, event, **fields):
+        self.f.write(json.dumps({"event": event, **fields}) + "\n")
+        self.f.flush()
+        if event == 'message':
+            # Turn boundaries are what a resume relies on; make them durable.
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def finish(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+# Rate Limiting
+# One limiter per process, shared by every session (including submit-many's
+# concurrent ones), so they pace each other instead of all hitting 429 at once.
+# Each bucket mirrors the server's view from the anthropic-ratelimit-* headers
+# and refills continuously between responses.
+DEFAULT_MAX_RETRIES = 8
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+class TokenBucket:
+    def __init__(self):
+        self.limit = None
+        self.level = 0.0
+        self.rate = 0.0
+        self.updated = 0.0
+
+    def observe(self, limit, remaining, reset_in, now):
+        self.limit = limit
+        self.level = float(remaining)
+        self.updated = now
+        # Limits are per minute; the reset header tells us how quickly the
+        # server actually expects the bucket to fill back up.
+        reset_in = min(reset_in, 60.0)
+        if remaining < limit and reset_in > 0:
+            self.rate = (limit - remaining) / reset_in
+        else:
+            self.rate = limit / 60
+
+    def wait_time(self, cost, now):
+        if self.limit is None:
+            return 0.0
+        self.level = min(self.limit, self.level + self.rate * (now - self.updated))
+        self.updated = now
+        cost = min(cost, self.limit)
+        if self.level >= cost:
+            return 0.0
+        return (cost - self.level) / self.rate if self.rate else BACKOFF_CAP
+
+    def take(self, cost):
+        if self.limit is not None:
+            self.level -= cost
+
+class RateLimiter:
+    BUCKETS = ('requests', 'input-tokens', 'output-tokens')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {name: TokenBucket() for name in self.BUCKETS}
+        self.blocked_until = 0.0
+
+    def reserve(self, input_tokens, output_tokens):
+        """Reserve capacity for one request and return how long to wait before sending it."""
+        costs = {'requests': 1, 'input-tokens': input_tokens, 'output-tokens': output_tokens}
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.blocked_until - now)
+            for name, bucket in self.buckets.items():
+                delay = max(delay, bucket.wait_time(costs[name], now))
+                bucket.take(costs[name])
+            return delay
+
+    def observe(self, headers):
+        now = time.monotonic()
+        with self.lock:
+            for name, bucket in self.buckets.items():
+                limit = headers.get(f'anthropic-ratelimit-{name}-limit')
+                remaining = headers.get(f'anthropic-ratelimit-{name}-remaining')
+                if limit is None or remaining is None:
+                    continue
+                bucket.observe(int(limit), int(remaining),
+                               seconds_until(headers.get(f'anthropic-ratelimit-{name}-reset')), now)
+
+    def backoff(self, error, attempt):
+        """Seconds to wait before retrying after error, or None if it should not be retried."""
+        from anthropic import APIConnectionError, APIStatusError, RateLimitError
+        if attempt >= project_setting('max_retries', DEFAULT_MAX_RETRIES):
+            return None
+        if isinstance(error, APIStatusError):
+            if error.status_code not in RETRYABLE_STATUS:
+                return None
+            self.observe(error.response.headers)
+            retry_after = error.response.headers.get('retry-after')
+        elif isinstance(error, APIConnectionError):
+            retry_after = None
+        elif isinstance(getattr(error, 'http_status', None), int):
+            # An openai.error.OpenAIError from a hedged OpenAI provider.
+            if error.http_status not in RETRYABLE_STATUS:
+                return None
+            retry_after = (error.headers or {}).get('retry-after')
+        else:
+            return None
+        delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        if isinstance(error, RateLimitError):
+            # Hold every session back, not just the one that got the 429.
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+def seconds_until(timestamp):
+    if not timestamp:
+        return 0.0
+    try:
+        reset = datetime.fromisoformat(timestamp)
+    except ValueError:
+        return 0.0
+    return max(0.0, (reset - datetime.now(reset.tzinfo)).total_seconds())
+
+rate_limiter = RateLimiter()
+
+def estimate_request_tokens(params):
+    prompt = json.dumps([params['system'], params['tools'], params['messages']], default=str)
+    return estimate_tokens(prompt), params['max_tokens']
+
+# Context Window
+# Tracks the prompt size of a session: a local estimate per message, scaled by
+# the ratio between the API's reported prompt tokens and our estimate for the
+# same request. When the total crosses context_token_budget, stale tool output
+# outside the newest rounds is elided oldest-first until we are back under
+# COMPACT_TARGET of the budget. Blocks are rewritten in place, never removed,
+# so every tool_use keeps its tool_result. Compacting well below the budget
+# means the cached prefix is invalidated rarely rather than every round.
+DEFAULT_CONTEXT_TOKEN_BUDGET = 150000
+DEFAULT_CONTEXT_KEEP_ROUNDS = 2
+COMPACT_TARGET = 0.75
+ELIDE_MIN_TOKENS = 100
+ELIDED_PREFIX = "[Elided earlier"
+ELIDABLE_INPUTS = {'content': "file content", 'patch': "patch", 'edits': "edits"}
+
+def content_tokens(content):
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    return estimate_tokens(json.dumps(as_content_blocks(content), default=str))
+
+def elision_note(kind, content):
+    text = content if isinstance(content, str) else json.dumps(content, default=str)
+    first_line = text.strip().split("\n", 1)[0][:120]
+    return (f"{ELIDED_PREFIX} {kind} (~{estimate_tokens(text)} tokens) to save context; "
+            f"it began: {first_line!r}. Call the tool again if you need it.]")
+
+class ContextWindow:
+    def __init__(self, messages):
+        self.budget = project_setting('context_token_budget', DEFAULT_CONTEXT_TOKEN_BUDGET)
+        self.keep_rounds = project_setting('context_keep_rounds', DEFAULT_CONTEXT_KEEP_ROUNDS)
+        self.sizes = [content_tokens(message['content']) for message in messages]
+        self.overhead = 0
+        self.ratio = 1.0
+        self.estimated = 0
+        self.prompt_tokens = None
+        self.compactions = 0
+        self.saved = 0
+        self.reported = (0, 0)
+
+    def append(self, message):
+        self.sizes.append(content_tokens(message['content']))
+
+    def total(self):
+        return int((self.overhead + sum(self.sizes)) * self.ratio)
+
+    def before_request(self, session):
+        if self.total() > self.budget:
+            self.compact(session)
+        self.estimated = self.overhead + sum(self.sizes)
+
+    def observe(self, usage):
+        self.prompt_tokens = (usage.input_tokens + (usage.cache_read_input_tokens or 0)
+                              + (usage.cache_creation_input_tokens or 0))
+        if self.estimated:
+            self.ratio = self.prompt_tokens / self.estimated
+
+    def compact(self, session):
+        messages = session.messages
+        before = self.total()
+        target = self.budget * COMPACT_TARGET
+        elided = 0
+        elided_ids = set()
+        for i in range(len(messages) - 2 * self.keep_rounds):
+            if self.total() <= target:
+                break
+            if isinstance(messages[i]['content'], str):
+                continue  # conversation text, not tool output
+            blocks = as_content_blocks(messages[i]['content'])
+            changed = False
+            for j, block in enumerate(blocks):
+                if block['type'] == 'tool_result':
+                    content = block.get('content', "")
+                    if is_elided(content) or content_tokens(content) < ELIDE_MIN_TOKENS:
+                        continue
+                    blocks[j] = {**block, "content": elision_note("tool output", content)}
+                    elided_ids.add(block['tool_use_id'])
+                    # A later re-read must not point at output that is gone.
+                    for path, (key, tool_use_id) in session.delivered.copy().items():
+                        if tool_use_id == block['tool_use_id']:
+                            del session.delivered[path]
+                elif block['type'] == 'tool_use' and set(block.get('input', {})) & set(ELIDABLE_INPUTS):
+                    # Old write_file/append_file/edit_file payloads are usually the largest inputs.
+                    inputs = dict(block['input'])
+                    for name, kind in ELIDABLE_INPUTS.items():
+                        content = inputs.get(name)
+                        if content is None or is_elided(content) or content_tokens(content) < ELIDE_MIN_TOKENS:
+                            continue
+                        inputs[name] = elision_note(kind, content)
+                    if inputs == block['input']:
+                        continue
+                    blocks[j] = {**block, "input": inputs}
+                else:
+                    continue
+                changed = True
+                elided += 1
+            if changed:
+                messages[i] = {**messages[i], "content": blocks}
+                self.sizes[i] = content_tokens(blocks)
+        if elided_ids:
+            self.drop_references(messages, elided_ids)
+        after = self.total()
+        self.compactions += 1
+        self.saved += before - after
+        click.echo(f"[context] elided {elided} stale tool block(s): ~{before} -> ~{after} tokens "
+                   f"(budget {self.budget}, ~{self.saved} saved this session)")
+        if after > self.budget:
+            click.echo("[context] still over budget; only the newest rounds and conversation text remain.")
+
+    def drop_references(self, messages, elided_ids):
+        # Re-reads that pointed at now-elided output would point at nothing.
+        for i, message in enumerate(messages):
+            if message['role'] != 'user' or isinstance(message['content'], str):
+                continue
+            blocks = as_content_blocks(message['content'])
+            changed = False
+            for j, block in enumerate(blocks):
+                content = block.get('content') if block['type'] == 'tool_result' else None
+                match = UNCHANGED_REFERENCE.match(content) if isinstance(content, str) else None
+                if match and match.group(1) in elided_ids:
+                    blocks[j] = {**block, "content": f"{ELIDED_PREFIX} unchanged file content to save "
+                                 "context. Call read_file again if you need it.]"}
+                    changed = True
+            if changed:
+                messages[i] = {**message, "content": blocks}
+                self.sizes[i] = content_tokens(blocks)
+
+    def stats(self):
+        """The window's size, and what compaction saved since the last call."""
+        stats = {
+            "prompt_tokens": self.prompt_tokens,
+            "estimated_tokens": self.total(),
+            "budget": self.budget,
+            "compactions": self.compactions - self.reported[0],
+            "tokens_saved": self.saved - self.reported[1],
+        }
+        self.reported = (self.compactions, self.saved)
+        return stats
+
+def is_elided(content):
+    return isinstance(content, str) and content.startswith(ELIDED_PREFIX)
+
+# Telemetry
+# Every API round of a submit appends one JSON line to .aiproject/telemetry.jsonl
+# once its tools have run: latency, time to first streamed text, token usage,
+# stop reason, the context window's size and what compaction saved, and each
+# tool's execution time and result size. `aiproject stats` aggregates the
+# file. Lines are small single writes in append mode, so concurrent sessions
+# and processes can share it. The output budget and provider latencies are
+# seeded from the newest RECENT_TELEMETRY_RECORDS lines only, read backwards
+# from the end, so the cost of a submit does not grow with the file.
+TELEMETRY_FILE = os.path.join(PROJECT_STATE_DIR, 'telemetry.jsonl')
+RECENT_TELEMETRY_RECORDS = 2000
+_telemetry_lock = threading.Lock()
+
+def log_telemetry(record):
+    if not project_setting('telemetry', True):
+        return
+    line = json.dumps(record) + "\n"
+    with _telemetry_lock:
+        os.makedirs(PROJECT_STATE_DIR, exist_ok=True)
+        with open(TELEMETRY_FILE, 'a') as f:
+            f.write(line)
+
+def load_telemetry(filename=None):
+    records = []
+    try:
+        with open(TELEMETRY_FILE) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                if filename is None or record.get('file') == filename:
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+def load_recent_telemetry(count, block_size=65536):
+    """The newest count records, oldest first, reading only the end of the file."""
+    chunks = []
+    newlines = 0
+    try:
+        with open(TELEMETRY_FILE, 'rb') as f:
+            position = f.seek(0, os.SEEK_END)
+            while position > 0 and newlines <= count:
+                step = min(block_size, position)
+                position -= step
+                f.seek(position)
+                chunks.append(f.read(step))
+                newlines += chunks[-1].count(b'\n')
+    except FileNotFoundError:
+        return []
+    lines = b"".join(reversed(chunks)).split(b'\n')
+    if position > 0:
+        lines = lines[1:]  # the first line read starts mid-record
+    records = []
+    for line in lines[-count - 1:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue  # the empty string after the last newline, or a torn line
+    return records[-count:]
+
+def percentile(ordered, q):
+    # Nearest-rank percentile of an already sorted list.
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+def format_percentiles(values):
+    ordered = sorted(values)
+    return "  ".join(f"{name} {percentile(ordered, q):8.1f}"
+                     for name, q in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99))) \
+        + f"  max {ordered[-1]:8.1f}"
+
+# Response Cache
+# Opt-in (--cache, --replay or the response_cache setting). Each Messages
+# request is keyed by a hash of its model, max_tokens, system prompt, tools
+# and messages (cache_control markers aside), so a cut-off turn retried with
+# a larger budget is not served its own truncated reply. The response is
+# stored in
+# .aiproject/responses/ with the raw events when it was streamed. A hit is
+# written to the conversation exactly as a live response would be, without
+# touching the network or the rate limiter. Entries are evicted least
+# recently used first (a hit refreshes the file's mtime) once the directory
+# exceeds response_cache_bytes, down to three quarters of it. The directory
+# is scanned once per process and then when evicting; puts in between only
+# add to a running total. --replay serves only from the cache, so a tool
+# loop can be re-run offline; a miss is an error.
+RESPONSE_CACHE_DIR = os.path.join(PROJECT_STATE_DIR, 'responses')
+DEFAULT_RESPONSE_CACHE_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_EVICT_TARGET = 0.75
+RAW_STREAM_EVENTS = {'message_start', 'message_delta', 'message_stop',
+                     'content_block_start', 'content_block_delta', 'content_block_stop'}
+
+class ReplayMiss(Exception):
+    pass
+
+def without_cache_control(blocks):
+    return [{name: value for name, value in block.items() if name != 'cache_control'} for block in blocks]
+
+# Bytes under RESPONSE_CACHE_DIR, shared by every ResponseCache in the
+# process; None until the first put scans the directory.
+_response_cache_total = None
+_response_cache_lock = threading.Lock()
+
+def scan_response_cache():
+    entries = []
+    if not os.path.isdir(RESPONSE_CACHE_DIR):
+        return entries
+    for directory in os.scandir(RESPONSE_CACHE_DIR):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+class ResponseCache:
+    def __init__(self, replay=False):
+        self.replay = replay
+        self.max_bytes = project_setting('response_cache_bytes', DEFAULT_RESPONSE_CACHE_BYTES)
+
+    @staticmethod
+    def key(params):
+        request = {
+            "model": params['model'],
+            "max_tokens": params['max_tokens'],
+            "system": without_cache_control(params['system']),
+            "tools": without_cache_control(params['tools']),
+            "messages": [{"role": message['role'],
+                          "content": without_cache_control(as_content_blocks(message['content']))}
+                         for message in params['messages']],
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(RESPONSE_CACHE_DIR, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, message, events=None):
+        global _response_cache_total
+        path = self.path(key)
+        write_json_atomic(path, {"message": message.to_dict(), "events": events})
+        with _response_cache_lock:
+            if _response_cache_total is None:
+                _response_cache_total = sum(size for _, size, _ in scan_response_cache())
+            else:
+                # Overwriting an entry counts it twice; the next eviction's
+                # scan corrects the total.
+                _response_cache_total += os.path.getsize(path)
+            if _response_cache_total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Called with _response_cache_lock held. Rescans, since other
+        # processes may have added or evicted entries too.
+        global _response_cache_total
+        entries = sorted(scan_response_cache())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * RESPONSE_CACHE_EVICT_TARGET
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        _response_cache_total = total
+
+def open_response_cache(cache, replay):
+    """The response cache for a submit's sessions, or None when it is off."""
+    enabled = replay or cache or project_setting('response_cache', False)
+    return ResponseCache(replay) if enabled else None
+
+def replay_texts(entry):
+    if entry['events']:
+        for event in entry['events']:
+            if event['type'] == 'content_block_delta' and event['delta']['type'] == 'text_delta':
+                yield event['delta']['text']
+    else:
+        for block in entry['message']['content']:
+            if block['type'] == 'text':
+                yield block['text']
+
+def process_replay(entry, filepath, echo=True, timing=None, header=None):
+    from anthropic.types import Message
+    message = Message.model_validate(entry['message'])
+    writer = StreamWriter(filepath, echo)
+    writer.lock_wait = write_header(filepath, header)
+    try:
+        for text in replay_texts(entry):
+            writer.write(text)
+    finally:
+        writer.flush()
+    if timing is not None:
+        timing['first_text'] = writer.first_write
+        timing['lock_wait'] += writer.lock_wait
+    tool_calls = [block for block in message.content if block.type == 'tool_use']
+    return tool_calls, message
+
+class RecordingStream:
+    """Hands a MessageStream's text to process_stream while keeping its raw events for the cache."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.events = []
+
+    def keep(self, event):
+        if event.type in RAW_STREAM_EVENTS:
+            self.events.append(event.to_dict(exclude_none=True))
+        return event.type == 'text'
+
+    @property
+    def text_stream(self):
+        return (event.text async for event in self.stream if self.keep(event))
+
+    async def get_final_message(self):
+        return await self.stream.get_final_message()
+
+# Hedged Providers
+# With a `providers` list in .aiproject.json (see providers.py), each request
+# of the tool loop goes to those providers instead of the direct client.
+# hedge_mode "first" races them all; "hedge" starts the next one once the
+# previous one has run for its p95 latency (or hedge_delay seconds), with p95
+# seeded from the telemetry log; "all" waits for every provider, continues
+# the conversation with the first one in list order that succeeded and
+# records every reply in .aiproject/compare/<file>.jsonl. Hedged requests are
+# not streamed; they are paced by the rate limiter and retried like direct
+# ones when every provider failed.
+COMPARE_DIR = os.path.join(PROJECT_STATE_DIR, 'compare')
+_providers = None
+
+def hedging_mode(mode):
+    """The hedge mode for a submit's sessions, or None to send to the direct client."""
+    if project_setting('providers', []):
+        return mode or project_setting('hedge_mode', 'first')
+    if mode:
+        click.echo("--hedge needs a 'providers' list in .aiproject.json; sending normally.")
+    return None
+
+def get_providers():
+    global _providers
+    if _providers is None:
+        from providers import make_provider
+        _providers = [make_provider(config) for config in project_setting('providers', [])]
+        recent = load_recent_telemetry(RECENT_TELEMETRY_RECORDS)
+        for provider in _providers:
+            for record in recent:
+                if record.get('provider', record.get('model')) == provider.name and not record.get('cached'):
+                    provider.latency.observe(record['latency_ms'] / 1000)
+    return _providers
+
+async def hedged_reply(session, params):
+    import asyncio
+    from providers import ProviderError, hedged_request
+    request = {
+        "system": params['system'],
+        "tools": params['tools'],
+        "max_tokens": params['max_tokens'],
+        "messages": [{"role": message['role'],
+                      "content": message['content'] if isinstance(message['content'], str)
+                      else as_content_blocks(message['content'])}
+                     for message in params['messages']],
+    }
+    input_tokens, output_tokens = estimate_request_tokens(params)
+    attempt = 0
+    while True:
+        await asyncio.sleep(rate_limiter.reserve(input_tokens, output_tokens))
+        session.start_request(False, attempt)
+        try:
+            result = await hedged_request(get_providers(), request, session.hedge_mode,
+                                          project_setting('hedge_delay', None))
+            break
+        except ProviderError as e:
+            delay = hedged_backoff(e, attempt)
+            if delay is None:
+                raise
+            click.echo(f"{session.prefix}{describe_error(e)} (retrying in {delay:.1f}s)")
+            await asyncio.sleep(delay)
+            attempt += 1
+    for reply in (result if session.hedge_mode == 'all' else [result]):
+        if not isinstance(reply, BaseException) and reply.get('headers'):
+            rate_limiter.observe(reply['headers'])
+    if session.hedge_mode != 'all':
+        return result
+    record_comparison(session, result)
+    return next(reply for reply in result if not isinstance(reply, BaseException))
+
+def hedged_backoff(error, attempt):
+    # Every provider failed: retry if any of them might succeed next time,
+    # as soon as the first of them allows.
+    delays = [rate_limiter.backoff(e, attempt) for _, e in error.errors]
+    delays = [delay for delay in delays if delay is not None]
+    return min(delays) if delays else None
+
+def record_comparison(session, results):
+    entries = []
+    for provider, result in zip(get_providers(), results):
+        if isinstance(result, BaseException):
+            entries.append({"provider": provider.name, "error": str(result)})
+            click.echo(f"[compare] {provider.name}: failed: {result}")
+            continue
+        entries.append({"provider": provider.name, "latency_ms": round(result['latency'] * 1000, 2),
+                        "stop_reason": result['stop_reason'], "usage": result['usage'],
+                        "content": result['content']})
+        click.echo(f"[compare] {provider.name}: {result['latency'] * 1000:.0f} ms, "
+                   f"{result['usage'].get('output_tokens', 0)} output tokens, {result['stop_reason']}")
+    os.makedirs(COMPARE_DIR, exist_ok=True)
+    with open(os.path.join(COMPARE_DIR, session.filename + '.jsonl'), 'a') as f:
+        f.write(json.dumps({"ts": datetime.now().isoformat(timespec='seconds'),
+                            "round": session.rounds, "replies": entries}) + "\n")
+
+def finish_hedged(session, reply, echo=True):
+    from anthropic.types import Message
+    message = Message.model_validate({name: value for name, value in reply.items()
+                                      if name not in ('provider', 'latency', 'headers')})
+    header = session.begin_turn()
+    tool_calls = process_response(message, session.filepath, echo=echo, timing=session.timing, header=header)
+    session.end_turn(message)
+    session.turn['provider'] = reply['provider']
+    return tool_calls, message
+
+# Output Budget
+# max_tokens for each request is sized from what similar turns produced
+# before: the p95 of whole-turn output tokens (continuations included) plus
+# OUTPUT_HEADROOM, tracked separately for first replies to the user and for
+# tool-loop rounds. Samples are seeded from the telemetry log and updated as
+# turns finish. A turn that still stops at max_tokens is continued: what it
+# said so far goes back as the start of the assistant message and the model
+# carries on from there. Everything before that message is unchanged, so the
+# continuation reads the cached prefix. A prefill cannot hold tool calls, so
+# a turn is continued from its text up to the first one, and the file is cut
+# back to that text (without trailing whitespace, which a prefill may not
+# end in) before the continuation is appended. A turn cut off inside a tool
+# call cannot be picked up mid-call, so the call is asked for again with
+# twice the budget. Only Anthropic takes a prefill: when hedging across other
+# providers too, the file is cut back to the turn's header and the whole turn
+# is asked for again with twice the budget. Without --stream, max_tokens
+# never exceeds NON_STREAMING_MAX_TOKENS: the SDK refuses a non-streaming
+# request that could run past ten minutes (at its 128,000 tokens an hour).
+# A turn still cut off once max_continuations runs out ends there, and its
+# tool calls, possibly incomplete, are not run.
+DEFAULT_MAX_TOKENS = 4096
+MIN_MAX_TOKENS = 1024
+DEFAULT_MAX_OUTPUT_TOKENS = 32000
+NON_STREAMING_MAX_TOKENS = 21333
+DEFAULT_MAX_CONTINUATIONS = 4
+OUTPUT_HEADROOM = 1.5
+OUTPUT_SAMPLES = 500
+MIN_OUTPUT_SAMPLES = 5
+
+def turn_kind(rounds):
+    return 'reply' if rounds == 0 else 'tool_round'
+
+class OutputBudget:
+    def __init__(self):
+        self.samples = {kind: deque(maxlen=OUTPUT_SAMPLES) for kind in ('reply', 'tool_round')}
+        self.lock = threading.Lock()
+
+    def observe(self, kind, output_tokens):
+        with self.lock:
+            self.samples[kind].append(output_tokens)
+
+    def max_tokens(self, kind, limit):
+        with self.lock:
+            ordered = sorted(self.samples[kind])
+        if len(ordered) < MIN_OUTPUT_SAMPLES:
+            return min(DEFAULT_MAX_TOKENS, limit)
+        wanted = -(-int(percentile(ordered, 0.95) * OUTPUT_HEADROOM) // 256) * 256
+        return min(limit, max(MIN_MAX_TOKENS, wanted))
+
+_output_budget = None
+_output_budget_lock = threading.Lock()
+
+def output_limit(stream):
+    limit = project_setting('max_output_tokens', DEFAULT_MAX_OUTPUT_TOKENS)
+    return limit if stream else min(limit, NON_STREAMING_MAX_TOKENS)
+
+def get_output_budget():
+    global _output_budget
+    with _output_budget_lock:
+        if _output_budget is None:
+            _output_budget = OutputBudget()
+            for record in load_recent_telemetry(RECENT_TELEMETRY_RECORDS):
+                if record.get('stop_reason') != 'max_tokens':
+                    _output_budget.observe(turn_kind(record.get('round', 0)),
+                                           record.get('turn_output_tokens', record['output_tokens']))
+        return _output_budget
+
+def continuation_prefix(content):
+    """Blocks to continue a cut-off turn from, and whether it was cut inside a tool call."""
+    # A prefill cannot hold tool calls, so the turn is continued from its
+    # text up to the first one; anything after that is asked for again.
+    prefix = []
+    for block in content:
+        if block['type'] != 'text':
+            break
+        prefix.append(block)
+    cut_in_tool = bool(content) and content[-1]['type'] == 'tool_use'
+    # The API rejects an assistant prefix that ends in whitespace.
+    while prefix and not prefix[-1]['text'].rstrip():
+        prefix.pop()
+    if prefix:
+        prefix[-1] = {**prefix[-1], "text": prefix[-1]['text'].rstrip()}
+    return prefix, cut_in_tool
+
+def prefill_supported(hedge_mode):
+    # Other providers answer a trailing assistant message with a new reply
+    # instead of continuing it, so with them the whole turn is asked again.
+    return hedge_mode is None or all(provider.prefill for provider in get_providers())
+
+def rewind_turn(filepath, content, prefix):
+    """Cuts the turn's text in the file back to prefix's, which the continuation
+    is appended to. Returns the lock wait."""
+    written = "".join(block['text'] for block in content if block['type'] == 'text').encode()
+    kept = "".join(block['text'] for block in prefix).encode()
+    with file_lock(filepath) as waited, open(filepath, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        if written and end >= len(written):
+            f.seek(end - len(written))
+            # Leave the file alone if it no longer ends with what the turn wrote.
+            if f.read() == written:
+                f.truncate(end - len(written) + len(kept))
+    return waited
+
+def join_continuation(prefix, content):
+    if prefix and content and prefix[-1]['type'] == 'text' and content[0]['type'] == 'text':
+        joined = {**prefix[-1], "text": prefix[-1]['text'] + content[0]['text']}
+        return prefix[:-1] + [joined] + content[1:]
+    return prefix + content
+
+# Submit Sessions
+MODEL = "claude-haiku-4-5-20251001"
+
+class Session:
+    """One submit of one conversation file: its messages and the tool loop state."""
+
+    def __init__(self, filename, messages, journal):
+        self.filename = filename
+        self.filepath = os.path.join('conversations', filename)
+        self.messages = messages
+        self.journal = journal
+        self.system = build_system_prompt(exclude=filename)
+        self.tools = build_tools()
+        self.context = ContextWindow(messages)
+        self.context.overhead = content_tokens(self.system) + estimate_tokens(json.dumps(self.tools))
+        self.rounds = 0
+        # path -> ((path, mtime, size), tool_use_id) of the last full read_file result
+        self.delivered = {}
+        # Telemetry for the request in flight and for the last turn until its tools finish
+        self.timing = None
+        self.turn = None
+        self.lock = None
+        # A turn cut off at max_tokens: the blocks it is continued from (None
+        # when not continuing), how often it was continued, its output so far
+        # and, once complete, its whole content.
+        self.partial = None
+        self.continuations = 0
+        self.turn_output = 0
+        self.content = None
+        self.max_tokens = None
+        self.output_limit = None
+        # Tool calls dropped from the last turn because it was still cut off
+        # when it ran out of continuations.
+        self.dropped_calls = 0
+        # Starts submit-many's progress lines: "[filename] ".
+        self.prefix = ""
+        # Per-submit options: the ResponseCache (None when off) and the
+        # hedge mode (None to send to the direct client).
+        self.cache = None
+        self.hedge_mode = None
+
+    def request_params(self, stream):
+        self.context.before_request(self)
+        messages = self.messages
+        self.output_limit = output_limit(stream)
+        if self.partial is None:
+            self.max_tokens = get_output_budget().max_tokens(turn_kind(self.rounds), self.output_limit)
+        else:
+            self.max_tokens = min(self.max_tokens, self.output_limit)
+        if self.partial:
+            messages = messages + [{"role": "assistant", "content": self.partial}]
+        return dict(
+            model=MODEL,
+            max_tokens=self.max_tokens,
+            system=self.system,
+            messages=with_cache_breakpoints(messages),
+            tools=self.tools
+        )
+
+    def start_request(self, stream, attempt, cached=False):
+        self.timing = {"stream": stream, "retries": attempt, "cached": cached,
+                       "sent": time.perf_counter(), "first_text": None, "lock_wait": 0.0}
+
+    def begin_turn(self):
+        """Returns the header that opens the turn in the file: None for the usual one."""
+        if self.partial is not None:
+            return ""  # continuing a turn that is already in the file
+        self.journal.record('turn', round=self.rounds, offset=os.path.getsize(self.filepath))
+        return None
+
+    def end_turn(self, message):
+        self.context.observe(message.usage)
+        content = as_content_blocks(message.content)
+        if self.partial:
+            content = join_continuation(self.partial, content)
+        self.turn_output += message.usage.output_tokens
+        continuation = self.continuations
+        max_tokens = self.max_tokens
+        if (message.stop_reason == 'max_tokens'
+                and self.continuations < project_setting('max_continuations', DEFAULT_MAX_CONTINUATIONS)):
+            # Not journaled yet: if we die now, a resume re-sends the whole turn.
+            prefill = prefill_supported(self.hedge_mode)
+            self.partial, cut_in_tool = continuation_prefix(content) if prefill else ([], False)
+            self.timing['lock_wait'] += rewind_turn(self.filepath, content, self.partial)
+            if cut_in_tool or not prefill:
+                self.max_tokens = min(self.max_tokens * 2, self.output_limit)
+            self.continuations += 1
+        else:
+            self.dropped_calls = 0
+            if message.stop_reason == 'max_tokens':
+                # Out of continuations, and any tool call in a cut-off turn
+                # may be incomplete: the turn ends without running them.
+                self.dropped_calls = sum(block['type'] == 'tool_use' for block in content)
+                content = [block for block in content if block['type'] != 'tool_use']
+            self.journal.record('message', round=self.rounds, end=os.path.getsize(self.filepath),
+                                content=content)
+            get_output_budget().observe(turn_kind(self.rounds), self.turn_output)
+            self.content = content
+            self.partial = None
+        timing = self.timing
+        usage = message.usage
+        self.turn = {
+            "ts": datetime.now().isoformat(timespec='milliseconds'),
+            "file": self.filename,
+            "round": self.rounds,
+            "model": message.model,
+            "stream": timing['stream'],
+            "retries": timing['retries'],
+            "cached": timing['cached'],
+            "latency_ms": round((time.perf_counter() - timing['sent']) * 1000, 2),
+            "ttft_ms": round((timing['first_text'] - timing['sent']) * 1000, 2)
+                       if timing['first_text'] is not None else None,
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cache_read_input_tokens": usage.cache_read_input_tokens or 0,
+            "cache_creation_input_tokens": usage.cache_creation_input_tokens or 0,
+            "stop_reason": message.stop_reason,
+            "max_tokens": max_tokens,
+            "continuation": continuation,
+            "lock_wait_ms": round(timing['lock_wait'] * 1000, 2),
+            # Compaction ran, if at all, while this request was being built.
+            "context": self.context.stats(),
+            "tools": [],
+        }
+        if self.partial is None:
+            self.turn['turn_output_tokens'] = self.turn_output
+            self.continuations = 0
+            self.turn_output = 0
+
+    def log_turn(self):
+        if self.turn is not None:
+            log_telemetry(self.turn)
+            self.turn = None
+
+    def record_tool_result(self, tool_result):
+        self.journal.record('tool_result', round=self.rounds,
+                            tool_use_id=tool_result['tool_use_id'], content=tool_result['content'])
+
+    def run_tools(self, tool_calls):
+        return run_tool_calls(tool_calls, on_result=self.record_tool_result, session=self)
+
+    def add_tool_round(self, content, tool_results):
+        from anthropic.types import MessageParam
+        # The assistant's tool_use turn must be part of the conversation
+        # before we can send back its tool_result.
+        self.messages.append(MessageParam(role="assistant", content=content))
+        self.messages.append(MessageParam(role="user", content=tool_results))
+        self.context.append(self.messages[-2])
+        self.context.append(self.messages[-1])
+        self.log_turn()
+        self.rounds += 1
+
+    def complete(self):
+        self.log_turn()
+        self.journal.finish()
+
+    def close(self):
+        self.log_turn()
+        self.journal.close()
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+def open_session(filename, prefix="", cache=None, hedge_mode=None):
+    filepath = os.path.join('conversations', filename)
+    if not os.path.exists(filepath):
+        click.echo(f"{prefix}Conversation file '{filename}' not found.")
+        return None
+    try:
+        lock, _ = acquire_lock(filepath, 'session', blocking=False)
+    except FileBusy:
+        click.echo(f"{prefix}'{filename}' is already being submitted by another session.")
+        return None
+    try:
+        session = start_session(filename, filepath, prefix)
+    except BaseException:
+        lock.close()
+        raise
+    if session is None:
+        lock.close()
+    else:
+        session.lock = lock
+        session.prefix = prefix
+        session.cache = cache
+        session.hedge_mode = hedge_mode
+    return session
+
+def start_session(filename, filepath, prefix):
+    journal = Journal(filename)
+    events = journal.load()
+    if events:
+        session = resume_session(filename, journal, events, prefix)
+        if session is not None:
+            return session
+
+    messages = parse_conversation(filepath, filename)
+    if not messages or messages[-1]['role'] != 'user':
+        click.echo(f"{prefix}Nothing to submit: add a '## User' section with your message at the end of the file.")
+        return None
+
+    session = Session(filename, messages, journal)
+    journal.start(os.path.getsize(filepath))
+    return session
+
+def is_partial_turn(filepath, offset, size):
+    if size < offset:
+        return False
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        tail = f.read()
+    return tail.startswith(b"\n\n## Assistant") and not re.search(rb'^## User', tail, re.MULTILINE)
+
+def resume_session(filename, journal, events, prefix=""):
+    from anthropic.types import ToolResultBlockParam, ToolUseBlock
+    filepath = os.path.join('conversations', filename)
+    rounds = []
+    for event in events[1:]:
+        if event['event'] == 'turn':
+            rounds.append({"offset": event['offset'], "message": None, "results": {}})
+        elif event['event'] == 'message' and rounds:
+            rounds[-1]['message'] = event
+        elif event['event'] == 'tool_result' and rounds:
+            rounds[-1]['results'][event['tool_use_id']] = event['content']
+    if events[0]['event'] != 'start' or not rounds:
+        # Nothing was received before the interruption; a normal submit
+        # sends exactly the same request.
+        journal.finish()
+        return None
+
+    size = os.path.getsize(filepath)
+    last = rounds[-1]
+    if last['message'] is None:
+        consistent = is_partial_turn(filepath, last['offset'], size)
+    else:
+        consistent = size == last['message']['end']
+    if not consistent:
+        click.echo(f"{prefix}Conversation changed since the interrupted submit; starting a new one.")
+        journal.finish()
+        return None
+
+    messages = parse_conversation(filepath, filename, limit=events[0]['offset'])
+    session = Session(filename, messages, journal)
+    journal.reopen()
+    for completed in rounds[:-1]:
+        session.add_tool_round(completed['message']['content'], [
+            ToolResultBlockParam(type="tool_result", tool_use_id=tool_use_id, content=content)
+            for tool_use_id, content in completed['results'].items()
+        ])
+
+    if last['message'] is None:
+        with file_lock(filepath), open(filepath, 'r+b') as f:
+            f.truncate(last['offset'])
+        click.echo(f"{prefix}Resuming interrupted submit: discarded a partial response, "
+                   f"re-sending round {len(rounds)}.")
+        return session
+
+    content = last['message']['content']
+    tool_uses = [block for block in content if block['type'] == 'tool_use']
+    if not tool_uses:
+        # The final answer was already written; only the cleanup was missed.
+        journal.finish()
+        return None
+    missing = [ToolUseBlock(**block) for block in tool_uses if block['id'] not in last['results']]
+    click.echo(f"{prefix}Resuming interrupted submit at round {len(rounds)}: reusing "
+               f"{len(tool_uses) - len(missing)} tool result(s), running {len(missing)}.")
+    results = dict(last['results'])
+    for tool_result in session.run_tools(missing):
+        results[tool_result['tool_use_id']] = tool_result['content']
+    session.add_tool_round(content, [
+        ToolResultBlockParam(type="tool_result", tool_use_id=block['id'], content=results[block['id']])
+        for block in tool_uses if block['id'] in results
+    ])
+    return session
+
+def describe_error(e):
+    if isinstance(e, ReplayMiss):
+        return str(e)
+    from providers import ProviderError
+    if isinstance(e, ProviderError):
+        return f"All providers failed: {e}"
+    from anthropic import APIError, BadRequestError, RateLimitError
+    if isinstance(e, BadRequestError):
+        return f"Bad request: {e}"
+    if isinstance(e, RateLimitError):
+        return f"Rate limit exceeded: {e}"
+    if isinstance(e, APIError):
+        return f"API error: {e}"
+    return f"Unexpected error: {e}"
+
+def cached_response(params, session):
+    """Returns (cache key, cached entry); both None when the cache is off."""
+    if session.cache is None:
+        return None, None
+    key = ResponseCache.key(params)
+    entry = session.cache.get(key)
+    if entry is None and session.cache.replay:
+        raise ReplayMiss(f"No cached response for round {session.rounds + 1} of {session.filename} (--replay).")
+    return key, entry
+
+async def send_request(session, stream, echo=True):
+    import asyncio
+    from anthropic import APIConnectionError, APIStatusError
+    # Hedged requests are never streamed.
+    params = session.request_params(stream and session.hedge_mode is None)
+    key, entry = cached_response(params, session)
+    if entry is not None:
+        session.start_request(stream, 0, cached=True)
+        header = session.begin_turn()
+        tool_calls, message = process_replay(entry, session.filepath, echo=echo, timing=session.timing,
+                                             header=header)
+        session.end_turn(message)
+        return tool_calls, message
+    if session.hedge_mode is not None:
+        tool_calls, message = finish_hedged(session, await hedged_reply(session, params), echo=echo)
+        if key is not None:
+            session.cache.put(key, message)
+        return tool_calls, message
+    input_tokens, output_tokens = estimate_request_tokens(params)
+    attempt = 0
+    while True:
+        await asyncio.sleep(rate_limiter.reserve(input_tokens, output_tokens))
+        opened = False
+        session.start_request(stream, attempt)
+        try:
+            if stream:
+                async with get_client().messages.stream(**params) as message_stream:
+                    opened = True
+                    rate_limiter.observe(message_stream.response.headers)
+                    header = session.begin_turn()
+                    recording = RecordingStream(message_stream)
+                    tool_calls, message = await process_stream(recording, session.filepath, echo,
+                                                               session.timing, header)
+                    events = recording.events
+            else:
+                raw = await get_client().messages.with_raw_response.create(**params)
+                rate_limiter.observe(raw.headers)
+                message = await raw.parse()
+                header = session.begin_turn()
+                tool_calls = process_response(message, session.filepath, echo=echo, timing=session.timing,
+                                              header=header)
+                events = None
+            session.end_turn(message)
+            if key is not None:
+                session.cache.put(key, message, events)
+            return tool_calls, message
+        except (APIStatusError, APIConnectionError) as e:
+            # Once a stream has started writing to the conversation file a
+            # retry would duplicate its text, so only failed opens are retried.
+            delay = None if opened else rate_limiter.backoff(e, attempt)
+            if delay is None:
+                raise
+            click.echo(f"{session.prefix}{describe_error(e)} (retrying in {delay:.1f}s)")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+async def run_session(session, stream, echo=True):
+    """The tool loop of one submit. With echo the response text is printed as
+    it arrives; without it (submit-many) only progress lines are, each
+    starting with the session's prefix."""
+    import asyncio
+    lead = "\n" if echo else session.prefix
+    try:
+        while True:
+            tool_calls, message = await send_request(session, stream, echo)
+            report_usage(message.usage, lead)
+
+            if session.partial is not None:
+                click.echo(f"{lead}[max_tokens] response cut off at {message.usage.output_tokens} tokens; "
+                           f"continuing it (max_tokens {session.max_tokens})")
+                session.log_turn()
+                continue
+            if session.dropped_calls:
+                click.echo(f"{lead}[max_tokens] response still cut off after "
+                           f"{project_setting('max_continuations', DEFAULT_MAX_CONTINUATIONS)} continuation(s); "
+                           f"its {session.dropped_calls} tool call(s) were not run")
+                tool_calls = []
+
+            if not tool_calls:
+                break  # No more tool calls, we're done
+
+            # Tools run on the shared tool pool; this only keeps the event loop free.
+            tool_results = await asyncio.to_thread(session.run_tools, tool_calls)
+            session.add_tool_round(session.content, tool_results)
+        session.complete()
+    finally:
+        session.close()
+
+@cli.command()
+@click.argument('filename')
+@click.option('--stream', is_flag=True, help="Use streaming for the response")
+@click.option('--cache', is_flag=True, help="Reuse and store responses in the local response cache")
+@click.option('--replay', is_flag=True, help="Serve responses only from the response cache")
+@click.option('--hedge', type=click.Choice(['first', 'hedge', 'all']),
+              help="Send each request to the configured providers (default: hedge_mode setting)")
+def submit(filename, stream, cache, replay, hedge):
+    """Submit a conversation file to Claude and append the response"""
+    if run_in_daemon():
+        return
+    ensure_project_initialized()
+
+    session = open_session(filename, cache=open_response_cache(cache, replay),
+                           hedge_mode=hedging_mode(hedge))
+    if session is None:
+        return
+
+    try:
+        run_async(run_session(session, stream))
     except Exception as e:
-        click.echo(f"Unexpected error: {e}")
+        click.echo(describe_error(e))
         
     click.echo("Response received and appended to the conversation file.")
     click.echo("You can now edit the file and submit again to continue the conversation.")
 
+async def submit_many_async(filenames, stream, concurrency, cache=None, hedge_mode=None):
+    import asyncio
+    # Every conversation uses the loop's one client, and so one HTTP
+    # connection pool.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def submit_one(filename):
+        prefix = f"[{filename}] "
+        async with semaphore:
+            # Parsing the conversation and building the system prompt read
+            # files; keep that off the event loop.
+            session = await asyncio.to_thread(open_session, filename, prefix, cache, hedge_mode)
+            if session is None:
+                return False
+            click.echo(f"{prefix}started")
+            try:
+                await run_session(session, stream, echo=False)
+            except Exception as e:
+                click.echo(prefix + describe_error(e))
+                return False
+            click.echo(f"{prefix}done after {session.rounds} tool round(s)")
+            return True
+
+    # One tree walk for the batch; each session's own refresh is then a stat
+    # per directory.
+    await asyncio.to_thread(update_project_index)
+    return await asyncio.gather(*(submit_one(filename) for filename in filenames))
+
+@cli.command(name='submit-many')
+@click.argument('filenames', nargs=-1, required=True)
+@click.option('--stream', is_flag=True, help="Use streaming for the responses")
+@click.option('--concurrency', default=8, show_default=True, help="Maximum conversations in flight at once")
+@click.option('--cache', is_flag=True, help="Reuse and store responses in the local response cache")
+@click.option('--replay', is_flag=True, help="Serve responses only from the response cache")
+@click.option('--hedge', type=click.Choice(['first', 'hedge', 'all']),
+              help="Send each request to the configured providers (default: hedge_mode setting)")
+def submit_many(filenames, stream, concurrency, cache, replay, hedge):
+    """Submit several conversation files concurrently"""
+    if run_in_daemon():
+        return
+    ensure_project_initialized()
+
+    results = run_async(submit_many_async(filenames, stream, concurrency,
+                                          open_response_cache(cache, replay), hedging_mode(hedge)))
+    click.echo(f"{sum(results)} of {len(results)} conversations completed.")
+
+@cli.command()
+@click.option('--file', 'filename', help="Only turns from this conversation file")
+@click.option('--top', default=10, show_default=True, help="How many tools and conversations to list")
+def stats(filename, top):
+    """Summarize submit latency, token usage and tool time from the telemetry log"""
+    ensure_project_initialized()
+    records = load_telemetry(filename)
+    if not records:
+        click.echo(f"No telemetry recorded yet in {TELEMETRY_FILE}.")
+        return
+
+    conversations = {}
+    for record in records:
+        totals = conversations.setdefault(record['file'], dict.fromkeys(
+            ('turns', 'input_tokens', 'output_tokens', 'cache_read_input_tokens',
+             'cache_creation_input_tokens'), 0))
+        totals['turns'] += 1
+        for name in totals:
+            if name != 'turns':
+                totals[name] += record.get(name) or 0
+    click.echo(f"{len(records)} turns in {len(conversations)} conversation(s), "
+               f"{records[0]['ts'][:19]} to {records[-1]['ts'][:19]}\n")
+
+    click.echo(f"{'latency ms':12} {format_percentiles([record['latency_ms'] for record in records])}")
+    ttfts = [record['ttft_ms'] for record in records if record.get('ttft_ms') is not None]
+    if ttfts:
+        click.echo(f"{'ttft ms':12} {format_percentiles(ttfts)}")
+    wins = {}
+    for record in records:
+        if record.get('provider'):
+            wins.setdefault(record['provider'], []).append(record['latency_ms'])
+    for name, latencies in sorted(wins.items()):
+        click.echo(f"  {name:10} {format_percentiles(latencies)}  ({len(latencies)} hedged wins)")
+    retried = sum(1 for record in records if record.get('retries'))
+    stop_reasons = {}
+    for record in records:
+        stop_reasons[record.get('stop_reason')] = stop_reasons.get(record.get('stop_reason'), 0) + 1
+    waits = [record['lock_wait_ms'] + sum(call.get('lock_wait_ms', 0) for call in record.get('tools', []))
+             for record in records if 'lock_wait_ms' in record]
+    if any(waits):
+        click.echo(f"{'lock wait ms':12} {format_percentiles(waits)}  "
+                   f"({sum(1 for wait in waits if wait)} of {len(waits)} turns waited)")
+    click.echo("stop reasons " + ", ".join(f"{reason} {count}" for reason, count in
+                                           sorted(stop_reasons.items(), key=lambda item: -item[1]))
+               + f"; {retried} turn(s) needed retries")
+    windows = [record['context'] for record in records if record.get('context')]
+    if windows:
+        prompts = [window['prompt_tokens'] or window['estimated_tokens'] for window in windows]
+        click.echo(f"{'prompt tok':12} {format_percentiles(prompts)}")
+        click.echo(f"context      {sum(window['compactions'] for window in windows)} compaction(s), "
+                   f"~{sum(window['tokens_saved'] for window in windows)} tokens saved")
+
+    click.echo("\nTokens per conversation:")
+    for name in ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'):
+        values = [totals[name] for totals in conversations.values()]
+        click.echo(f"  {name:28} mean {sum(values) / len(values):10.0f}  max {max(values):10}")
+    heaviest = sorted(conversations.items(), key=lambda item: -(item[1]['input_tokens']
+                                                               + item[1]['cache_read_input_tokens']
+                                                               + item[1]['cache_creation_input_tokens']
+                                                               + item[1]['output_tokens']))
+    for name, totals in heaviest[:top]:
+        click.echo(f"  {name:40} {totals['turns']:4} turns  {totals['input_tokens']:9} in  "
+                   f"{totals['output_tokens']:8} out  {totals['cache_read_input_tokens']:9} cached")
+
+    tools = {}
+    for record in records:
+        for call in record.get('tools', []):
+            tools.setdefault(call['name'], []).append(call)
+    if tools:
+        click.echo("\nSlowest tools (by p95 ms):")
+        ranked = sorted(tools.items(), key=lambda item: -percentile(sorted(call['ms'] for call in item[1]), 0.95))
+        for name, calls in ranked[:top]:
+            times = sorted(call['ms'] for call in calls)
+            result_bytes = sum(call['result_bytes'] for call in calls) / len(calls)
+            timed_out = sum(1 for call in calls if call.get('timed_out'))
+            click.echo(f"  {name:14} {len(calls):6} calls  p50 {percentile(times, 0.5):8.1f}  "
+                       f"p95 {percentile(times, 0.95):8.1f}  max {times[-1]:8.1f}  "
+                       f"total {sum(times):9.1f}  avg result {format_size(result_bytes)}"
+                       + (f"  {timed_out} timed out" if timed_out else ""))
+
 if __name__ == '__main__':
     cli()
     
@@ -0,0 +1,103 @@
+"""Tail latency of hedged requests, against two local mock providers.
+
+Starts two mock servers from mock_api.py: an Anthropic-style one that is fast
+but sometimes very slow, and an OpenAI-style one that is steadier but slower.
+Then sends the same one-turn request through providers.py, sequentially, as
+a single provider and in each hedge mode. Reports latency percentiles and how
+many upstream requests each mode cost.
+
+    python benchmarks/bench_hedge.py [--requests 200] [--json out.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from mock_api import MockMessagesAPI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from providers import AnthropicProvider, OpenAIProvider, hedged_request  # noqa: E402
+
+REQUEST = {
+    "system": [{"type": "text", "text": "You are a benchmark."}],
+    "messages": [{"role": "user", "content": "Say something."}],
+    "tools": [],
+    "max_tokens": 100,
+}
+
+def summarize(samples, upstream):
+    """Latency percentiles in milliseconds plus upstream requests per call."""
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, round(q * len(ordered)) - 1)] * 1000, 1)
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 1),
+        "p50_ms": pick(0.5),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 1),
+        "upstream_per_request": round(upstream / len(ordered), 2),
+    }
+
+async def run_mode(providers, mode, requests, mocks):
+    """Sends requests one at a time in one mode and summarizes the latencies."""
+    for mock in mocks:
+        mock.reset()
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        if mode == 'single':
+            await providers[0].complete(REQUEST)
+        else:
+            await hedged_request(providers, REQUEST, mode)
+        samples.append(time.perf_counter() - start)
+    # Give cancelled requests time to reach the mocks' counters.
+    await asyncio.sleep(0.1)
+    return summarize(samples, sum(mock.stats['requests'] for mock in mocks))
+
+async def run(options):
+    """Runs every mode against fresh mocks."""
+    fast = MockMessagesAPI(rounds=0, words=20, latency=options.latency,
+                           slow_fraction=options.slow_fraction, slow_latency=options.slow_latency)
+    steady = MockMessagesAPI(rounds=0, words=20, latency=options.latency * 2)
+    fast.start()
+    steady.start()
+    providers = [
+        AnthropicProvider('mock-claude', api_key='mock-key', base_url=fast.base_url),
+        OpenAIProvider('mock-gpt', api_key='mock-key', base_url=steady.base_url + '/v1'),
+    ]
+    results = {}
+    try:
+        # Warm up: imports, client construction and the first connections.
+        for provider in providers:
+            await provider.complete(REQUEST)
+        for mode in ('single', 'first', 'hedge', 'all'):
+            results[mode] = await run_mode(providers, mode, options.requests, [fast, steady])
+    finally:
+        for provider in providers:
+            await provider.close()
+        fast.stop()
+        steady.stop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.03, help="Usual latency of the fast mock")
+    parser.add_argument('--slow-fraction', type=float, default=0.05)
+    parser.add_argument('--slow-latency', type=float, default=0.5)
+    parser.add_argument('--json', help="Write results to this file")
+    options = parser.parse_args()
+
+    results = asyncio.run(run(options))
+    for mode, result in results.items():
+        print(f"{mode:8} " + "  ".join(f"{key} {value}" for key, value in result.items()))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({"benchmark": "hedge", "options": vars(options), "results": results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
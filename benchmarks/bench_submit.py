@@ -0,0 +1,238 @@
+"""Offline benchmarks for the submit path, run against benchmarks/mock_api.py.
+
+Nothing here talks to the real API: every run starts its own mock server and
+points the SDK at it through ANTHROPIC_BASE_URL with a dummy key. Measures
+
+- submit / submit_stream: end-to-end wall time of `aiproject submit [--stream]`
+  as a subprocess, for a conversation with one tool round;
+- ttft: time from sending a streamed request to the first text reaching the
+  conversation file;
+- tool_round_trip: client-side time between the end of a tool_use response
+  and the start of the next request (parse, write, run tools, journal,
+  rebuild the request), with the mock's own time excluded;
+- throughput: conversations and requests per second through submit-many;
+- memory: tracemalloc growth per round over a long tool loop, and what is
+  still held once the session is done.
+
+Results go to stdout and, with --json, to a file that can be diffed between
+commits. Mock latencies are configurable so the client's own
+overhead can be seen with (default) or without realistic network time.
+
+    python benchmarks/bench_submit.py [--repeat 5] [--quick] [--json out.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mock_api import MockMessagesAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AIRPROJECT = os.path.join(ROOT, 'airproject.py')
+# The mock reports generous limits so client-side pacing never skews timings.
+MOCK_LIMITS = {"requests": 10**6, "input-tokens": 10**9, "output-tokens": 10**8}
+CONVERSATION = "# bench\n\n## User\n\nRead bench.txt and summarise it.\n"
+BENCH_FILE = "".join(f"line {i}: the quick brown fox jumps over the lazy dog\n" for i in range(200))
+
+def percentiles(samples, scale=1000):
+    """Median, p95 and max of samples, in milliseconds by default."""
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))]
+    return {
+        "n": len(ordered),
+        "median_ms": round(statistics.median(ordered) * scale, 2),
+        "p95_ms": round(p95 * scale, 2),
+        "max_ms": round(ordered[-1] * scale, 2),
+    }
+
+def make_project(path, conversations=1):
+    """Creates a scratch project with bench.txt and conversation files bench-N.md."""
+    os.makedirs(os.path.join(path, 'conversations'), exist_ok=True)
+    with open(os.path.join(path, '.aiproject.json'), 'w') as f:
+        json.dump({"project_name": "bench"}, f)
+    with open(os.path.join(path, 'conversations', 'bench.txt'), 'w') as f:
+        f.write(BENCH_FILE)
+    reset_conversations(path, conversations)
+
+def reset_conversations(path, conversations):
+    """Rewrites the conversation files and drops journals so each run starts fresh."""
+    shutil.rmtree(os.path.join(path, '.aiproject', 'journal'), ignore_errors=True)
+    for i in range(conversations):
+        with open(os.path.join(path, 'conversations', f'bench-{i}.md'), 'w') as f:
+            f.write(CONVERSATION)
+
+def bench_cli(api, project, stream, repeat):
+    """End-to-end wall time of one `submit` subprocess."""
+    env = {**os.environ, 'ANTHROPIC_BASE_URL': api.base_url, 'ANTHROPIC_API_KEY': 'mock-key'}
+    args = [sys.executable, AIRPROJECT, 'submit', 'bench-0.md'] + (['--stream'] if stream else [])
+    walls = []
+    for _ in range(repeat):
+        reset_conversations(project, 1)
+        start = time.perf_counter()
+        result = subprocess.run(args, cwd=project, env=env, capture_output=True, text=True)
+        walls.append(time.perf_counter() - start)
+        if result.returncode != 0 or 'error' in result.stdout.lower():
+            raise RuntimeError(f"submit failed:\n{result.stdout}{result.stderr}")
+    return percentiles(walls)
+
+def bench_ttft(airproject, api, project, repeat):
+    """Time from starting a streamed request to its first text write."""
+    samples = []
+    first_write = []
+    writer_class = airproject.StreamWriter
+
+    class TimedWriter(writer_class):
+        def write(self, text):
+            if not first_write:
+                first_write.append(time.perf_counter())
+            super().write(text)
+
+    async def run():
+        # One extra run first, so client construction is not counted.
+        for _ in range(repeat + 1):
+            reset_conversations(project, 1)
+            session = airproject.open_session('bench-0.md')
+            first_write.clear()
+            start = time.perf_counter()
+            await airproject.send_request(session, stream=True)
+            samples.append(first_write[0] - start)
+            session.close()
+
+    airproject.StreamWriter = TimedWriter
+    try:
+        airproject.run_async(run())
+    finally:
+        airproject.StreamWriter = writer_class
+    return percentiles(samples[1:])
+
+def bench_tool_round_trip(airproject, api, project, stream, rounds):
+    """Client-side gap between consecutive requests of one tool loop."""
+    reset_conversations(project, 1)
+    api.reset()
+    api.rounds = rounds
+    start = time.perf_counter()
+    airproject.run_async(airproject.run_session(airproject.open_session('bench-0.md'), stream))
+    total = time.perf_counter() - start
+    timings = sorted(api.timings)
+    gaps = [timings[i + 1][0] - timings[i][1] for i in range(len(timings) - 1)]
+    server = sum(end - begin for begin, end in timings)
+    return {**percentiles(gaps), "rounds": rounds, "total_ms": round(total * 1000, 2),
+            "client_share": round(1 - server / total, 3)}
+
+def bench_throughput(airproject, api, project, conversations, concurrency, stream):
+    """Conversations and requests per second through submit-many."""
+    reset_conversations(project, conversations)
+    api.reset()
+    filenames = [f'bench-{i}.md' for i in range(conversations)]
+    start = time.perf_counter()
+    results = airproject.run_async(airproject.submit_many_async(filenames, stream, concurrency))
+    elapsed = time.perf_counter() - start
+    if not all(results):
+        raise RuntimeError("submit-many reported failed conversations")
+    return {
+        "conversations": conversations,
+        "concurrency": concurrency,
+        "elapsed_ms": round(elapsed * 1000, 2),
+        "conversations_per_s": round(conversations / elapsed, 2),
+        "requests_per_s": round(api.stats['requests'] / elapsed, 2),
+    }
+
+def bench_memory(airproject, api, project, rounds):
+    """tracemalloc growth per tool round and memory retained after the session."""
+    reset_conversations(project, 1)
+    api.rounds = rounds
+    samples = []
+    add_tool_round = airproject.Session.add_tool_round
+
+    def sampled(session, content, tool_results):
+        add_tool_round(session, content, tool_results)
+        samples.append(tracemalloc.get_traced_memory()[0])
+
+    airproject.Session.add_tool_round = sampled
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        airproject.run_async(airproject.run_session(airproject.open_session('bench-0.md'), stream=False))
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        airproject.Session.add_tool_round = add_tool_round
+    # Skip the first rounds: they include one-off costs such as SDK imports.
+    steady = samples[len(samples) // 4:]
+    per_round = (steady[-1] - steady[0]) / max(1, len(steady) - 1)
+    return {
+        "rounds": rounds,
+        "growth_per_round_kib": round(per_round / 1024, 2),
+        "peak_kib": round((peak - before) / 1024, 1),
+        "retained_kib": round((after - before) / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help="Fewer rounds and conversations")
+    parser.add_argument('--latency', type=float, default=0.02, help="Mock seconds before each response")
+    parser.add_argument('--first-token-latency', type=float, default=0.03)
+    parser.add_argument('--token-interval', type=float, default=0.0005)
+    parser.add_argument('--json', help="Write results to this file")
+    options = parser.parse_args()
+    rounds = 5 if options.quick else 20
+    conversations = 8 if options.quick else 32
+
+    api = MockMessagesAPI(
+        rounds=1, words=200, limits=MOCK_LIMITS, latency=options.latency,
+        first_token_latency=options.first_token_latency, token_interval=options.token_interval,
+    )
+    api.start()
+    project = tempfile.mkdtemp(prefix='aiproject-bench-')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        make_project(project, conversations)
+        results["submit"] = bench_cli(api, project, False, options.repeat)
+        results["submit_stream"] = bench_cli(api, project, True, options.repeat)
+
+        # The rest runs in-process so it can look inside a session.
+        os.environ['ANTHROPIC_BASE_URL'] = api.base_url
+        os.environ['ANTHROPIC_API_KEY'] = 'mock-key'
+        os.chdir(project)
+        sys.path.insert(0, ROOT)
+        import airproject
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            results["ttft"] = bench_ttft(airproject, api, project, options.repeat * 2)
+            results["tool_round_trip"] = bench_tool_round_trip(airproject, api, project, False, rounds)
+            results["tool_round_trip_stream"] = bench_tool_round_trip(airproject, api, project, True, rounds)
+            api.rounds = 2
+            results["throughput"] = bench_throughput(airproject, api, project, conversations, 8, False)
+            results["throughput_stream"] = bench_throughput(airproject, api, project, conversations, 8, True)
+            api.latency = api.first_token_latency = api.token_interval = 0.0
+            results["memory"] = bench_memory(airproject, api, project, rounds * 5)
+    finally:
+        os.chdir(cwd)
+        api.stop()
+        shutil.rmtree(project, ignore_errors=True)
+
+    for name, result in results.items():
+        print(f"{name:24} " + "  ".join(f"{key} {value}" for key, value in result.items()))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({
+                "benchmark": "submit",
+                "python": platform.python_version(),
+                "mock": {"latency": options.latency, "first_token_latency": options.first_token_latency,
+                         "token_interval": options.token_interval},
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
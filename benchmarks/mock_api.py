@@ -0,0 +1,308 @@
+"""A local stand-in for the Anthropic Messages API, for offline benchmarks.
+
+Serves POST /v1/messages (JSON and SSE streaming, with tool_use blocks and
+anthropic-ratelimit-* headers) and POST /v1/messages/count_tokens. Point the
+SDK at it with ANTHROPIC_BASE_URL. It also answers OpenAI-style POST
+/v1/chat/completions (non-streaming, function calling) for the providers in
+providers.py.
+
+Responses follow a tool-loop scenario worked out from the request itself, so
+any number of conversations can run against one server at once: while fewer
+than `rounds` tool rounds have happened since the last user text, the reply
+asks for `tools_per_round` tool calls; after that it answers with `words`
+words of text. Alternatively `script` is a list of canned responses
+({"content": [...], "stop_reason": ...}) served in order. A `slow_fraction` of
+requests wait `slow_latency` seconds instead of `latency`, to give the
+latency distribution a tail.
+
+    python benchmarks/mock_api.py --port 8765 --rounds 2 --token-interval 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose (cancelled hedges, interrupted streams).
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+class MockMessagesAPI:
+    def __init__(self, rounds=1, tools_per_round=1, words=50, tool_name='read_file',
+                 tool_input=None, latency=0.0, first_token_latency=0.0, token_interval=0.0,
+                 rate_limit_every=0, limits=None, script=None, slow_fraction=0.0, slow_latency=0.0,
+                 host='127.0.0.1', port=0):
+        self.rounds = rounds
+        self.tools_per_round = tools_per_round
+        self.words = words
+        self.tool_name = tool_name
+        self.tool_input = tool_input if tool_input is not None else {"filename": "bench.txt"}
+        self.latency = latency
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.rate_limit_every = rate_limit_every
+        self.limits = limits or {"requests": 4000, "input-tokens": 400000, "output-tokens": 80000}
+        self.script = script
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "rate_limited": 0, "request_bytes": 0}
+        # (received, finished) perf_counter times of every answered /v1/messages request
+        self.timings = []
+        self.server = MockServer((host, port), self.handler_class())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def reset(self):
+        with self.lock:
+            self.stats = dict.fromkeys(self.stats, 0)
+            self.timings = []
+
+    def next_id(self):
+        return next(self.counter)
+
+    def completed_rounds(self, messages):
+        """Tool rounds since the last user turn that carried text."""
+        rounds = 0
+        for message in reversed(messages):
+            if message['role'] != 'user':
+                continue
+            content = message['content']
+            if isinstance(content, list) and content and all(
+                    block.get('type') == 'tool_result' for block in content):
+                rounds += 1
+            else:
+                break
+        return rounds
+
+    def delay(self):
+        if self.slow_fraction and random.random() < self.slow_fraction:
+            return self.slow_latency
+        return self.latency
+
+    def completed_chat_rounds(self, messages):
+        """Function calls since the last user message of a chat completions request."""
+        rounds = 0
+        for message in reversed(messages):
+            if message['role'] == 'user':
+                break
+            if message['role'] == 'assistant' and message.get('function_call'):
+                rounds += 1
+        return rounds
+
+    def respond_chat(self, body):
+        n = self.next_id()
+        message = {"role": "assistant", "content": None}
+        if self.completed_chat_rounds(body['messages']) < self.rounds and body.get('functions'):
+            message['function_call'] = {"name": self.tool_name, "arguments": json.dumps(self.tool_input)}
+            finish_reason = 'function_call'
+        else:
+            message['content'] = " ".join(f"word{i}" for i in range(self.words))
+            finish_reason = 'stop'
+        return {
+            "id": f"chatcmpl-mock-{n}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'mock'),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": len(json.dumps(body)) // 4,
+                      "completion_tokens": self.words if finish_reason == 'stop' else 10,
+                      "total_tokens": 0},
+        }
+
+    def respond(self, body):
+        n = self.next_id()
+        if self.script:
+            reply = self.script[n % len(self.script)]
+            content, stop_reason = reply['content'], reply.get('stop_reason', 'end_turn')
+        elif self.completed_rounds(body['messages']) < self.rounds:
+            content = [{"type": "text", "text": "Let me check."}] + [
+                {"type": "tool_use", "id": f"toolu_mock_{n}_{i}", "name": self.tool_name,
+                 "input": self.tool_input}
+                for i in range(self.tools_per_round)
+            ]
+            stop_reason = 'tool_use'
+        else:
+            content = [{"type": "text", "text": " ".join(f"word{i}" for i in range(self.words))}]
+            stop_reason = 'end_turn'
+        output_tokens = sum(len(block.get('text', '').split()) + len(json.dumps(block.get('input', '')))
+                            for block in content)
+        return {
+            "id": f"msg_mock_{n}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get('model', 'mock'),
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": len(json.dumps(body)) // 4,
+                "output_tokens": output_tokens,
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 0,
+            },
+        }
+
+    def rate_limit_headers(self):
+        reset = (datetime.now(timezone.utc) + timedelta(seconds=60)).isoformat().replace('+00:00', 'Z')
+        headers = {}
+        for name, limit in self.limits.items():
+            headers[f"anthropic-ratelimit-{name}-limit"] = str(limit)
+            headers[f"anthropic-ratelimit-{name}-remaining"] = str(limit - 1)
+            headers[f"anthropic-ratelimit-{name}-reset"] = reset
+        return headers
+
+    def handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                received = time.perf_counter()
+                raw = self.rfile.read(int(self.headers.get('content-length', 0)))
+                body = json.loads(raw or b'{}')
+                api.count('request_bytes', len(raw))
+                if self.path.rstrip('/').endswith('/v1/messages/count_tokens'):
+                    return self.send_json(200, {"input_tokens": len(raw) // 4})
+                if self.path.rstrip('/').endswith('/v1/chat/completions'):
+                    api.count('requests')
+                    time.sleep(api.delay())
+                    self.send_json(200, api.respond_chat(body))
+                    with api.lock:
+                        api.timings.append((received, time.perf_counter()))
+                    return
+                if not self.path.rstrip('/').endswith('/v1/messages'):
+                    return self.send_json(404, {"type": "error", "error": {"type": "not_found_error",
+                                                                           "message": self.path}})
+                api.count('requests')
+                if api.rate_limit_every and api.stats['requests'] % api.rate_limit_every == 0:
+                    api.count('rate_limited')
+                    return self.send_json(429, {"type": "error", "error": {
+                        "type": "rate_limit_error", "message": "mock rate limit"}},
+                        {"retry-after": "0.1"})
+                time.sleep(api.delay())
+                message = api.respond(body)
+                if body.get('stream'):
+                    api.count('streamed')
+                    self.send_stream(message)
+                else:
+                    self.send_json(200, message, api.rate_limit_headers())
+                with api.lock:
+                    api.timings.append((received, time.perf_counter()))
+
+            def send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_event(self, event, data):
+                self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                self.wfile.flush()
+
+            def send_stream(self, message):
+                self.send_response(200)
+                self.send_header('content-type', 'text/event-stream')
+                self.send_header('connection', 'close')
+                for name, value in api.rate_limit_headers().items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.close_connection = True
+                time.sleep(api.first_token_latency)
+                self.send_event('message_start', {"type": "message_start", "message": {
+                    **message, "content": [], "stop_reason": None,
+                    "usage": {**message['usage'], "output_tokens": 0}}})
+                for index, block in enumerate(message['content']):
+                    if block['type'] == 'text':
+                        self.send_event('content_block_start', {"type": "content_block_start", "index": index,
+                                                                "content_block": {"type": "text", "text": ""}})
+                        for word in block['text'].split(' '):
+                            self.send_event('content_block_delta', {
+                                "type": "content_block_delta", "index": index,
+                                "delta": {"type": "text_delta", "text": word + ' '}})
+                            time.sleep(api.token_interval)
+                    else:
+                        self.send_event('content_block_start', {"type": "content_block_start", "index": index,
+                                                                "content_block": {**block, "input": {}}})
+                        self.send_event('content_block_delta', {
+                            "type": "content_block_delta", "index": index,
+                            "delta": {"type": "input_json_delta", "partial_json": json.dumps(block['input'])}})
+                    self.send_event('content_block_stop', {"type": "content_block_stop", "index": index})
+                self.send_event('message_delta', {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": message['stop_reason'], "stop_sequence": None},
+                    "usage": {"output_tokens": message['usage']['output_tokens']}})
+                self.send_event('message_stop', {"type": "message_stop"})
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the mock Messages API server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rounds', type=int, default=1, help="Tool rounds before the final answer")
+    parser.add_argument('--tools-per-round', type=int, default=1)
+    parser.add_argument('--words', type=int, default=50, help="Words in the final answer")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument('--first-token-latency', type=float, default=0.0)
+    parser.add_argument('--token-interval', type=float, default=0.0, help="Seconds between streamed words")
+    parser.add_argument('--rate-limit-every', type=int, default=0, help="Answer every Nth request with a 429")
+    parser.add_argument('--slow-fraction', type=float, default=0.0, help="Share of requests that are slow")
+    parser.add_argument('--slow-latency', type=float, default=0.0, help="Seconds before a slow response")
+    parser.add_argument('--script', help="JSON file with a list of canned responses")
+    options = parser.parse_args()
+
+    script = None
+    if options.script:
+        with open(options.script) as f:
+            script = json.load(f)
+    api = MockMessagesAPI(
+        rounds=options.rounds, tools_per_round=options.tools_per_round, words=options.words,
+        latency=options.latency, first_token_latency=options.first_token_latency,
+        token_interval=options.token_interval, rate_limit_every=options.rate_limit_every,
+        slow_fraction=options.slow_fraction, slow_latency=options.slow_latency, script=script, host=options.host, port=options.port,
+    )
+    print(f"Mock Messages API on {api.base_url} (ANTHROPIC_BASE_URL={api.base_url})")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Startup benchmark for the non-network aiproject commands.
+
+Runs `--help`, `init`, `new` and `list` under `python -X importtime` in a
+scratch project and reports median wall time and import time per command.
+Exits non-zero if a command imports any module in FORBIDDEN_MODULES or if its
+median import time is over the budget, so it can guard against someone
+re-adding a top-level `import anthropic`.
+
+    python benchmarks/startup.py [--repeat 5] [--budget-ms 150] [--json out.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+AIRPROJECT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'airproject.py')
+FORBIDDEN_MODULES = {'anthropic', 'httpx', 'asyncio', 'sqlite3'}
+COMMANDS = [
+    ['--help'],
+    ['init'],
+    ['new', 'startup-bench.md'],
+    ['list'],
+]
+
+def run_command(args, cwd):
+    """Runs one CLI command, returning (wall seconds, import seconds, top-level modules)."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', AIRPROJECT, *args],
+        cwd=cwd, capture_output=True, text=True,
+        # Never let a benchmark run reach a real API.
+        env={**os.environ, 'ANTHROPIC_API_KEY': '', 'ANTHROPIC_BASE_URL': 'http://127.0.0.1:9'},
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{result.stdout}{result.stderr}")
+
+    import_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip().split('.')[0])
+        if not name.startswith('  '):  # top level: cumulative covers its children
+            import_us += int(cumulative)
+    return wall, import_us / 1e6, modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=150.0,
+                        help="Maximum median import time per command")
+    parser.add_argument('--json', help="Write results to this file")
+    options = parser.parse_args()
+
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as project:
+        for args in COMMANDS:
+            walls, imports, modules = [], [], set()
+            for i in range(options.repeat):
+                if args[0] == 'new' and i:
+                    os.remove(os.path.join(project, 'conversations', args[1]))
+                wall, import_time, imported = run_command(args, project)
+                walls.append(wall)
+                imports.append(import_time)
+                modules |= imported
+            name = ' '.join(args)
+            results[name] = {
+                "wall_ms": round(statistics.median(walls) * 1000, 1),
+                "import_ms": round(statistics.median(imports) * 1000, 1),
+                "forbidden_imports": sorted(modules & FORBIDDEN_MODULES),
+            }
+            if results[name]["forbidden_imports"]:
+                failures.append(f"{name}: imports {', '.join(results[name]['forbidden_imports'])}")
+            if results[name]["import_ms"] > options.budget_ms:
+                failures.append(f"{name}: import time {results[name]['import_ms']}ms "
+                                f"over the {options.budget_ms}ms budget")
+
+    for name, result in results.items():
+        print(f"{name:28} wall {result['wall_ms']:7.1f} ms   import {result['import_ms']:7.1f} ms")
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({"benchmark": "startup", "results": results}, f, indent=2)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
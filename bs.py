@@ -2,12 +2,49 @@ import os
 import sys
 import openai
 import json
-import shutil
+import time
+import atexit
+import bisect
+import threading
+from array import array
 from datetime import datetime
 
 # Constants
 TARGET_FILE = sys.argv[0]  # The current script is the target file
-HISTORY_FILE = 'airproject_history.json'
+HISTORY_FILE = 'airproject_history.jsonl'
+HISTORY_INDEX_FILE = 'airproject_history.idx'
+HISTORY_ARCHIVE_FILE = 'airproject_history.archive.jsonl'
+HISTORY_COMPACT_MARKER = 'airproject_history.compacting'
+LEGACY_HISTORY_FILE = 'airproject_history.json'
+HISTORY_PINS_FILE = 'airproject_history.pins.jsonl'
+
+# The history is an append-only JSONL log: one line per entry, so logging a
+# message costs one small write instead of re-serializing the whole history.
+# fsync is batched (every HISTORY_FSYNC_BATCH entries or HISTORY_FSYNC_INTERVAL
+# seconds, and at exit). The .idx file holds the byte offset of every line so
+# the newest entries can be read without scanning the log. Once the log grows
+# past HISTORY_COMPACT_BYTES, a background thread moves older entries to the
+# archive file, keeping at most the newest HISTORY_KEEP_ENTRIES and at most
+# HISTORY_COMPACT_TARGET_BYTES. The target is well under the trigger, so
+# compactions stay rare even when entries are large.
+HISTORY_FSYNC_BATCH = 16
+HISTORY_FSYNC_INTERVAL = 1.0
+HISTORY_COMPACT_BYTES = 8 * 1024 * 1024
+HISTORY_COMPACT_TARGET_BYTES = HISTORY_COMPACT_BYTES // 2
+HISTORY_KEEP_ENTRIES = 2000
+
+# Only a window of the history goes into each request: pinned turns, and
+# the most recent complete turns (a user message and everything after it) up
+# to HISTORY_WINDOW_TURNS and HISTORY_TOKEN_BUDGET, which pinned turns count
+# against too. The log is read newest first and reading stops once the window
+# is full and every pinned turn has been found. A full window is not
+# completed by searching the archive for pins: a pinned turn archived by
+# compaction is then sent as just its pinned message. Start a message with PIN_PREFIX to pin its turn; pinned
+# messages are also kept in their own small file, which says what to look for.
+HISTORY_WINDOW_TURNS = 20
+HISTORY_TOKEN_BUDGET = 8000
+PIN_PREFIX = '/pin '
+MESSAGE_KEYS = ('role', 'content', 'name', 'function_call')
 
 # Get OpenAI API key from environment variable
 openai.api_key = os.environ.get('OPENAI_API_KEY')
@@ -38,39 +75,424 @@ def get_user_input():
     """Prompts the user for input."""
     return input("Please enter your request:\n")
 
-def load_conversation_history():
-    """Loads the conversation history from the JSON file."""
-    print(f"Loading conversation history from {HISTORY_FILE}...")
-    if not os.path.exists(HISTORY_FILE):
-        return []
+def read_lines_from(f, start, end):
+    """Yields the complete lines of an open binary file between two byte offsets."""
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        line = f.readline(remaining)
+        if not line:
+            break
+        remaining -= len(line)
+        yield line
+
+def read_lines_backward(f, end, block_size=65536):
+    """Yields the lines of an open binary file before byte offset end, last line first."""
+    position = end
+    rest = b''
+    while position > 0:
+        start = max(0, position - block_size)
+        f.seek(start)
+        lines = (f.read(position - start) + rest).split(b'\n')
+        position = start
+        # The first piece may be the end of a line that starts in an earlier block.
+        rest = lines.pop(0) if position > 0 else b''
+        for line in reversed(lines):
+            if line:
+                yield line
+    if rest:
+        yield rest
+
+def parse_entry(line):
+    """Parses one history line, returning None for a line that cannot be decoded."""
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        print(f"Loaded conversation history with {len(history)} entries.")
-        return history
+        return json.loads(line)
     except json.JSONDecodeError:
-        print(f"Error: {HISTORY_FILE} is corrupted. Starting with empty history.")
-        return []
+        return None
+
+class HistoryLog:
+    """Append-only JSONL conversation history with a line-offset index."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.compactor = None
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.recover_compaction()
+        self.f = open(HISTORY_FILE, 'ab')
+        self.size = self.f.tell()
+        self.repair_tail()
+        self.offsets = self.load_index()
+        self.index_file = open(HISTORY_INDEX_FILE, 'ab')
+        # Archive bytes that belong to a finished compaction; readers stop here.
+        self.archive_size = os.path.getsize(HISTORY_ARCHIVE_FILE) if os.path.exists(HISTORY_ARCHIVE_FILE) else 0
+
+    def recover_compaction(self):
+        """Finishes or undoes a compaction that was interrupted by a crash."""
+        if not os.path.exists(HISTORY_COMPACT_MARKER):
+            return
+        with open(HISTORY_COMPACT_MARKER, 'r', encoding='utf-8') as f:
+            marker = json.load(f)
+        if os.path.exists(HISTORY_FILE) and os.stat(HISTORY_FILE).st_ino == marker['inode']:
+            # The live log was never replaced, so the archive copy is a duplicate.
+            with open(HISTORY_ARCHIVE_FILE, 'ab') as archive:
+                archive.truncate(marker['archive_size'])
+            print("Rolled back an interrupted history compaction.")
+        if os.path.exists(HISTORY_FILE + '.compact'):
+            os.remove(HISTORY_FILE + '.compact')
+        os.remove(HISTORY_COMPACT_MARKER)
+
+    def repair_tail(self):
+        """Cuts a partially written last line left by a crash."""
+        if self.size == 0:
+            return
+        with open(HISTORY_FILE, 'rb') as f:
+            f.seek(max(0, self.size - 65536))
+            tail = f.read()
+        if tail.endswith(b'\n'):
+            return
+        cut = tail.rfind(b'\n')
+        if cut < 0 and self.size > len(tail):
+            return  # a single line longer than 64 KiB; leave it for parse_entry to skip
+        keep = self.size - len(tail) + cut + 1
+        print(f"Discarding {self.size - keep} bytes of a partially written history entry.")
+        self.f.truncate(keep)
+        self.size = keep
+
+    def load_index(self):
+        """Loads the line-offset index, rebuilding it if it does not match the log."""
+        offsets = array('Q')
+        try:
+            with open(HISTORY_INDEX_FILE, 'rb') as f:
+                data = f.read()
+            if len(data) % offsets.itemsize == 0:
+                offsets.frombytes(data)
+        except FileNotFoundError:
+            pass
+        if self.index_matches(offsets):
+            return offsets
+
+        print(f"Rebuilding history index {HISTORY_INDEX_FILE}...")
+        offsets = array('Q')
+        position = 0
+        with open(HISTORY_FILE, 'rb') as f:
+            for line in f:
+                offsets.append(position)
+                position += len(line)
+        with open(HISTORY_INDEX_FILE, 'wb') as f:
+            offsets.tofile(f)
+        return offsets
+
+    def index_matches(self, offsets):
+        """Checks that the index ends exactly at the last line of the log."""
+        if not offsets:
+            return self.size == 0
+        if offsets[-1] >= self.size:
+            return False
+        with open(HISTORY_FILE, 'rb') as f:
+            if offsets[-1] > 0:
+                f.seek(offsets[-1] - 1)
+                if f.read(1) != b'\n':
+                    return False
+            last = f.read()
+        return last.count(b'\n') == 1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, entry):
+        """Appends one entry, syncing to disk in batches."""
+        line = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            self.offsets.append(self.size)
+            self.index_file.write(self.offsets[-1:].tobytes())
+            self.index_file.flush()
+            self.size += len(line)
+            self.pending += 1
+            if (self.pending >= HISTORY_FSYNC_BATCH
+                    or time.monotonic() - self.last_sync >= HISTORY_FSYNC_INTERVAL):
+                self.sync()
+            compactor = None
+            if self.size > HISTORY_COMPACT_BYTES and self.compactor is None:
+                compactor = self.compactor = threading.Thread(target=self.compact, daemon=True)
+        if compactor is not None:
+            compactor.start()
+
+    def sync(self):
+        """Forces pending entries to disk. Called with the lock held."""
+        if self.pending:
+            os.fsync(self.f.fileno())
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def tail(self, count):
+        """Returns the newest count entries of the live log, oldest first."""
+        with self.lock:
+            if not self.offsets:
+                return []
+            with open(HISTORY_FILE, 'rb') as f:
+                start = self.offsets[max(0, len(self.offsets) - count)]
+                entries = [parse_entry(line) for line in read_lines_from(f, start, self.size)]
+        return [entry for entry in entries if entry is not None]
+
+    def entries(self):
+        """Yields every entry, archived ones first, reading the files lazily."""
+        # Open both files together under the lock so a compaction finishing
+        # while we read can neither hide nor repeat entries.
+        with self.lock:
+            parts = [(open(HISTORY_FILE, 'rb'), self.size)]
+            if self.archive_size:
+                parts.insert(0, (open(HISTORY_ARCHIVE_FILE, 'rb'), self.archive_size))
+        for f, end in parts:
+            with f:
+                for line in read_lines_from(f, 0, end):
+                    entry = parse_entry(line)
+                    if entry is not None:
+                        yield entry
+
+    def reverse_entries(self, batch=256, into_archive=None):
+        """Yields every entry newest first: the live log via its index, then the archive.
+
+        into_archive, if given, is called once the live log is exhausted; the
+        archive is only read if it returns true.
+        """
+        with self.lock:
+            live = open(HISTORY_FILE, 'rb')
+            offsets = self.offsets[:]
+            end = self.size
+            archive = open(HISTORY_ARCHIVE_FILE, 'rb') if self.archive_size else None
+            archive_end = self.archive_size
+        with live:
+            i = len(offsets)
+            while i > 0:
+                start = max(0, i - batch)
+                live.seek(offsets[start])
+                lines = live.read(end - offsets[start]).splitlines()
+                for line in reversed(lines):
+                    entry = parse_entry(line)
+                    if entry is not None:
+                        yield entry
+                end = offsets[start]
+                i = start
+        if archive is not None:
+            with archive:
+                if into_archive is not None and not into_archive():
+                    return
+                for line in read_lines_backward(archive, archive_end):
+                    entry = parse_entry(line)
+                    if entry is not None:
+                        yield entry
+
+    def compact(self):
+        """Moves older entries to the archive, leaving the newest that fit the target."""
+        try:
+            with self.lock:
+                fits = bisect.bisect_left(self.offsets, self.size - HISTORY_COMPACT_TARGET_BYTES)
+                keep_from = max(len(self.offsets) - HISTORY_KEEP_ENTRIES, fits)
+                if keep_from <= 0:
+                    return
+                cut = self.offsets[keep_from] if keep_from < len(self.offsets) else self.size
+                snapshot = self.size
+                self.sync()
+            print(f"Compacting history: archiving {keep_from} entries...")
+            archive_size = os.path.getsize(HISTORY_ARCHIVE_FILE) if os.path.exists(HISTORY_ARCHIVE_FILE) else 0
+            with open(HISTORY_COMPACT_MARKER, 'w', encoding='utf-8') as f:
+                json.dump({"inode": os.stat(HISTORY_FILE).st_ino, "archive_size": archive_size}, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Copy without the lock held; only entries appended meanwhile are
+            # copied under it.
+            temp_file = HISTORY_FILE + '.compact'
+            with open(HISTORY_FILE, 'rb') as src:
+                with open(HISTORY_ARCHIVE_FILE, 'ab') as archive:
+                    for line in read_lines_from(src, 0, cut):
+                        archive.write(line)
+                    archive.flush()
+                    os.fsync(archive.fileno())
+                with open(temp_file, 'wb') as out:
+                    for line in read_lines_from(src, cut, snapshot):
+                        out.write(line)
+                    with self.lock:
+                        for line in read_lines_from(src, snapshot, self.size):
+                            out.write(line)
+                        out.flush()
+                        os.fsync(out.fileno())
+                        os.replace(temp_file, HISTORY_FILE)
+                        self.archive_size = archive_size + cut
+                        self.f.close()
+                        self.f = open(HISTORY_FILE, 'ab')
+                        self.offsets = array('Q', (offset - cut for offset in self.offsets[keep_from:]))
+                        self.size -= cut
+                        self.pending = 0
+                        self.index_file.close()
+                        with open(HISTORY_INDEX_FILE + '.tmp', 'wb') as f:
+                            self.offsets.tofile(f)
+                        os.replace(HISTORY_INDEX_FILE + '.tmp', HISTORY_INDEX_FILE)
+                        self.index_file = open(HISTORY_INDEX_FILE, 'ab')
+            os.remove(HISTORY_COMPACT_MARKER)
+            print("History compaction finished.")
+        except Exception as e:
+            print(f"Error compacting history: {e}")
+        finally:
+            self.compactor = None
+
+    def close(self):
+        """Waits for a running compaction and syncs everything to disk."""
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            if self.f.closed:
+                return
+            self.sync()
+            self.f.close()
+            self.index_file.close()
+
+history_log = None
+
+def migrate_legacy_history():
+    """Converts an old airproject_history.json into the JSONL log."""
+    if not os.path.exists(LEGACY_HISTORY_FILE) or os.path.exists(HISTORY_FILE):
+        return
+    print(f"Migrating {LEGACY_HISTORY_FILE} to {HISTORY_FILE}...")
+    try:
+        with open(LEGACY_HISTORY_FILE, 'r', encoding='utf-8') as f:
+            history = json.load(f)
     except Exception as e:
-        print(f"Unexpected error while loading history: {e}")
+        print(f"Error: could not read {LEGACY_HISTORY_FILE} ({e}); leaving it in place.")
+        return
+    temp_file = f"{HISTORY_FILE}.temp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        for entry in history:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, HISTORY_FILE)
+    os.replace(LEGACY_HISTORY_FILE, LEGACY_HISTORY_FILE + '.migrated')
+    print(f"Migrated {len(history)} entries; the old file is kept as {LEGACY_HISTORY_FILE}.migrated.")
+
+def get_history_log():
+    """Opens the history log on first use, migrating an old JSON history if needed."""
+    global history_log
+    if history_log is None:
+        migrate_legacy_history()
+        history_log = HistoryLog()
+        atexit.register(history_log.close)
+    return history_log
+
+def load_pinned_entries():
+    """Reads the pinned history entries, oldest first."""
+    try:
+        with open(HISTORY_PINS_FILE, 'rb') as f:
+            entries = [parse_entry(line) for line in f]
+    except FileNotFoundError:
         return []
+    return [entry for entry in entries if entry is not None]
+
+def log_pinned_entry(entry):
+    """Records a pinned entry in the pins file as well as the main log."""
+    with open(HISTORY_PINS_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def as_api_message(entry):
+    """Strips a history entry down to the fields the API accepts."""
+    return {key: entry[key] for key in MESSAGE_KEYS if key in entry}
+
+def estimate_tokens(message):
+    """Rough token count of a message, at ~4 characters per token."""
+    return (len(json.dumps(message, ensure_ascii=False)) + 3) // 4
+
+def drop_unpaired_calls(messages):
+    """Removes function calls without a result.
+
+    Histories written before calls were logged hold results with no call
+    before them. Those are kept, as they were always sent, and counted.
+    """
+    paired = []
+    orphans = 0
+    for i, message in enumerate(messages):
+        if message['role'] == 'function':
+            call = paired[-1].get('function_call') if paired else None
+            if not call or call.get('name') != message.get('name'):
+                orphans += 1
+        elif message.get('function_call'):
+            if i + 1 >= len(messages) or messages[i + 1]['role'] != 'function':
+                continue
+        paired.append(message)
+    if orphans:
+        print(f"Kept {orphans} function results logged without their call (older history).")
+    return paired
+
+def load_history_window(max_turns=HISTORY_WINDOW_TURNS, token_budget=HISTORY_TOKEN_BUDGET):
+    """Returns the pinned turns plus the most recent complete turns that fit the budget, in order."""
+    print(f"Loading conversation history window from {HISTORY_FILE}...")
+    pins = load_pinned_entries()
+    unfound = {entry.get('timestamp'): entry for entry in pins}
+    # Every pinned message is sent, so the pins come off the budget first;
+    # the rest of a pinned turn is charged once the turn is found.
+    pin_costs = {entry.get('timestamp'): estimate_tokens(as_api_message(entry)) for entry in pins}
+    budget = token_budget - sum(pin_costs.values())
+
+    turns = []  # (messages, cost), newest first; the cost of a pinned turn is 0
+    turn = []
+    recent = 0
+    used = 0
+    window_full = False
+    in_archive = False
+
+    def into_archive():
+        # Past the live log, read on only while the window has room. Pinned
+        # turns not found by then are sent as just their pinned message.
+        nonlocal in_archive
+        in_archive = True
+        return not window_full
 
-def save_conversation_history(history):
-    """Saves the conversation history to the JSON file."""
-    temp_file = f"{HISTORY_FILE}.temp"
-    print(f"Saving conversation history to {HISTORY_FILE}...")
     try:
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=2)
-        # If successful, replace the original file
-        shutil.move(temp_file, HISTORY_FILE)
-        print("Conversation history saved successfully.")
+        for entry in get_history_log().reverse_entries(into_archive=into_archive):
+            if entry.get('role') == 'error':
+                continue
+            turn.append(as_api_message(entry))
+            if entry.get('role') != 'user':
+                continue
+            # A user message starts a turn: take the whole turn or none of it,
+            # so function calls and their results are never split. Pinned
+            # turns are always taken, in their place in the history.
+            cost = sum(estimate_tokens(message) for message in turn)
+            if entry.get('pinned') and entry.get('timestamp') in unfound:
+                del unfound[entry.get('timestamp')]
+                turns.append((turn[::-1], 0))
+                used += cost - pin_costs[entry.get('timestamp')]
+                # Found after the newer turns were taken: make room by giving
+                # back the oldest of them.
+                while used > budget and recent:
+                    oldest = max(i for i, (_, taken) in enumerate(turns) if taken)
+                    used -= turns.pop(oldest)[1]
+                    recent -= 1
+                    window_full = True
+            elif not window_full:
+                if used + cost > budget or recent >= max_turns:
+                    window_full = True
+                else:
+                    turns.append((turn[::-1], cost))
+                    used += cost
+                    recent += 1
+            turn = []
+            if window_full and (not unfound or in_archive):
+                break
     except Exception as e:
-        print(f"Error saving conversation history: {str(e)}")
-        # In case of error, remove the temporary file if it exists
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-            print(f"Temporary file {temp_file} removed due to error.")
+        print(f"Unexpected error while loading history: {e}")
+    # Unfound pins are older than everything read.
+    turns.extend(([as_api_message(entry)], 0) for entry in reversed(list(unfound.values())))
+
+    window = drop_unpaired_calls([message for turn, _ in reversed(turns) for message in turn])
+    print(f"Loaded {recent} recent and {len(turns) - recent} pinned turns "
+          f"({len(window)} messages, ~{used + sum(pin_costs.values())} tokens).")
+    return window
 
 def log_conversation(history, new_message):
     """Logs the conversation to the history."""
@@ -78,7 +500,12 @@ def log_conversation(history, new_message):
     new_entry.update(new_message)
     print("New entry:", new_entry)
     history.append(new_entry)
-    save_conversation_history(history)
+    try:
+        get_history_log().append(new_entry)
+        if new_entry.get('pinned'):
+            log_pinned_entry(new_entry)
+    except Exception as e:
+        print(f"Error saving conversation history: {str(e)}")
 
 def log_error(history, error_message):
     """Logs an error to the history."""
@@ -99,19 +526,19 @@ Use these functions to read and suggest modifications to the code as necessary b
 Your goal is to help improve the tool's code based on the user's input. Remember to maintain the code's existing functionality unless instructed otherwise."""
     print("System prompt initialized.")
 
-    # Load conversation history and get user input
-    history = load_conversation_history()
+    # Load a window of the conversation history and get user input
+    window = load_history_window()
+    history = []
     messages = [{'role': 'system', 'content': system_prompt}]
     print("System message added to messages.")
-    for msg in history:
-        if msg['role'] != 'error':
-            #messages.append({'role': msg['role'], 'content': msg['content']})
-            messages.append(msg)
-    print(f"Added {len(history)} historical messages to current messages.")
+    messages.extend(window)
+    print(f"Added {len(window)} historical messages to current messages.")
 
     user_input = get_user_input()
     new_message = {'role': 'user', 'content': user_input}
-    messages.append(new_message)
+    if user_input.startswith(PIN_PREFIX):
+        new_message = {'role': 'user', 'content': user_input[len(PIN_PREFIX):], 'pinned': True}
+    messages.append(as_api_message(new_message))
     log_conversation(history, new_message)
     print("User message appended to messages and logged.")
 
@@ -176,7 +603,9 @@ Your goal is to help improve the tool's code based on the user's input. Remember
 
         assistant_message = response['choices'][0]['message']
         messages.append(assistant_message)
-        print(f"Assistant message added to messages. Role: {assistant_message.get('role')}")
+        # Logged before any function runs, so its result is paired with it.
+        log_conversation(history, assistant_message)
+        print(f"Assistant message added to messages and logged. Role: {assistant_message.get('role')}")
 
         if assistant_message.get('function_call'):
             function_call = assistant_message['function_call']
@@ -218,7 +647,6 @@ Your goal is to help improve the tool's code based on the user's input. Remember
         else:
             # No function call, output the assistant's reply
             assistant_reply = assistant_message.get('content', '')
-            log_conversation(history, assistant_message)
             print("\nAssistant:", assistant_reply)
             print("No function call detected. Exiting the loop.")
             break  # Exit the loop
@@ -0,0 +1,267 @@
+"""Model providers behind one interface, and hedged requests across them.
+
+Requests and replies use the Anthropic Messages shape that airproject.py
+already builds: a list of system text blocks, messages whose content may hold
+tool_use/tool_result blocks, and ToolParam-style tools. A reply is a Message
+dict (content blocks, stop_reason, usage) plus the provider's name, the
+request latency and, from Anthropic, the response headers. Each Provider
+translates to and from its own API.
+
+hedged_request() sends one request to several providers:
+
+- "first": all start at once; the first successful reply wins and the
+  others are cancelled.
+- "hedge": providers start one after another, each once the previous one
+  has been running for its p95 latency, or straight away if it failed. The
+  first successful reply wins.
+- "all": waits for every provider and returns every reply, for comparison.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+
+HEDGE_MODES = ('first', 'hedge', 'all')
+DEFAULT_HEDGE_DELAY = 2.0
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 5
+OPENAI_STOP_REASONS = {'stop': 'end_turn', 'function_call': 'tool_use', 'length': 'max_tokens'}
+
+class ProviderError(Exception):
+    """Every provider failed; errors holds (provider name, exception) pairs."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(f"{name}: {error}" for name, error in errors) or "no providers")
+        self.errors = errors
+
+class LatencyTracker:
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=samples)
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    def p95(self, default=DEFAULT_HEDGE_DELAY):
+        if len(self.samples) < MIN_LATENCY_SAMPLES:
+            return default
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, round(0.95 * len(ordered)) - 1)]
+
+class Provider(ABC):
+    # Whether a trailing assistant message is continued (a prefill) rather
+    # than answered with a new one.
+    prefill = False
+
+    def __init__(self, model, name=None):
+        self.model = model
+        self.name = name or model
+        self.latency = LatencyTracker()
+
+    async def complete(self, request):
+        start = time.perf_counter()
+        reply = await self.send(request)
+        elapsed = time.perf_counter() - start
+        self.latency.observe(elapsed)
+        return {**reply, "provider": self.name, "latency": elapsed}
+
+    @abstractmethod
+    async def send(self, request):
+        """Sends request to the provider's API; returns the reply as a Message dict."""
+
+    async def close(self):
+        pass
+
+class AnthropicProvider(Provider):
+    prefill = True
+
+    def __init__(self, model, name=None, api_key=None, base_url=None):
+        super().__init__(model, name)
+        self.api_key = api_key or os.getenv('ANTHROPIC_API_KEY')
+        self.base_url = base_url or os.getenv('ANTHROPIC_BASE_URL')
+        self._client = None
+        self._client_loop = None
+
+    def client(self):
+        from anthropic import AsyncAnthropic
+        # An async client belongs to the event loop it was first used on.
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+            self._client_loop = loop
+        return self._client
+
+    async def send(self, request):
+        raw = await self.client().messages.with_raw_response.create(model=self.model, **request)
+        message = await raw.parse()
+        # The headers carry the rate-limit state for airproject's limiter.
+        return {**message.to_dict(), "headers": dict(raw.headers)}
+
+    async def close(self):
+        if self._client is not None and self._client_loop is asyncio.get_running_loop():
+            await self._client.close()
+        self._client = None
+
+class OpenAIProvider(Provider):
+    """Chat Completions with function calling, through the openai SDK that bs.py uses."""
+
+    def __init__(self, model, name=None, api_key=None, base_url=None):
+        super().__init__(model, name)
+        self.api_key = api_key or os.getenv('OPENAI_API_KEY')
+        self.base_url = base_url or os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+        self._session = None
+        self._session_loop = None
+
+    def session(self):
+        import aiohttp
+        # Without a session of its own, acreate() opens a new connection per
+        # request. Like AnthropicProvider's client, it belongs to one loop.
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession()
+            self._session_loop = loop
+        return self._session
+
+    async def send(self, request):
+        import openai
+        openai.aiosession.set(self.session())
+        options = dict(
+            model=self.model,
+            messages=to_openai_messages(request.get('system'), request['messages']),
+            max_tokens=request['max_tokens'],
+            api_key=self.api_key,
+            api_base=self.base_url,
+        )
+        if request.get('tools'):
+            options['functions'] = [{"name": tool['name'], "description": tool.get('description', ''),
+                                     "parameters": tool['input_schema']} for tool in request['tools']]
+        response = await openai.ChatCompletion.acreate(**options)
+        return from_openai_response(response, self.model)
+
+    async def close(self):
+        if self._session is not None and self._session_loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+
+def text_of(content):
+    if isinstance(content, str):
+        return content
+    return "".join(block.get('text', '') for block in content if block.get('type') == 'text')
+
+def to_openai_messages(system, messages):
+    converted = [{"role": "system", "content": text_of(system)}] if system else []
+    results = {}
+    for message in messages:
+        if message['role'] == 'user' and not isinstance(message['content'], str):
+            for block in message['content']:
+                if block.get('type') == 'tool_result':
+                    results[block['tool_use_id']] = block.get('content', '')
+    for message in messages:
+        content = message['content']
+        if message['role'] == 'user':
+            text = text_of(content)
+            if text:
+                converted.append({"role": "user", "content": text})
+            continue
+        text = text_of(content) or None
+        tool_uses = [] if isinstance(content, str) else [block for block in content
+                                                        if block.get('type') == 'tool_use']
+        if not tool_uses:
+            converted.append({"role": "assistant", "content": text})
+        # Function calling takes one call per assistant message, each followed
+        # by its result, so a turn with several tool_use blocks is unrolled.
+        for tool_use in tool_uses:
+            converted.append({"role": "assistant", "content": text, "function_call": {
+                "name": tool_use['name'], "arguments": json.dumps(tool_use['input'])}})
+            converted.append({"role": "function", "name": tool_use['name'],
+                              "content": text_of(results.get(tool_use['id'], ''))})
+            text = None
+    return converted
+
+def from_openai_response(response, model):
+    choice = response['choices'][0]
+    message = choice['message']
+    content = []
+    if message.get('content'):
+        content.append({"type": "text", "text": message['content']})
+    call = message.get('function_call')
+    if call:
+        try:
+            arguments = json.loads(call.get('arguments') or '{}')
+        except json.JSONDecodeError:
+            arguments = {}
+        content.append({"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}",
+                        "name": call['name'], "input": arguments})
+    usage = response.get('usage') or {}
+    return {
+        "id": response.get('id', ''),
+        "type": "message",
+        "role": "assistant",
+        "model": response.get('model') or model,
+        "content": content,
+        "stop_reason": 'tool_use' if call else OPENAI_STOP_REASONS.get(choice.get('finish_reason'), 'end_turn'),
+        "stop_sequence": None,
+        "usage": {"input_tokens": usage.get('prompt_tokens', 0),
+                  "output_tokens": usage.get('completion_tokens', 0)},
+    }
+
+def make_provider(config):
+    """Builds a provider from a settings entry such as {"type": "openai", "model": "gpt-4o"}."""
+    kinds = {'anthropic': AnthropicProvider, 'openai': OpenAIProvider}
+    if config.get('type') not in kinds:
+        raise ValueError(f"Unknown provider type {config.get('type')!r}; expected one of {', '.join(kinds)}")
+    api_key = os.getenv(config['api_key_env']) if config.get('api_key_env') else None
+    return kinds[config['type']](config['model'], name=config.get('name'),
+                                 api_key=api_key, base_url=config.get('base_url'))
+
+async def hedged_request(providers, request, mode='first', hedge_delay=None):
+    """Sends request to providers as mode says.
+
+    Returns the winning reply, or for "all" a list with a reply or exception
+    per provider. Raises ProviderError if every provider failed.
+    """
+    if mode not in HEDGE_MODES:
+        raise ValueError(f"Unknown hedge mode {mode!r}; expected one of {', '.join(HEDGE_MODES)}")
+    if mode == 'all':
+        results = await asyncio.gather(*(provider.complete(request) for provider in providers),
+                                       return_exceptions=True)
+        if all(isinstance(result, BaseException) for result in results):
+            raise ProviderError([(provider.name, result) for provider, result in zip(providers, results)])
+        return results
+
+    waiting = deque(providers)
+    running = {}
+    errors = []
+
+    def launch():
+        provider = waiting.popleft()
+        running[asyncio.ensure_future(provider.complete(request))] = provider
+        return provider
+
+    last = launch()
+    while mode == 'first' and waiting:
+        launch()
+    try:
+        while running:
+            timeout = None
+            if waiting:
+                timeout = hedge_delay if hedge_delay is not None else last.latency.p95()
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                last = launch()  # the running ones are slow: hedge
+                continue
+            for task in done:
+                provider = running.pop(task)
+                if task.exception() is None:
+                    return task.result()
+                errors.append((provider.name, task.exception()))
+            if waiting:
+                last = launch()  # fail over without waiting out the delay
+        raise ProviderError(errors)
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
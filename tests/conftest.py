@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """An initialized, empty project as the working directory."""
+    (tmp_path / 'conversations').mkdir()
+    (tmp_path / '.aiproject.json').write_text('{"project_name": "test"}')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
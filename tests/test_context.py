@@ -0,0 +1,36 @@
+import json
+from types import SimpleNamespace
+
+from click.testing import CliRunner
+
+import airproject
+
+def tool_round(n, output):
+    call = {"type": "tool_use", "id": f"toolu_{n}", "name": "read_file", "input": {"filename": f"{n}.txt"}}
+    result = {"type": "tool_result", "tool_use_id": f"toolu_{n}", "content": output}
+    return [{"role": "assistant", "content": [call]}, {"role": "user", "content": [result]}]
+
+def test_stats_report_savings_once(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 5000 if name == 'context_token_budget' else default)
+    messages = [{"role": "user", "content": "Go."}]
+    for n in range(10):
+        messages += tool_round(n, "x" * 4000)
+    session = SimpleNamespace(messages=messages, delivered={})
+    window = airproject.ContextWindow(messages)
+    window.before_request(session)
+    first = window.stats()
+    assert first['compactions'] == 1 and first['tokens_saved'] > 0
+    assert first['estimated_tokens'] <= 5000 * airproject.COMPACT_TARGET
+    # The next turn only reports compaction that happened after this one.
+    assert window.stats()['compactions'] == 0
+
+def test_stats_command_shows_compaction(project):
+    (project / '.aiproject').mkdir()
+    record = {"ts": "2026-01-01T00:00:00.000", "file": "c.md", "round": 0, "latency_ms": 100.0,
+              "input_tokens": 10, "output_tokens": 5, "stop_reason": "end_turn", "tools": [],
+              "context": {"prompt_tokens": 9000, "estimated_tokens": 9100, "budget": 10000,
+                          "compactions": 1, "tokens_saved": 4000}}
+    (project / airproject.TELEMETRY_FILE).write_text(json.dumps(record) + "\n")
+    result = CliRunner().invoke(airproject.cli, ['stats'])
+    assert "1 compaction(s), ~4000 tokens saved" in result.output
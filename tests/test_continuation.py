@@ -0,0 +1,80 @@
+import contextlib
+import io
+
+import pytest
+
+import airproject
+from mock_api import MockMessagesAPI
+
+def text(value):
+    return {"type": "text", "text": value}
+
+def tool_use(n, **tool_input):
+    return {"type": "tool_use", "id": f"toolu_{n}", "name": "write_file", "input": tool_input}
+
+@pytest.fixture
+def submit(project, monkeypatch):
+    """Runs a submit of conversations/c.md against a scripted mock API; returns the request bodies."""
+    (project / 'conversations' / 'c.md').write_text("## User\n\nGo.\n")
+    monkeypatch.setattr(airproject, '_output_budget', None)
+    monkeypatch.setattr(airproject, '_response_cache_total', None)
+    monkeypatch.setattr(airproject, 'ANTHROPIC_API_KEY', 'mock')
+    servers = []
+
+    def run(script, stream=False, cache=None):
+        api = MockMessagesAPI(script=script)
+        bodies = []
+        respond = api.respond
+        api.respond = lambda body: bodies.append(body) or respond(body)
+        servers.append(api)
+        api.start()
+        monkeypatch.setenv('ANTHROPIC_BASE_URL', api.base_url)
+        with contextlib.redirect_stdout(io.StringIO()):
+            airproject.run_async(airproject.run_session(airproject.open_session('c.md', cache=cache), stream))
+        return bodies
+
+    yield run
+    for api in servers:
+        api.stop()
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_non_streaming_max_tokens_is_capped(submit, stream):
+    cut = {"content": [text("Writing it."), tool_use(1)], "stop_reason": "max_tokens"}
+    bodies = submit([cut] * 4 + [{"content": [text("Done.")], "stop_reason": "end_turn"}], stream)
+    limit = airproject.DEFAULT_MAX_OUTPUT_TOKENS if stream else airproject.NON_STREAMING_MAX_TOKENS
+    assert [body['max_tokens'] for body in bodies] == [4096, 8192, 16384, limit, limit]
+
+def test_cut_off_retry_is_not_served_from_the_cache(submit):
+    # Nothing to prefill, so the retry differs from the first request only in max_tokens.
+    cut = {"content": [tool_use(1)], "stop_reason": "max_tokens"}
+    cache = airproject.open_response_cache(True, False)
+    bodies = submit([cut, {"content": [text("Done.")], "stop_reason": "end_turn"}], cache=cache)
+    assert [body['max_tokens'] for body in bodies] == [4096, 8192]
+
+def test_cut_off_tool_call_is_never_run(submit, project):
+    (project / '.aiproject.json').write_text('{"project_name": "test", "max_continuations": 1}')
+    cut = {"content": [text("Writing it."), tool_use(1, filename="out.txt", content="partial")],
+           "stop_reason": "max_tokens"}
+    bodies = submit([cut, cut, {"content": [text("Unreachable.")], "stop_reason": "end_turn"}])
+    assert len(bodies) == 2
+    assert not (project / 'conversations' / 'out.txt').exists()
+
+def conversation(project):
+    return (project / 'conversations' / 'c.md').read_text()
+
+def test_continuation_starts_after_trimmed_text(submit, project):
+    bodies = submit([{"content": [text("Part one.\n\n")], "stop_reason": "max_tokens"},
+                     {"content": [text(" Part two.")], "stop_reason": "end_turn"}])
+    assert bodies[1]['messages'][-1] == {"role": "assistant", "content": [text("Part one.")]}
+    assert "Part one. Part two." in conversation(project)
+
+def test_text_after_a_tool_call_is_not_repeated(submit, project):
+    call = tool_use(1, filename="out.txt", content="x")
+    bodies = submit([{"content": [text("Writing it."), call, text("Then I will")], "stop_reason": "max_tokens"},
+                     {"content": [call, text(" Then I will check it.")], "stop_reason": "tool_use"},
+                     {"content": [text("Done.")], "stop_reason": "end_turn"}])
+    # The prefill stops before the tool call; the rest of the turn is asked for again.
+    assert bodies[1]['messages'][-1] == {"role": "assistant", "content": [text("Writing it.")]}
+    assert bodies[1]['max_tokens'] == bodies[0]['max_tokens']
+    assert conversation(project).count("Then I will") == 1
+    assert (project / 'conversations' / 'out.txt').read_text() == "x"
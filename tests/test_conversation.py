@@ -0,0 +1,61 @@
+import airproject
+
+def write(project, text, name='c.md'):
+    (project / 'conversations' / name).write_bytes(text.encode())
+
+def parse(name='c.md'):
+    return [(m['role'], m['content']) for m in
+            airproject.parse_conversation(f'conversations/{name}', name)]
+
+def test_sections(project):
+    write(project, "# c\n\n## User\n\nHi.\n\n## Assistant\nTimestamp: 2026-01-01 00:00:00\n\nHello.\n\n## User\n\nMore.\n")
+    # The preamble before the first header is user text too.
+    assert parse() == [('user', "# c\n\nHi."), ('assistant', "Hello."), ('user', "More.")]
+
+def test_header_inside_fence_is_content(project):
+    text = ("## User\n\nWhat does this print?\n\n```markdown\n## User\n## Assistant\n```\n\n"
+            "~~~~\n## User\n~~~\nstill fenced\n~~~~\n")
+    write(project, text)
+    messages = parse()
+    assert len(messages) == 1
+    assert "## Assistant\n```" in messages[0][1]
+    assert messages[0][1].endswith("still fenced\n~~~~")
+
+def test_written_header_closes_unterminated_fence(project):
+    write(project, "## User\n\nGo.\n\n## Assistant\nTimestamp: 2026-01-01 00:00:00\n\n```python\nprint(1)\n"
+                   "\n\n## Assistant\nTimestamp: 2026-01-01 00:00:01\n\nDone.\n")
+    assert [role for role, _ in parse()] == ['user', 'assistant']
+    assert parse()[1][1].endswith("Done.")
+
+def test_resubmit_scans_only_the_tail(project, monkeypatch):
+    body = "## User\n\n" + "x" * 100000 + "\n\n## Assistant\nTimestamp: 2026-01-01 00:00:00\n\nOk.\n"
+    write(project, body)
+    parse()
+    with open('conversations/c.md', 'a') as f:
+        f.write("\n## User\n\nNext.\n")
+    scanned = []
+    find_headers = airproject.find_headers
+    monkeypatch.setattr(airproject, 'find_headers', lambda data, start: scanned.append(len(data))
+                        or find_headers(data, start))
+    messages = parse()
+    assert [role for role, _ in messages] == ['user', 'assistant', 'user']
+    assert messages[-1][1] == "Next."
+    # The last indexed section and what follows it; never the 100 KB user turn.
+    assert sum(scanned) < 200
+    # The index holds offsets and hashes, not a copy of the text.
+    assert (project / airproject.conversation_index_path('c.md')).stat().st_size < 1000
+
+def test_same_length_edit_is_seen(project):
+    turns = "".join(f"## User\n\nQuestion {i}.{' pad' * 200}\n\n## Assistant\nTimestamp: 2026-01-01 00:00:00"
+                    f"\n\nAnswer {i}.\n\n" for i in range(20))
+    write(project, turns.replace("Answer 7.", "Use the BLUE theme."))
+    parse()
+    write(project, turns.replace("Answer 7.", "Use the PINK theme.") + "## User\n\nNext.\n")
+    texts = [text for _, text in parse()]
+    assert "Use the PINK theme." in texts and "Use the BLUE theme." not in texts
+
+def test_edited_prefix_is_rescanned(project):
+    write(project, "## User\n\nOne.\n\n## Assistant\nTimestamp: 2026-01-01 00:00:00\n\nTwo.\n")
+    parse()
+    write(project, "## User\n\nOne, edited.\n\n## Assistant\nTimestamp: 2026-01-01 00:00:00\n\nTwo.\n\n## User\n\nThree.\n")
+    assert parse() == [('user', "One, edited."), ('assistant', "Two."), ('user', "Three.")]
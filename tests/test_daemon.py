@@ -0,0 +1,23 @@
+import asyncio
+import io
+import json
+
+import airproject
+
+def test_output_from_worker_threads_reaches_the_client(monkeypatch):
+    daemon_out, conn = io.StringIO(), io.BytesIO()
+    monkeypatch.setattr('sys.stdout', airproject.DaemonStdout(daemon_out))
+
+    async def submit():
+        await asyncio.to_thread(airproject.click.echo, "from a worker thread")
+        airproject.click.echo("from the event loop")
+
+    client = airproject._daemon_client.set(conn)
+    try:
+        asyncio.run(submit())
+    finally:
+        airproject._daemon_client.reset(client)
+    airproject.click.echo("from the daemon")
+    lines = [json.loads(line)['out'] for line in conn.getvalue().splitlines()]
+    assert "".join(lines) == "from a worker thread\nfrom the event loop\n"
+    assert daemon_out.getvalue() == "from the daemon\n"
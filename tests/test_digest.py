@@ -0,0 +1,32 @@
+import os
+
+import airproject
+
+def test_index_rereads_only_files_whose_stat_changed(project, monkeypatch):
+    for n in range(5):
+        (project / 'conversations' / f"{n}.py").write_text(f"def f{n}():\n    pass\n")
+    read = []
+    fingerprint = airproject.fingerprint_file
+    monkeypatch.setattr(airproject, 'fingerprint_file', lambda path: read.append(path) or fingerprint(path))
+    airproject.update_project_index()
+    assert len(read) == 5
+
+    read.clear()
+    assert airproject.update_project_index()['0.py']['summary'] == "f0"
+    assert read == []
+
+    (project / 'conversations' / '1.py').write_text("def renamed():\n    pass\n")
+    stat = (project / 'conversations' / '2.py').stat()
+    os.utime(project / 'conversations' / '2.py', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    files = airproject.update_project_index()
+    assert sorted(read) == [os.path.join('conversations', '1.py'), os.path.join('conversations', '2.py')]
+    assert files['1.py']['summary'] == "renamed" and files['2.py']['summary'] == "f2"
+
+def test_digest_stays_within_its_token_budget():
+    files = {f"src/module_{n:03}.py": {"size": 1000, "summary": "load; save; render; parse"} for n in range(300)}
+    for budget in (100, 150, 500, 2000):
+        digest = airproject.build_project_digest(files, budget)
+        assert airproject.estimate_tokens(digest) <= budget, budget
+        assert "more files not shown" in digest
+    everything = airproject.build_project_digest(files, 10**6)
+    assert "more files not shown" not in everything and everything.count("\n- ") == 300
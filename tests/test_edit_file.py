@@ -0,0 +1,62 @@
+import pytest
+
+import airproject
+
+def numbered(count):
+    return "".join(f"line {i}\n" for i in range(1, count + 1))
+
+def test_hunk_is_found_when_line_numbers_are_off():
+    patch = "--- a/f.txt\n+++ b/f.txt\n@@ -2,3 +2,3 @@\n line 6\n-line 7\n+seven\n line 8\n"
+    result, hunks = airproject.apply_patch(numbered(10), patch)
+    assert hunks == 1
+    assert result == numbered(10).replace("line 7\n", "seven\n")
+
+def test_later_hunks_follow_the_shift_of_earlier_ones():
+    patch = "@@ -1,1 +1,2 @@\n line 1\n+inserted\n@@ -5,1 +6,1 @@\n-line 5\n+five\n"
+    result, _ = airproject.apply_patch(numbered(6), patch)
+    assert result == "line 1\ninserted\nline 2\nline 3\nline 4\nfive\nline 6\n"
+
+def test_crlf_endings_are_kept():
+    result, _ = airproject.apply_patch("a\r\nb\r\nc\r\n", "@@ -2 +2,2 @@\n-b\n+B\n+B2\n")
+    assert result == "a\r\nB\r\nB2\r\nc\r\n"
+
+def test_insert_after_a_line():
+    result, _ = airproject.apply_patch("a\nb\n", "@@ -1,0 +2 @@\n+x\n")
+    assert result == "a\nx\nb\n"
+
+def test_missing_final_newline_is_added():
+    patch = "@@ -1,2 +1,3 @@\n a\n-b\n\\ No newline at end of file\n+b\n+c\n"
+    result, _ = airproject.apply_patch("a\nb", patch)
+    assert result == "a\nb\nc\n"
+
+def test_final_newline_is_removed():
+    patch = "@@ -2 +2 @@\n-b\n+b\n\\ No newline at end of file\n"
+    result, _ = airproject.apply_patch("a\nb\n", patch)
+    assert result == "a\nb"
+
+def test_mismatched_hunk_is_an_error():
+    with pytest.raises(airproject.EditError, match="hunk 1 does not match"):
+        airproject.apply_patch(numbered(3), "@@ -2 +2 @@\n-line 9\n+nine\n")
+
+def test_malformed_patches_are_errors():
+    with pytest.raises(airproject.EditError, match="no @@ hunks"):
+        airproject.parse_hunks("--- a/f.txt\n+++ b/f.txt\n")
+    with pytest.raises(airproject.EditError, match="not context"):
+        airproject.parse_hunks("@@ -1 +1 @@\n*line 1\n")
+
+def test_find_hunk_prefers_the_nearest_match():
+    lines = ["x", "y", "x", "y", "x"]
+    assert airproject.find_hunk(lines, ["x"], 3, 0) == 2
+    assert airproject.find_hunk(lines, ["x"], 3, 3) == 4
+    assert airproject.find_hunk(lines, ["z"], 0, 0) is None
+
+def test_replacements_match_crlf_files():
+    result, count = airproject.apply_replacements("a\r\nb\r\nc\r\n", [{"old_text": "a\nb", "new_text": "x\ny"}])
+    assert (result, count) == ("x\r\ny\r\nc\r\n", 1)
+
+def test_failed_patch_leaves_the_file(project):
+    path = project / 'conversations' / 'f.txt'
+    path.write_text(numbered(3))
+    result = airproject.edit_file('f.txt', patch="@@ -1 +1 @@\n-line 1\n+one\n@@ -3 +3 @@\n-nope\n+three\n")
+    assert result.startswith("Error: Could not edit 'f.txt': hunk 2")
+    assert path.read_text() == numbered(3)
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import airproject
+from providers import Provider
+
+class FakeProvider(Provider):
+    def __init__(self, name, failures=(), replies=()):
+        super().__init__(name)
+        self.failures = list(failures)
+        self.replies = list(replies)
+        self.loops = []
+        self.requests = []
+        self.closed = 0
+
+    async def send(self, request):
+        self.loops.append(asyncio.get_running_loop())
+        self.requests.append(request)
+        if self.failures:
+            raise self.failures.pop(0)
+        text, stop_reason = self.replies.pop(0) if self.replies else ("Hi.", "end_turn")
+        return {"id": "msg_1", "type": "message", "role": "assistant", "model": self.model,
+                "content": [{"type": "text", "text": text}], "stop_reason": stop_reason,
+                "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 2},
+                "headers": {}}
+
+    async def close(self):
+        self.closed += 1
+
+class Unavailable(Exception):
+    http_status = 503
+    headers = {}
+
+@pytest.fixture
+def hedged(project, monkeypatch):
+    (project / 'conversations' / 'c.md').write_text("## User\n\nHello.\n")
+    monkeypatch.setattr(airproject, 'BACKOFF_BASE', 0.0)
+    def use(*providers):
+        monkeypatch.setattr(airproject, '_providers', list(providers))
+        session = airproject.open_session('c.md', hedge_mode='first')
+        return session, session.request_params(False)
+    return use
+
+def test_rounds_share_one_loop(hedged):
+    provider = FakeProvider('a')
+    session, params = hedged(provider)
+
+    async def two_rounds():
+        await airproject.hedged_reply(session, params)
+        await airproject.hedged_reply(session, params)
+
+    airproject.run_async(two_rounds())
+    assert len(provider.loops) == 2 and provider.loops[0] is provider.loops[1]
+    assert provider.closed == 1 and provider.loops[0].is_closed()
+    session.close()
+
+def test_retries_when_every_provider_failed(hedged):
+    provider = FakeProvider('a', failures=[Unavailable("overloaded")])
+    session, params = hedged(provider)
+    reply = airproject.run_async(airproject.hedged_reply(session, params))
+    assert reply['provider'] == 'a'
+    assert session.timing['retries'] == 1
+    session.close()
+
+def test_permanent_failure_is_not_retried(hedged):
+    from providers import ProviderError
+    provider = FakeProvider('a', failures=[ValueError("bad request")])
+    session, params = hedged(provider)
+    with pytest.raises(ProviderError):
+        airproject.run_async(airproject.hedged_reply(session, params))
+    assert len(provider.loops) == 1
+    session.close()
+
+def test_turn_is_asked_again_without_prefill(hedged, project):
+    provider = FakeProvider('a', replies=[("Half an ans", "max_tokens"), ("A whole answer.", "end_turn")])
+    session, _ = hedged(provider)
+    airproject.run_async(airproject.run_session(session, False))
+    first, second = provider.requests
+    assert second['messages'][-1]['role'] == 'user'
+    assert second['max_tokens'] == 2 * first['max_tokens']
+    text = (project / 'conversations' / 'c.md').read_text()
+    assert "Half an ans" not in text and text.count("A whole answer.") == 1
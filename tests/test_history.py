@@ -0,0 +1,144 @@
+import json
+import os
+
+import pytest
+
+import bs
+
+def entry(n):
+    return {"role": "user", "content": f"message {n} " + "x" * 80}
+
+def read_log():
+    with open(bs.HISTORY_FILE, 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    """Runs in an empty directory with no history log open; returns a log opener."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bs, 'history_log', None)
+    logs = []
+
+    def open_log():
+        logs.append(bs.HistoryLog())
+        return logs[-1]
+
+    yield open_log
+    for log in logs + [bs.history_log]:
+        if log is not None:
+            log.close()
+
+def test_torn_last_line_is_cut(history):
+    lines = [json.dumps(entry(n)) + '\n' for n in range(2)]
+    with open(bs.HISTORY_FILE, 'w') as f:
+        f.write(''.join(lines) + '{"role": "user", "cont')
+    log = history()
+    assert len(log) == 2
+    assert read_log() == ''.join(lines).encode()
+    log.append(entry(2))
+    assert list(log.entries()) == [entry(n) for n in range(3)]
+
+def test_interrupted_compaction_is_rolled_back(history):
+    log = history()
+    for n in range(3):
+        log.append(entry(n))
+    log.close()
+    archived = (json.dumps(entry(-1)) + '\n').encode()
+    with open(bs.HISTORY_ARCHIVE_FILE, 'wb') as f:
+        f.write(archived)
+    # A crash after copying entries to the archive, before the live log was replaced.
+    with open(bs.HISTORY_COMPACT_MARKER, 'w') as f:
+        json.dump({"inode": os.stat(bs.HISTORY_FILE).st_ino, "archive_size": len(archived)}, f)
+    with open(bs.HISTORY_ARCHIVE_FILE, 'ab') as f:
+        f.write(read_log()[:100])
+    with open(bs.HISTORY_FILE + '.compact', 'wb') as f:
+        f.write(b'partial')
+
+    log = history()
+    with open(bs.HISTORY_ARCHIVE_FILE, 'rb') as f:
+        assert f.read() == archived
+    assert not os.path.exists(bs.HISTORY_COMPACT_MARKER)
+    assert not os.path.exists(bs.HISTORY_FILE + '.compact')
+    assert list(log.entries()) == [entry(n) for n in range(-1, 3)]
+
+def test_compaction_archives_older_entries(history, monkeypatch):
+    monkeypatch.setattr(bs, 'HISTORY_COMPACT_BYTES', 2000)
+    monkeypatch.setattr(bs, 'HISTORY_COMPACT_TARGET_BYTES', 1000)
+    monkeypatch.setattr(bs, 'HISTORY_KEEP_ENTRIES', 5)
+    log = history()
+    for n in range(50):
+        log.append(entry(n))
+    log.close()
+    assert os.path.getsize(bs.HISTORY_ARCHIVE_FILE) > 0
+
+    log = history()
+    assert len(log) < 50
+    expected = [entry(n) for n in range(50)]
+    assert list(log.entries()) == expected
+    assert list(log.reverse_entries(batch=3)) == expected[::-1]
+    assert log.tail(2) == expected[-2:]
+
+def test_function_calls_are_logged_with_their_results(history, monkeypatch):
+    with open('a.txt', 'w') as f:
+        f.write("contents")
+    call = {"role": "assistant", "content": None,
+            "function_call": {"name": "read_file", "arguments": '{"filename": "a.txt"}'}}
+    replies = iter([call, {"role": "assistant", "content": "Done."}])
+    monkeypatch.setattr(bs, 'get_user_input', lambda: "Read a.txt.")
+    monkeypatch.setattr(bs.openai.ChatCompletion, 'create',
+                        lambda **params: {"choices": [{"message": next(replies)}]})
+    bs.main()
+    window = bs.load_history_window()
+    assert [message['role'] for message in window] == ['user', 'assistant', 'function', 'assistant']
+    assert window[1]['function_call'] == call['function_call']
+    assert window[2]['content'] == "contents"
+
+def test_results_without_a_logged_call_are_kept(history):
+    bs.log_conversation([], {"role": "user", "content": "Read a.txt."})
+    bs.log_conversation([], {"role": "function", "name": "read_file", "content": "contents"})
+    bs.log_conversation([], {"role": "assistant", "content": "Done."})
+    bs.log_conversation([], {"role": "user", "content": "Write b.txt."})
+    bs.log_conversation([], {"role": "assistant", "content": None,
+                             "function_call": {"name": "write_file", "arguments": "{}"}})
+    window = bs.load_history_window()
+    assert [message['role'] for message in window] == ['user', 'function', 'assistant', 'user']
+
+def log_turn(n, pinned=False, result_size=0):
+    message = {"role": "user", "content": f"question {n}", "timestamp": f"t{n}"}
+    if pinned:
+        message['pinned'] = True
+        bs.log_pinned_entry(message)
+    bs.get_history_log().append(message)
+    if result_size:
+        bs.get_history_log().append({"role": "assistant", "content": None,
+                                     "function_call": {"name": "read_file", "arguments": "{}"}})
+        bs.get_history_log().append({"role": "function", "name": "read_file", "content": "x" * result_size})
+    bs.get_history_log().append({"role": "assistant", "content": f"answer {n}"})
+
+def test_pins_missing_from_the_live_log_do_not_scan_the_archive(history, monkeypatch):
+    monkeypatch.setattr(bs, 'HISTORY_COMPACT_BYTES', 3000)
+    monkeypatch.setattr(bs, 'HISTORY_COMPACT_TARGET_BYTES', 1500)
+    log_turn(0, pinned=True)
+    for n in range(1, 60):
+        log_turn(n)
+    bs.get_history_log().close()
+    bs.history_log = None
+    assert os.path.getsize(bs.HISTORY_ARCHIVE_FILE) > 0
+
+    def no_archive(*args):
+        raise AssertionError("read the archive")
+    monkeypatch.setattr(bs, 'read_lines_backward', no_archive)
+    window = bs.load_history_window(max_turns=3)
+    assert window[0] == {"role": "user", "content": "question 0"}
+    assert [message['content'] for message in window[1:]] == [
+        "question 57", "answer 57", "question 58", "answer 58", "question 59", "answer 59"]
+
+def test_pinned_turns_count_against_the_budget(history):
+    log_turn(0, pinned=True, result_size=2000)  # ~500 tokens
+    for n in range(1, 20):
+        log_turn(n)
+    window = bs.load_history_window(token_budget=700)
+    recent = [message for message in window if message['role'] == 'user'][1:]
+    assert window[0]['content'] == "question 0" and window[2]['role'] == 'function'
+    assert sum(bs.estimate_tokens(message) for message in window) <= 700
+    assert 0 < len(recent) < 19
@@ -0,0 +1,107 @@
+import contextlib
+import io
+
+import pytest
+
+import airproject
+from mock_api import MockMessagesAPI
+
+class Crash(BaseException):
+    """Stands in for the process being killed."""
+
+def text(value):
+    return {"type": "text", "text": value}
+
+def write_call(n, filename, content):
+    return {"type": "tool_use", "id": f"toolu_{n}", "name": "write_file",
+            "input": {"filename": filename, "content": content}}
+
+@pytest.fixture
+def submit(project, monkeypatch):
+    """Runs a submit of conversations/c.md against a scripted mock API; returns the request bodies."""
+    (project / 'conversations' / 'c.md').write_text("## User\n\nGo.\n")
+    monkeypatch.setattr(airproject, '_output_budget', None)
+    monkeypatch.setattr(airproject, 'ANTHROPIC_API_KEY', 'mock')
+    servers = []
+
+    def run(script, output=None):
+        api = MockMessagesAPI(script=script)
+        bodies = []
+        respond = api.respond
+        api.respond = lambda body: bodies.append(body) or respond(body)
+        servers.append(api)
+        api.start()
+        monkeypatch.setenv('ANTHROPIC_BASE_URL', api.base_url)
+        with contextlib.redirect_stdout(output or io.StringIO()):
+            session = airproject.open_session('c.md')
+            if session is not None:
+                airproject.run_async(airproject.run_session(session, True))
+        return bodies
+
+    yield run
+    for api in servers:
+        api.stop()
+
+def conversation(project):
+    return (project / 'conversations' / 'c.md').read_text()
+
+def crash_before_message_is_journaled(monkeypatch):
+    # The whole reply is in the file, but the process dies before the turn
+    # is journaled as complete: the same state as a kill mid-stream.
+    def end_turn(session, message):
+        raise Crash()
+    monkeypatch.setattr(airproject.Session, 'end_turn', end_turn)
+
+def test_kill_mid_stream_cuts_the_partial_turn_and_resends(submit, project, monkeypatch):
+    with monkeypatch.context() as patch:
+        crash_before_message_is_journaled(patch)
+        with pytest.raises(Crash):
+            submit([{"content": [text("Half an answer")]}])
+    assert "Half an answer" in conversation(project)
+
+    bodies = submit([{"content": [text("The whole answer.")]}])
+    assert len(bodies) == 1 and len(bodies[0]['messages']) == 1
+    assert "Half an answer" not in conversation(project)
+    assert conversation(project).count("## Assistant") == 1
+    assert "The whole answer." in conversation(project)
+    assert not (project / airproject.JOURNAL_DIR / 'c.md.jsonl').exists()
+
+def test_resume_runs_only_the_missing_tools(submit, project, monkeypatch):
+    calls = [write_call(1, "a.txt", "A"), write_call(2, "b.txt", "B")]
+    record = airproject.Session.record_tool_result
+
+    def record_then_crash(session, tool_result):
+        record(session, tool_result)
+        raise Crash()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(airproject.Session, 'record_tool_result', record_then_crash)
+        with pytest.raises(Crash):
+            submit([{"content": [text("Writing."), *calls], "stop_reason": "tool_use"}])
+
+    ran = []
+    handle = airproject.handle_tool_use
+    monkeypatch.setattr(airproject, 'handle_tool_use',
+                        lambda tool_call, session=None: ran.append(tool_call.id) or handle(tool_call, session))
+    output = io.StringIO()
+    bodies = submit([{"content": [text("Done.")]}], output)
+    assert ran == ["toolu_2"]
+    assert "reusing 1 tool result(s), running 1" in output.getvalue()
+    results = bodies[0]['messages'][-1]['content']
+    assert [result['tool_use_id'] for result in results] == ["toolu_1", "toolu_2"]
+    assert conversation(project).count("## Assistant") == 2
+
+def test_edited_conversation_starts_fresh_without_truncating(submit, project, monkeypatch):
+    with monkeypatch.context() as patch:
+        crash_before_message_is_journaled(patch)
+        with pytest.raises(Crash):
+            submit([{"content": [text("Half an answer")]}])
+    with open(project / 'conversations' / 'c.md', 'a') as f:
+        f.write("\n\n## User\n\nNever mind that.\n")
+    edited = conversation(project)
+
+    output = io.StringIO()
+    bodies = submit([{"content": [text("Fresh answer.")]}], output)
+    assert "Conversation changed since the interrupted submit" in output.getvalue()
+    assert conversation(project).startswith(edited)
+    assert bodies[0]['messages'][-1]['content'][-1]['text'] == "Never mind that."
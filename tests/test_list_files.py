@@ -0,0 +1,51 @@
+import json
+import os
+
+import airproject
+
+def paths(listing):
+    return [entry['path'] for entry in listing['files']]
+
+def touch(project, *names):
+    for name in names:
+        path = project / 'conversations' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+
+def test_gitignore_negation(project):
+    touch(project, 'a.log', 'keep.log', 'b.txt', 'sub/c.log', 'sub/d.log')
+    (project / '.gitignore').write_text("*.log\n!keep.log\n")
+    (project / 'conversations' / 'sub' / '.gitignore').write_text("!d.log\n")
+    assert paths(airproject.list_files()) == ['b.txt', 'keep.log', 'sub/d.log']
+
+def test_cursor_is_stable_across_pages(project):
+    touch(project, *(f"{n}.txt" for n in range(6)))
+    first = airproject.list_files(limit=3)
+    assert paths(first) == ['0.txt', '1.txt', '2.txt'] and first['next_cursor'] == '2.txt'
+    # Files added or removed before the cursor neither repeat nor skip entries.
+    os.remove(project / 'conversations' / '1.txt')
+    touch(project, '00.txt', '4a.txt')
+    second = airproject.list_files(cursor=first['next_cursor'], limit=3)
+    assert paths(second) == ['3.txt', '4.txt', '4a.txt']
+    assert paths(airproject.list_files(cursor=second['next_cursor'], limit=3)) == ['5.txt']
+
+def test_limit_is_clamped(project):
+    (project / '.aiproject.json').write_text('{"project_name": "test", "max_list_limit": 4}')
+    touch(project, *(f"{n}.txt" for n in range(6)))
+    assert paths(airproject.list_files(limit=-2)) == ['0.txt']
+    assert len(airproject.list_files(limit=10**9)['files']) == 4
+
+def test_snapshot_is_reused_until_the_directory_changes(project):
+    touch(project, 'sub/a.txt')
+    airproject.list_files()
+    snapshot_path = project / airproject.TREE_SNAPSHOT
+    snapshot = json.loads(snapshot_path.read_text())
+    mtime, children = snapshot['conversations/sub']
+    # A planted entry proves the cached listing is used while the mtime holds.
+    snapshot['conversations/sub'] = [mtime, children + [['ghost.txt', False]]]
+    snapshot_path.write_text(json.dumps(snapshot))
+    assert airproject.walk_tree() == ['sub/a.txt', 'sub/ghost.txt']
+
+    sub = project / 'conversations' / 'sub'
+    os.utime(sub, ns=(mtime + 1_000_000_000, mtime + 1_000_000_000))
+    assert airproject.walk_tree() == ['sub/a.txt']
@@ -0,0 +1,86 @@
+import contextlib
+import io
+import json
+import threading
+import time
+
+from click.testing import CliRunner
+
+import airproject
+from mock_api import MockMessagesAPI
+
+def hold_lock(path, seconds):
+    """Holds path's write lock from another thread; returns once it is held."""
+    held = threading.Event()
+
+    def hold():
+        with airproject.file_lock(path):
+            held.set()
+            time.sleep(seconds)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    return thread
+
+def test_concurrent_appends_do_not_interleave(project):
+    path = str(project / 'conversations' / 'log.txt')
+    chunk = 256 * 1024
+
+    def writer(letter):
+        for _ in range(10):
+            airproject.append_locked(path, letter * chunk + "\n")
+
+    threads = [threading.Thread(target=writer, args=(letter,)) for letter in "abcdef"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lines = open(path).read().splitlines()
+    assert len(lines) == 60
+    assert all(line == line[0] * chunk for line in lines)
+
+def test_append_waits_for_the_lock(project):
+    path = str(project / 'conversations' / 'log.txt')
+    holder = hold_lock(path, 0.3)
+    assert airproject.append_locked(path, "x") >= 0.2
+    holder.join()
+
+def test_second_session_on_a_conversation_is_refused(project):
+    (project / 'conversations' / 'c.md').write_text("## User\n\nGo.\n")
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        first = airproject.open_session('c.md')
+        try:
+            assert airproject.open_session('c.md') is None
+        finally:
+            first.close()
+        second = airproject.open_session('c.md')
+        second.close()
+    assert "'c.md' is already being submitted by another session." in output.getvalue()
+    assert second is not None
+
+def test_lock_waits_reach_telemetry(project, monkeypatch):
+    (project / 'conversations' / 'c.md').write_text("## User\n\nGo.\n")
+    monkeypatch.setattr(airproject, '_output_budget', None)
+    monkeypatch.setattr(airproject, 'ANTHROPIC_API_KEY', 'mock')
+    call = {"type": "tool_use", "id": "toolu_1", "name": "write_file",
+            "input": {"filename": "out.txt", "content": "x"}}
+    api = MockMessagesAPI(script=[{"content": [call], "stop_reason": "tool_use"},
+                                  {"content": [{"type": "text", "text": "Done."}]}])
+    api.start()
+    monkeypatch.setenv('ANTHROPIC_BASE_URL', api.base_url)
+    # The turn's first append waits for the conversation; the tool, which
+    # runs after it, waits for out.txt.
+    holders = [hold_lock('conversations/c.md', 0.6), hold_lock('conversations/out.txt', 1.2)]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            airproject.run_async(airproject.run_session(airproject.open_session('c.md'), False))
+    finally:
+        for holder in holders:
+            holder.join()
+        api.stop()
+    records = [json.loads(line) for line in (project / airproject.TELEMETRY_FILE).read_text().splitlines()]
+    assert records[0]['lock_wait_ms'] >= 50
+    assert records[0]['tools'][0]['lock_wait_ms'] >= 50
+    assert "lock wait ms" in CliRunner().invoke(airproject.cli, ['stats']).output
@@ -0,0 +1,34 @@
+import contextlib
+import io
+
+import airproject
+
+def markers(blocks):
+    return [i for i, block in enumerate(blocks) if 'cache_control' in block]
+
+def tool_round(n):
+    call = {"type": "tool_use", "id": f"toolu_{n}", "name": "read_file", "input": {"filename": "a.txt"}}
+    result = {"type": "tool_result", "tool_use_id": f"toolu_{n}", "content": "alpha"}
+    return [{"role": "assistant", "content": [call]}, {"role": "user", "content": [result]}]
+
+def test_breakpoints_mark_the_last_tool_system_block_and_two_newest_user_turns(project):
+    (project / 'conversations' / 'a.txt').write_text("alpha")
+    (project / 'conversations' / 'c.md').write_text(
+        "## User\n\nHello.\n\n## Assistant\n\nHi.\n\n## User\n\nRead a.txt.\n")
+    with contextlib.redirect_stdout(io.StringIO()):
+        session = airproject.open_session('c.md')
+    try:
+        for n in range(3):
+            session.messages.extend(tool_round(n))
+            params = session.request_params(False)
+            assert markers(params['tools']) == [len(params['tools']) - 1]
+            assert markers(params['system']) == [len(params['system']) - 1]
+            marked = [i for i, message in enumerate(params['messages'])
+                      if markers(airproject.as_content_blocks(message['content']))]
+            users = [i for i, message in enumerate(params['messages']) if message['role'] == 'user']
+            assert marked == users[-2:]
+            assert len(marked) + 2 <= 4
+        # Marking copies the messages; the session's own stay unmarked.
+        assert not any(markers(airproject.as_content_blocks(message['content'])) for message in session.messages)
+    finally:
+        session.close()
@@ -0,0 +1,45 @@
+import contextlib
+import io
+import json
+
+import pytest
+
+import airproject
+from mock_api import MockMessagesAPI
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_rate_limit_mid_loop_is_retried_from_the_last_round(project, monkeypatch, stream):
+    (project / 'conversations' / 'c.md').write_text("## User\n\nGo.\n")
+    (project / 'conversations' / 'a.txt').write_text("alpha")
+    monkeypatch.setattr(airproject, '_output_budget', None)
+    monkeypatch.setattr(airproject, 'ANTHROPIC_API_KEY', 'mock')
+    monkeypatch.setattr(airproject, 'BACKOFF_BASE', 0.01)
+    read = {"type": "tool_use", "id": "toolu_1", "name": "read_file", "input": {"filename": "a.txt"}}
+    # Every second request is refused: the one after the tool round.
+    api = MockMessagesAPI(rate_limit_every=2, script=[{"content": [read], "stop_reason": "tool_use"},
+                                                      {"content": [{"type": "text", "text": "Done."}]}])
+    bodies = []
+    respond = api.respond
+    api.respond = lambda body: bodies.append(body) or respond(body)
+    ran = []
+    handle = airproject.handle_tool_use
+    monkeypatch.setattr(airproject, 'handle_tool_use',
+                        lambda tool_call, session=None: ran.append(tool_call.id) or handle(tool_call, session))
+    api.start()
+    monkeypatch.setenv('ANTHROPIC_BASE_URL', api.base_url)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            airproject.run_async(airproject.run_session(airproject.open_session('c.md'), stream))
+    finally:
+        api.stop()
+
+    assert api.stats['requests'] == 3 and api.stats['rate_limited'] == 1
+    assert "Rate limit exceeded" in output.getvalue() and "retrying in" in output.getvalue()
+    assert ran == ["toolu_1"]
+    # The retried request carries the finished tool round, not a restart.
+    assert len(bodies) == 2 and len(bodies[1]['messages']) == 3
+    assert bodies[1]['messages'][-1]['content'][0]['content'] == "alpha"
+    assert (project / 'conversations' / 'c.md').read_text().count("Done.") == 1
+    records = [json.loads(line) for line in (project / airproject.TELEMETRY_FILE).read_text().splitlines()]
+    assert [record['retries'] for record in records] == [0, 1]
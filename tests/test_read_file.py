@@ -0,0 +1,96 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from anthropic.types import ToolUseBlock
+
+import airproject
+
+def test_long_line_points_at_byte_offset(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 100 if name == 'read_file_max_bytes' else default)
+    (project / 'conversations' / 'big.txt').write_text("short\n" + "y" * 250 + "\nlast\n")
+    result = airproject.read_file('big.txt', start_line=2)
+    header, body = result.split("\n", 1)
+    assert body == "y" * 100
+    assert "offset=106" in header and "length=151" in header and "start_line=3" in header
+    rest = airproject.read_file('big.txt', offset=106, length=151)
+    assert rest.split("\n", 1)[1] == "y" * 100  # still capped, but continues the same line
+
+def test_line_ranges_continue_by_line(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 20 if name == 'read_file_max_bytes' else default)
+    (project / 'conversations' / 'lines.txt').write_text("".join(f"line {i}\n" for i in range(1, 10)))
+    header, body = airproject.read_file('lines.txt', start_line=1).split("\n", 1)
+    assert body == "line 1\nline 2\n"
+    assert "start_line=3" in header
+
+def test_line_index_cache_is_capped_in_bytes(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 1000 if name == 'line_index_cache_bytes' else default)
+    monkeypatch.setattr(airproject, '_line_index_cache', None)
+    for name in ('a.txt', 'b.txt'):
+        (project / 'conversations' / name).write_text("x\n" * 100)  # an 800-byte index
+        airproject.read_file(name, start_line=50, end_line=50)
+    cache = airproject.get_line_index_cache()
+    assert cache.size == 800 and len(cache.entries) == 1
+
+def test_oversized_line_index_is_spilled_not_rebuilt(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 100 if name == 'line_index_cache_bytes' else default)
+    monkeypatch.setattr(airproject, '_line_index_cache', None)
+    builds = []
+    build = airproject.build_line_index
+    monkeypatch.setattr(airproject, 'build_line_index', lambda *args: builds.append(args) or build(*args))
+    path = project / 'conversations' / 'log.txt'
+    path.write_text("".join(f"line {i}\n" for i in range(1, 101)))  # an 800-byte index
+    first = airproject.read_file('log.txt', start_line=50, end_line=51)
+    assert airproject.read_file('log.txt', start_line=50, end_line=51) == first
+    assert first.endswith("line 50\nline 51\n") and len(builds) == 1
+    assert len(list((project / airproject.LINE_INDEX_DIR).iterdir())) == 1
+
+    path.write_text("".join(f"entry {i}\n" for i in range(1, 201)))
+    assert airproject.read_file('log.txt', start_line=200).endswith("entry 200\n")
+    assert len(builds) == 2
+    assert len(list((project / airproject.LINE_INDEX_DIR).iterdir())) == 1
+
+def test_file_cache_counts_bytes_not_characters(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 100 if name == 'file_cache_bytes' else default)
+    monkeypatch.setattr(airproject, '_file_cache', None)
+    for name in ('a.txt', 'b.txt'):
+        (project / 'conversations' / name).write_text("é" * 30)  # 30 characters, 60 bytes
+        assert airproject.read_file(name) == "é" * 30
+    cache = airproject.get_file_cache()
+    assert cache.size == 60 and len(cache.entries) == 1
+
+def tool_use(n, name, **tool_input):
+    return ToolUseBlock(type="tool_use", id=f"toolu_{n}", name=name, input=tool_input)
+
+def test_unchanged_reread_points_at_the_first_result(project):
+    (project / 'conversations' / 'a.txt').write_text("alpha")
+    session = SimpleNamespace(delivered={})
+    assert airproject.handle_tool_use(tool_use(1, 'read_file', filename='a.txt'), session) == "alpha"
+    assert airproject.handle_tool_use(tool_use(2, 'read_file', filename='a.txt'), session) == \
+        airproject.UNCHANGED_NOTE.format("toolu_1")
+    airproject.handle_tool_use(tool_use(3, 'write_file', filename='a.txt', content="bravo"), session)
+    assert airproject.handle_tool_use(tool_use(4, 'read_file', filename='a.txt'), session) == "bravo"
+
+@pytest.mark.parametrize("tool, tool_input, after", [
+    ('write_file', {"content": "bravo"}, "bravo"),
+    ('append_file', {"content": "!"}, "alph!"),
+    ('edit_file', {"edits": [{"old_text": "alpha", "new_text": "gamma"}]}, "gamma"),
+    ('delete_file', {}, "Error: File 'a.txt' not found."),
+])
+def test_mutating_tools_invalidate_the_cache(project, monkeypatch, tool, tool_input, after):
+    monkeypatch.setattr(airproject, '_file_cache', None)
+    path = project / 'conversations' / 'a.txt'
+    path.write_text("alph" if tool == 'append_file' else "alpha")
+    airproject.read_file('a.txt')
+    stat = path.stat()
+    airproject.handle_tool_use(tool_use(1, tool, filename='a.txt', **tool_input))
+    assert not airproject.get_file_cache().entries
+    if path.exists() and path.stat().st_size == stat.st_size:
+        # A same-size rewrite within the mtime granularity keeps the cache key.
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert airproject.read_file('a.txt') == after
@@ -0,0 +1,26 @@
+import os
+from types import SimpleNamespace
+
+import airproject
+
+class Message(SimpleNamespace):
+    def to_dict(self):
+        return {"content": self.content}
+
+def test_eviction_keeps_a_running_total(project, monkeypatch):
+    monkeypatch.setattr(airproject, '_response_cache_total', None)
+    (project / '.aiproject.json').write_text('{"project_name": "test", "response_cache_bytes": 10000}')
+    cache = airproject.ResponseCache()
+    scans = []
+    scan = airproject.scan_response_cache
+    monkeypatch.setattr(airproject, 'scan_response_cache', lambda: scans.append(1) or scan())
+    keys = [f"{n:02d}" * 32 for n in range(20)]
+    for n, key in enumerate(keys):
+        cache.put(key, Message(content="x" * 1000))
+        os.utime(cache.path(key), (n, n))
+    # One scan to seed the total, then only when the cache overflows.
+    assert len(scans) < len(keys) // 2
+    remaining = [key for key in keys if os.path.exists(cache.path(key))]
+    assert remaining == keys[-len(remaining):]
+    size = sum(os.path.getsize(cache.path(key)) for key in remaining)
+    assert size <= 10000 and airproject._response_cache_total == size
@@ -0,0 +1,56 @@
+import pytest
+
+import airproject
+
+@pytest.mark.parametrize("pattern, literals", [
+    ('x{2,3}foo', ['foo']),
+    ('abc{1}defg', ['defg']),
+    ('(abc){2}defg', ['defg']),
+    ('hello{2}', ['hell']),
+    ('a{,2}bcd', ['bcd']),
+    ('literal{brace}', ['literal{brace}']),
+    ('foo.*bar', ['foo', 'bar']),
+    (r'[a\]b]xyz', ['xyz']),
+    ('[]ab]cde', ['cde']),
+])
+def test_required_literals(pattern, literals):
+    assert airproject.required_literals(pattern) == literals
+
+@pytest.mark.parametrize("query", ['x{2,3}foo', 'abc{1}defg', '(abc){2}defg', r'[a\]b]xyz'])
+def test_quantified_regex_finds_matches(project, query):
+    (project / 'conversations' / 'notes.txt').write_text("xxfoo\nabcdefg\nabcabcdefg\n]xyz\n")
+    result = airproject.search_files(query, regex=True)
+    assert result.startswith("notes.txt:"), result
+
+def test_concurrent_searches_share_a_fresh_index(project):
+    from concurrent.futures import ThreadPoolExecutor
+    for i in range(20):
+        (project / 'conversations' / f'f{i}.txt').write_text(f"needle {i}\n")
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: airproject.search_files('needle'), range(4)))
+    assert all(result.count("needle") == 20 for result in results), results
+
+def test_max_results_zero_returns_a_page(project):
+    (project / 'conversations' / 'a.txt').write_text("hit\nhit\n")
+    assert airproject.search_files('hit', max_results=0).startswith("a.txt:1: hit\n[More matches")
+
+def test_path_glob_matches_like_list_files(project):
+    (project / 'conversations' / 'src' / 'deep').mkdir(parents=True)
+    (project / 'conversations' / 'src' / 'top.py').write_text("hit\n")
+    (project / 'conversations' / 'src' / 'deep' / 'low.py').write_text("hit\n")
+    result = airproject.search_files('hit', path_glob='src/*.py')
+    assert result == "src/top.py:1: hit"
+    assert [entry['path'] for entry in airproject.list_files('src/*.py')['files']] == ['src/top.py']
+
+def test_unindexed_files_are_reported(project, monkeypatch):
+    monkeypatch.setattr(airproject, 'project_setting',
+                        lambda name, default: 100 if name == 'search_max_file_bytes' else default)
+    (project / 'conversations' / 'big.log').write_text("needle\n" * 50)
+    (project / 'conversations' / 'image.bin').write_bytes(b"\x00\x01needle")
+    result = airproject.search_files('needle')
+    assert result == "No matches for 'needle'.\n[2 file(s) not searched (binary, or over 100 bytes): big.log, image.bin]"
+    assert "not searched" not in airproject.search_files('needle', path_glob='*.txt')
+
+def test_files_too_short_for_a_trigram_are_searched(project):
+    (project / 'conversations' / 'ab.txt').write_text("ab")
+    assert airproject.search_files('ab') == "ab.txt:1: ab"
@@ -0,0 +1,17 @@
+import json
+
+import pytest
+
+import airproject
+
+@pytest.mark.parametrize('block_size', [16, 100, 65536])
+def test_recent_records_are_read_from_the_end(project, block_size):
+    (project / '.aiproject').mkdir()
+    records = [{"file": "c.md", "round": n, "output_tokens": n * 10} for n in range(50)]
+    lines = "".join(json.dumps(record) + "\n" for record in records)
+    (project / airproject.TELEMETRY_FILE).write_text(lines + '{"file": "c.md", "ro')  # torn by a crash
+    for count in (1, 10, 50, 100):
+        assert airproject.load_recent_telemetry(count, block_size) == records[-count:]
+
+def test_no_telemetry_yet(project):
+    assert airproject.load_recent_telemetry(10) == []
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+from anthropic.types import ToolUseBlock
+
+import airproject
+
+def call(n, name, **tool_input):
+    return ToolUseBlock(type="tool_use", id=f"toolu_{n}", name=name, input=tool_input)
+
+def results(tool_results):
+    return [(result['tool_use_id'], result['content']) for result in tool_results]
+
+@pytest.fixture
+def slow_tools(monkeypatch):
+    """Delays chosen calls by tool_use id before running them for real."""
+    delays = {}
+    finished = threading.Event()
+    handle = airproject.handle_tool_use
+
+    def slow(tool_call, session=None):
+        time.sleep(delays.get(tool_call.id, 0))
+        try:
+            return handle(tool_call, session)
+        finally:
+            if tool_call.id == max(delays, key=delays.get, default=None):
+                finished.set()
+
+    monkeypatch.setattr(airproject, 'handle_tool_use', slow)
+    yield delays
+    finished.wait(5)
+
+def test_reads_run_in_parallel_and_results_keep_their_order(project, monkeypatch):
+    barrier = threading.Barrier(3, timeout=5)
+
+    def read(tool_call, session=None):
+        barrier.wait()  # only passes if all three reads run at once
+        return tool_call.input['filename']
+
+    monkeypatch.setattr(airproject, 'handle_tool_use', read)
+    calls = [call(n, 'read_file', filename=f"{n}.txt") for n in (3, 1, 2)]
+    assert results(airproject.run_tool_calls(calls)) == [
+        ("toolu_3", "3.txt"), ("toolu_1", "1.txt"), ("toolu_2", "2.txt")]
+
+def test_calls_on_a_written_path_keep_their_order(project, slow_tools):
+    slow_tools['toolu_1'] = 0.2
+    calls = [call(1, 'append_file', filename="log.txt", content="1"),
+             call(2, 'read_file', filename="log.txt", start_line=1),
+             call(3, 'append_file', filename="log.txt", content="2")]
+    tool_results = results(airproject.run_tool_calls(calls))
+    assert tool_results[1][1].endswith("]\n1")
+    assert (project / 'conversations' / 'log.txt').read_text() == "12"
+
+def test_calls_behind_a_timed_out_write_are_cancelled(project, slow_tools):
+    (project / '.aiproject.json').write_text('{"project_name": "test", "tool_timeout": 0.5}')
+    slow_tools['toolu_1'] = 1.0
+    calls = [call(1, 'append_file', filename="log.txt", content="1"),
+             call(2, 'append_file', filename="log.txt", content="2")]
+    tool_results = results(airproject.run_tool_calls(calls))
+    assert tool_results == [
+        ("toolu_1", "Error: Tool 'append_file' timed out after 0.5s."),
+        ("toolu_2", "Error: Tool 'append_file' was not run (an earlier call on log.txt timed out).")]
+    time.sleep(1.0)
+    assert (project / 'conversations' / 'log.txt').read_text() == "1"
+
+def test_each_call_times_out_from_its_own_start(project, slow_tools):
+    (project / '.aiproject.json').write_text('{"project_name": "test", "tool_timeout": 1}')
+    (project / 'conversations' / 'a.txt').write_text("a")
+    slow_tools.update(toolu_1=0.6, toolu_2=1.3)
+    calls = [call(1, 'read_file', filename="a.txt", start_line=1),
+             call(2, 'read_file', filename="a.txt", start_line=1)]
+    tool_results = results(airproject.run_tool_calls(calls))
+    assert tool_results[0][1].endswith("]\na")
+    assert tool_results[1] == ("toolu_2", "Error: Tool 'read_file' timed out after 1s.")